@@ -0,0 +1,92 @@
+"""
+Vectorised trader profit / volume reports over completed transactions.
+
+Transactions are streamed from a Motor cursor with a tight projection. Each
+batch is turned into columnar numpy arrays and reduced with pandas to partial
+sums per (trader, currency, day), so memory is bounded by the number of groups
+rather than the number of rows. Amounts stay in integer minor units throughout.
+Volumes in different currencies are never added together; every row is priced
+with its own currency's exchange rate.
+"""
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+import numpy as np
+import pandas as pd
+
+REPORT_FIELDS = {"_id": 0, "trader_id": 1, "currency": 1, "amount": 1, "usdt_requested": 1, "completed_at": 1}
+REPORT_BATCH_SIZE = 50000
+SUM_COLUMNS = ["count", "volume", "usdt"]
+REPORT_COLUMNS = SUM_COLUMNS + ["profit"]
+GROUP_LEVELS = ["trader_id", "currency", "day"]
+DEFAULT_CURRENCY = "UAH"
+
+class TraderReport(NamedTuple):
+    by_trader: List[dict]  # per (trader_id, currency)
+    by_day: List[dict]  # per (day, currency)
+    by_currency: List[dict]
+
+def batch_totals(docs: List[dict]) -> pd.DataFrame:
+    """Reduce one batch of projected documents to sums per (trader_id, currency, day)."""
+    size = len(docs)
+    frame = pd.DataFrame({
+        "trader_id": [doc['trader_id'] for doc in docs],
+        "currency": [doc.get('currency', DEFAULT_CURRENCY) for doc in docs],
+        "day": pd.to_datetime([doc['completed_at'] for doc in docs], utc=True).floor("D"),
+        "volume": np.fromiter((doc.get('amount', 0) for doc in docs), dtype=np.int64, count=size),
+        "usdt": np.fromiter((doc.get('usdt_requested', 0) for doc in docs), dtype=np.int64, count=size),
+    })
+    frame["count"] = 1
+    return frame.groupby(GROUP_LEVELS, sort=False)[SUM_COLUMNS].sum()
+
+async def collect_totals(cursor, batch_size: int = REPORT_BATCH_SIZE) -> Optional[pd.DataFrame]:
+    partials = []
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            partials.append(batch_totals(batch))
+            batch = []
+    if batch:
+        partials.append(batch_totals(batch))
+    if not partials:
+        return None
+    return pd.concat(partials).groupby(level=GROUP_LEVELS).sum()
+
+def with_profit(frame: pd.DataFrame, markup: float, rates: Dict[str, float]) -> pd.DataFrame:
+    # Profit = currency received - (USDT sent * markup * rate of that currency), in minor units.
+    # A currency without a configured rate has no profit (None) rather than a wrong one.
+    frame = frame.copy()
+    rate = frame.index.get_level_values("currency").map(rates).to_numpy(dtype=np.float64, na_value=np.nan)
+    frame["profit"] = pd.array(np.rint(frame["volume"] - frame["usdt"] * markup * rate), dtype="Int64")
+    return frame
+
+def to_rows(frame: pd.DataFrame) -> List[dict]:
+    keys = list(frame.index.names)
+    rows = []
+    for index, values in zip(frame.index, frame[REPORT_COLUMNS].astype(object).to_numpy().tolist()):
+        row = {key: value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+               for key, value in zip(keys, index if isinstance(index, tuple) else (index,))}
+        row.update((column, None if value is pd.NA else int(value)) for column, value in zip(REPORT_COLUMNS, values))
+        rows.append(row)
+    return rows
+
+async def build_trader_report(cursor, markup: float, rates: Dict[str, float],
+                              batch_size: int = REPORT_BATCH_SIZE) -> TraderReport:
+    """Count, volume, USDT and profit per (trader, currency), (day, currency) and currency for `cursor`."""
+    totals = await collect_totals(cursor, batch_size)
+    if totals is None:
+        return TraderReport(by_trader=[], by_day=[], by_currency=[])
+    by_trader = with_profit(totals.groupby(level=["trader_id", "currency"]).sum(), markup, rates)
+    by_day = with_profit(totals.groupby(level=["day", "currency"]).sum(), markup, rates)
+    by_currency = with_profit(totals.groupby(level="currency").sum(), markup, rates)
+    return TraderReport(
+        by_trader=to_rows(by_trader.sort_values(["currency", "volume"], ascending=[True, False])),
+        by_day=to_rows(by_day.sort_index()),
+        by_currency=to_rows(by_currency.sort_index())
+    )
+
+def report_match(start: datetime, end: datetime, trader_id: Optional[str] = None) -> dict:
+    match = {"status": "completed", "completed_at": {"$gte": start, "$lt": end}}
+    if trader_id:
+        match["trader_id"] = trader_id
+    return match
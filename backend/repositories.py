@@ -0,0 +1,263 @@
+"""
+Data access layer for the SkiPay API.
+
+One repository per collection. A `Repositories` bundle is created per request
+(see get_repos in server.py): documents read through it are kept in per-request
+identity maps, so repeated lookups of the same id hit Mongo once, and get_many()
+turns N lookups into a single $in query. get() calls issued in the same event
+loop tick (e.g. under asyncio.gather) are folded into one get_many() the same
+way, DataLoader-style. Every round trip is reported to the functions in
+`query_hooks`.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Raise on hot queries that would scatter across shards (enable in dev/CI)
+SHARD_KEY_CHECKS = os.environ.get('SHARD_KEY_CHECKS', '0') == '1'
+
+# transactions and cards are laid out to be sharded by trader_id; transaction_keys
+# (transaction id -> trader_id map for user-side lookups) by user_id
+SHARD_KEYS = {
+    "transactions": "trader_id",
+    "transactions_archive": "trader_id",
+    "cards": "trader_id",
+    "transaction_keys": "user_id",
+}
+
+# Called as hook(collection, operation, seconds, documents) after every query
+query_hooks: List[Callable[[str, str, float, int], None]] = []
+
+def targeted(collection: str, query: dict) -> dict:
+    """Mark a hot query as shard-targeted; with SHARD_KEY_CHECKS on, a missing shard key raises."""
+    if SHARD_KEY_CHECKS and SHARD_KEYS[collection] not in query:
+        raise AssertionError(f"Scatter-gather query on {collection}: {sorted(query)}")
+    return query
+
+async def fetch_bounded(cursor, name: str, limit: int) -> List[dict]:
+    """Materialise at most `limit` documents; a larger result is logged instead of cut silently."""
+    docs = await cursor.limit(limit + 1).to_list(None)
+    if len(docs) > limit:
+        logger.warning("Query %s truncated to %d results", name, limit)
+        del docs[limit:]
+    return docs
+
+class Repository:
+    collection_name = ""
+    key = "id"
+    projection = {"_id": 0}
+
+    def __init__(self, db, max_results: int, identity_map: Optional[dict] = None):
+        self.db = db
+        self.collection = db[self.collection_name]
+        self.max_results = max_results
+        # Pass a longer-lived mapping here to share cached documents across requests
+        self.identity_map = {} if identity_map is None else identity_map
+        # scope -> key -> future for get() calls waiting on the next batch
+        self.pending_loads: Dict[tuple, Dict[str, asyncio.Future]] = {}
+        self.dispatches = set()
+
+    def query(self, query: dict, scatter: bool = False) -> dict:
+        """Filter for this collection; pass scatter=True for deliberate cross-shard reads (admin)."""
+        if self.collection_name in SHARD_KEYS and not scatter:
+            return targeted(self.collection_name, query)
+        return query
+
+    def report(self, operation: str, started: float, documents: int):
+        elapsed = time.perf_counter() - started
+        for hook in query_hooks:
+            hook(self.collection_name, operation, elapsed, documents)
+
+    def remember(self, doc: Optional[dict]) -> Optional[dict]:
+        if doc is not None:
+            self.identity_map[doc[self.key]] = doc
+        return doc
+
+    def forget(self, key: str):
+        self.identity_map.pop(key, None)
+
+    async def get(self, key: str, **scope) -> Optional[dict]:
+        """One document by key; concurrent calls in the same tick share a single $in query."""
+        if key in self.identity_map:
+            return (await self.get_many([key], **scope)).get(key)
+        loop = asyncio.get_running_loop()
+        scope_key = tuple(sorted(scope.items()))
+        batch = self.pending_loads.get(scope_key)
+        if batch is None:
+            batch = self.pending_loads[scope_key] = {}
+            loop.call_soon(self.start_dispatch, scope_key)
+        if key not in batch:
+            batch[key] = loop.create_future()
+        return await batch[key]
+
+    def start_dispatch(self, scope_key: tuple):
+        task = asyncio.ensure_future(self.dispatch(scope_key))
+        self.dispatches.add(task)
+        task.add_done_callback(self.dispatches.discard)
+
+    async def dispatch(self, scope_key: tuple):
+        batch = self.pending_loads.pop(scope_key)
+        try:
+            found = await self.get_many(batch, **dict(scope_key))
+        except Exception as exc:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+    async def get_many(self, keys: Iterable[str], **scope) -> Dict[str, dict]:
+        """Documents by key; `scope` adds fields every match must have (e.g. the shard key)."""
+        keys = list(dict.fromkeys(keys))
+        missing = [key for key in keys if key not in self.identity_map]
+        if missing:
+            started = time.perf_counter()
+            docs = await self.collection.find(
+                self.query({**scope, self.key: {"$in": missing}}), self.projection
+            ).to_list(None)
+            self.report("get_many", started, len(docs))
+            for doc in docs:
+                self.remember(doc)
+        found = {}
+        for key in keys:
+            doc = self.identity_map.get(key)
+            if doc is not None and all(doc.get(field) == value for field, value in scope.items()):
+                found[key] = doc
+        return found
+
+    async def find_one(self, query: dict) -> Optional[dict]:
+        started = time.perf_counter()
+        doc = await self.collection.find_one(self.query(query), self.projection)
+        self.report("find_one", started, int(doc is not None))
+        return self.remember(doc)
+
+    async def list(self, query: dict, name: str, sort=None, projection: Optional[dict] = None,
+                   scatter: bool = False) -> List[dict]:
+        cursor = self.collection.find(self.query(query, scatter), projection or self.projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        started = time.perf_counter()
+        docs = await fetch_bounded(cursor, name, self.max_results)
+        self.report("list", started, len(docs))
+        if projection is None:
+            for doc in docs:
+                self.remember(doc)
+        return docs
+
+    async def count(self, query: dict) -> int:
+        started = time.perf_counter()
+        count = await self.collection.count_documents(self.query(query))
+        self.report("count", started, count)
+        return count
+
+    async def insert(self, doc: dict):
+        started = time.perf_counter()
+        # insert_one adds _id to the dict it is given
+        await self.collection.insert_one(dict(doc))
+        self.report("insert", started, 1)
+        self.remember(doc)
+
+    async def update(self, key: str, fields: dict, unset: Iterable[str] = (), **scope) -> Optional[dict]:
+        """$set `fields` (and $unset `unset`) on one document and return it updated, or None if it doesn't exist."""
+        started = time.perf_counter()
+        update = {"$set": fields}
+        if unset:
+            update["$unset"] = dict.fromkeys(unset, "")
+        doc = await self.collection.find_one_and_update(
+            self.query({**scope, self.key: key}),
+            update,
+            projection=self.projection,
+            return_document=ReturnDocument.AFTER
+        )
+        self.report("update", started, int(doc is not None))
+        self.forget(key)
+        return self.remember(doc)
+
+    async def delete(self, key: str, **scope) -> bool:
+        started = time.perf_counter()
+        result = await self.collection.delete_one(self.query({**scope, self.key: key}))
+        self.report("delete", started, result.deleted_count)
+        self.forget(key)
+        return result.deleted_count > 0
+
+class UserRepo(Repository):
+    collection_name = "users"
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return await self.find_one({"email": email})
+
+class TraderRepo(Repository):
+    collection_name = "traders"
+    # Settlement and job bookkeeping stays server-side
+    projection = {"_id": 0, "pending_settlements": 0, "applied_jobs": 0}
+
+    async def get_by_user(self, user_id: str) -> Optional[dict]:
+        for trader in self.identity_map.values():
+            if trader['user_id'] == user_id:
+                return trader
+        return await self.find_one({"user_id": user_id})
+
+class CardRepo(Repository):
+    collection_name = "cards"
+
+class TxnRepo(Repository):
+    collection_name = "transactions"
+    archive_name = "transactions_archive"
+
+    async def history(self, query: dict, name: str, include_archive: bool = False,
+                      scatter: bool = False) -> List[dict]:
+        """Newest-first transactions matching `query`, optionally including archived ones."""
+        transactions = await self.list(query, name, sort=[("created_at", -1)], scatter=scatter)
+        if include_archive:
+            archive_query = query if scatter else targeted(self.archive_name, query)
+            started = time.perf_counter()
+            archived = await fetch_bounded(
+                self.db[self.archive_name].find(archive_query, self.projection).sort("created_at", -1),
+                f"{name}_archive", self.max_results
+            )
+            self.report("history_archive", started, len(archived))
+            transactions = sorted(transactions + archived, key=lambda txn: txn['created_at'], reverse=True)
+            if len(transactions) > self.max_results:
+                logger.warning("Query %s truncated to %d results", name, self.max_results)
+                del transactions[self.max_results:]
+        return transactions
+
+class TransactionKeyRepo(Repository):
+    collection_name = "transaction_keys"
+    key = "_id"
+    projection = None
+
+class WithdrawalRepo(Repository):
+    collection_name = "withdrawals"
+
+class SettingsRepo(Repository):
+    """The single settings document."""
+    collection_name = "settings"
+
+    async def load(self) -> Optional[dict]:
+        started = time.perf_counter()
+        doc = await self.collection.find_one({}, self.projection)
+        self.report("find_one", started, int(doc is not None))
+        return doc
+
+    async def save(self, fields: dict):
+        started = time.perf_counter()
+        await self.collection.update_one({}, {"$set": fields}, upsert=True)
+        self.report("update", started, 1)
+
+class Repositories:
+    def __init__(self, db, max_results: int):
+        self.users = UserRepo(db, max_results)
+        self.traders = TraderRepo(db, max_results)
+        self.cards = CardRepo(db, max_results)
+        self.transactions = TxnRepo(db, max_results)
+        self.transaction_keys = TransactionKeyRepo(db, max_results)
+        self.withdrawals = WithdrawalRepo(db, max_results)
+        self.settings = SettingsRepo(db, max_results)
@@ -1,24 +1,44 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 import os
+import asyncio
+import csv
+import hashlib
+import io
+import json
 import logging
+import math
+import time
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from collections import OrderedDict
 import uuid
 from datetime import datetime, timezone, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 import bcrypt
 import jwt
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Imported after load_dotenv: repositories reads its settings from the environment
+from repositories import Repositories, SettingsRepo, query_hooks, targeted
+from reporting import REPORT_BATCH_SIZE, REPORT_FIELDS, build_trader_report, report_match
+from snapshots import LeaseLost, run_snapshot
+
 # MongoDB connection
+# Timestamps are stored as BSON dates; tz_aware returns them as UTC-aware datetimes
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
@@ -26,6 +46,91 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production'
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
 
+# AUTH_MODE=stateless trusts signed token claims instead of re-reading the user
+# on every request: access tokens are short-lived, clients renew them with a
+# refresh token, and blocked users are rejected from an in-memory set
+AUTH_MODE = os.environ.get('AUTH_MODE', 'database')
+ACCESS_TOKEN_MINUTES = int(os.environ.get('ACCESS_TOKEN_MINUTES', '15'))
+REFRESH_TOKEN_DAYS = int(os.environ.get('REFRESH_TOKEN_DAYS', '7'))
+BLOCKED_USERS_REFRESH_SECONDS = int(os.environ.get('BLOCKED_USERS_REFRESH_SECONDS', '30'))
+
+# Idempotency-Key records expire after this long (TTL index); an in-progress
+# record older than the lock timeout is treated as abandoned and taken over
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+# Rate limiting: "memory" keeps token buckets per worker, "mongo" shares them
+# across workers through the rate_limits collection
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+
+# Deposit routing answers from an in-process index of traders and cards kept
+# current by a change stream, or by polling on a standalone mongod
+ROUTING_INDEX_POLL_SECONDS = int(os.environ.get('ROUTING_INDEX_POLL_SECONDS', '5'))
+# Deposits answer 503 if the index hasn't loaded within this long
+ROUTING_INDEX_READY_TIMEOUT_SECONDS = float(os.environ.get('ROUTING_INDEX_READY_TIMEOUT_SECONDS', '5'))
+
+# Cards with less headroom than this (minor units), or whose trader is blocked
+# or below the minimum balance, are auto-paused until they can take deposits again
+CARD_MIN_HEADROOM = int(os.environ.get('CARD_MIN_HEADROOM', '10000'))
+CARD_HEALTH_INTERVAL_SECONDS = int(os.environ.get('CARD_HEALTH_INTERVAL_SECONDS', '60'))
+
+# Settlements stuck in "settling" longer than this are completed or rolled back
+# by the recovery worker
+SETTLEMENT_RECOVERY_GRACE_SECONDS = int(os.environ.get('SETTLEMENT_RECOVERY_GRACE_SECONDS', '60'))
+
+# The events tail stops at a sequence gap younger than this: the event holding
+# that number may still be in flight
+EVENT_GAP_WAIT_SECONDS = 5
+EVENTS_PAGE_MAX = 1000
+
+# Background job queue
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '20'))
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '4'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_LEASE_SECONDS = 60
+JOB_POLL_SECONDS = 1
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', str(7 * 86400)))
+
+# Upper bound on documents any list endpoint materialises in memory
+MAX_QUERY_RESULTS = int(os.environ.get('MAX_QUERY_RESULTS', '1000'))
+
+# Terminal transactions older than this move to transactions_archive
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600'))
+ARCHIVE_BATCH_SIZE = 1000
+
+# Parquet snapshots for offline analytics; disabled unless SNAPSHOT_DIR is set.
+# Only rows older than SNAPSHOT_LAG_HOURS are exported, once their status has settled.
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '')
+SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get('SNAPSHOT_INTERVAL_SECONDS', '3600'))
+SNAPSHOT_LAG_HOURS = int(os.environ.get('SNAPSHOT_LAG_HOURS', '48'))
+# Identifies this process as a lease holder, e.g. for the snapshot lease
+WORKER_ID = os.environ.get('WORKER_ID') or uuid.uuid4().hex
+
+# Read preference per route class. Dashboards and analytics may read from
+# secondaries lagging the primary by up to READ_MAX_STALENESS_SECONDS (Mongo's
+# minimum is 90); matching, settlement and auth always read the primary.
+READ_MAX_STALENESS_SECONDS = int(os.environ.get('READ_MAX_STALENESS_SECONDS', '90'))
+READ_PREFERENCE_MODES = {
+    "primary": "primary",
+    "dashboard": os.environ.get('DASHBOARD_READ_PREFERENCE', 'secondaryPreferred'),
+    "analytics": os.environ.get('ANALYTICS_READ_PREFERENCE', 'secondaryPreferred'),
+}
+
+# Repository queries slower than this are logged
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', '200'))
+
+# Settings are cached in-process for this long; updates on this worker apply immediately
+SETTINGS_CACHE_SECONDS = int(os.environ.get('SETTINGS_CACHE_SECONDS', '30'))
+QUOTE_BATCH_MAX = 50
+
+# Most transactions a trader can confirm in one batch request
+CONFIRM_BATCH_MAX = int(os.environ.get('CONFIRM_BATCH_MAX', '100'))
+
+# Admin stats counters are reconciled against the collections on this interval
+STATS_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('STATS_RECONCILE_INTERVAL_SECONDS', '300'))
+
 security = HTTPBearer()
 
 app = FastAPI()
@@ -40,6 +145,9 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -48,7 +156,7 @@ class User(BaseModel):
     role: str = "user"  # user, trader, admin
     is_blocked: bool = False
     is_approved: bool = False  # Requires admin approval
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class TraderRegister(BaseModel):
     name: str
@@ -64,10 +172,10 @@ class Trader(BaseModel):
     nickname: str
     usdt_address: str
     phone: str
-    usdt_balance: float = 0.0
+    usdt_balance: int = 0  # USDT cents
     is_blocked: bool = False
     is_working: bool = False  # Toggle work status
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class CardCreate(BaseModel):
     card_number: str
@@ -84,12 +192,13 @@ class Card(BaseModel):
     card_number: str
     bank_name: str
     holder_name: str
-    limit: float
-    current_usage: float = 0.0
-    status: str = "active"  # active, paused
+    limit: int  # Minor units (kopecks)
+    current_usage: int = 0  # Minor units (kopecks)
+    status: str = "active"  # active, paused, auto_paused
+    pause_reason: Optional[str] = None  # Why an auto_paused card was paused: no_capacity, trader_ineligible
     currency: str = "UAH"
     card_name: Optional[str] = None  # Custom name for the card
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class CardUpdate(BaseModel):
     limit: Optional[float] = None
@@ -100,21 +209,27 @@ class TransactionRequest(BaseModel):
     amount: float  # Amount in UAH user wants to pay
     currency: str = "UAH"  # Payment currency
 
+class BatchConfirmRequest(BaseModel):
+    transaction_ids: List[str]
+
 class Transaction(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     trader_id: str
     card_id: str
-    amount: float  # Amount in UAH with commission that user pays
-    usdt_requested: float = 0.0  # Amount of USDT user requested
-    usdt_amount: float = 0.0  # Actual USDT amount sent to user (same as requested)
+    amount: int  # Amount in UAH kopecks (without commission)
+    usdt_requested: int = 0  # USDT cents user requested
+    usdt_amount: int = 0  # USDT cents actually sent to user (same as requested)
+    commission_amount: int = 0  # Platform commission in kopecks
     currency: str = "UAH"
-    status: str = "pending"  # pending, user_confirmed, trader_confirmed, completed, cancelled
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-    user_confirmed_at: Optional[str] = None
-    completed_at: Optional[str] = None
-    expires_at: str = Field(default_factory=lambda: (datetime.now(timezone.utc) + timedelta(minutes=30)).isoformat())
+    status: str = "pending"  # pending, user_confirmed, settling, completed, expired, cancelled
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    user_confirmed_at: Optional[datetime] = None
+    settling_at: Optional[datetime] = None  # Write-ahead marker while the trader is being debited
+    settling_batch: Optional[str] = None  # Batch confirmation that claimed the transaction
+    completed_at: Optional[datetime] = None
+    expires_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc) + timedelta(minutes=30))
 
 class AdminAddBalance(BaseModel):
     amount: float
@@ -122,6 +237,7 @@ class AdminAddBalance(BaseModel):
 class AdminSettings(BaseModel):
     commission_rate: float  # percentage
     usd_to_uah_rate: float  # 1 USDT = X UAH
+    currency_rates: Dict[str, float] = {}  # Other currencies: 1 USDT = X units; UAH always uses usd_to_uah_rate
     deposit_wallet_address: str = "TB4K5h9QwFGSYR2LLJS9ejmt9EjHWurvi1"  # TRC-20 wallet for deposits
 
 class WithdrawalRequest(BaseModel):
@@ -133,13 +249,878 @@ class Withdrawal(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     user_email: str
-    amount: float
+    amount: int  # USDT cents
     wallet_address: str
     status: str = "pending"  # pending, approved, rejected
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-    processed_at: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    processed_at: Optional[datetime] = None
     admin_note: Optional[str] = None
 
+# ===== MONEY HELPERS =====
+# Money is stored as integer minor units (cents / kopecks) so balance and usage
+# arithmetic can run inside atomic $inc updates and aggregation pipelines.
+# The API keeps speaking decimal amounts; conversion happens at the boundary.
+MINOR_UNITS = 100
+TRADER_MARKUP = Decimal('1.04')  # Trader is debited requested USDT + 4%
+MIN_TRADER_BALANCE = 50 * MINOR_UNITS  # 50 USDT
+LOW_BALANCE_WARNING = "Your balance is below 50 USDT. You have been automatically disabled from work."
+
+TRADER_MONEY_FIELDS = ("usdt_balance",)
+CARD_MONEY_FIELDS = ("limit", "current_usage")
+TRANSACTION_MONEY_FIELDS = ("amount", "usdt_requested", "usdt_amount", "commission_amount")
+WITHDRAWAL_MONEY_FIELDS = ("amount",)
+
+USER_PUBLIC_PROJECTION = {"_id": 0, "password_hash": 0}
+
+def to_minor(amount) -> int:
+    """Convert a decimal amount (e.g. 12.345 UAH) to integer minor units."""
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def from_minor(value) -> float:
+    """Convert stored minor units back to a decimal amount for API responses."""
+    return float(Decimal(value or 0) / MINOR_UNITS)
+
+def scale_minor(value: int, factor) -> int:
+    """Multiply minor units by a factor, rounding half-up to a whole minor unit."""
+    return int((Decimal(value) * Decimal(str(factor))).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def present_money(doc: Optional[dict], fields) -> Optional[dict]:
+    """Return a copy of a stored document with money fields as decimal amounts."""
+    if doc is None:
+        return None
+    doc = dict(doc)
+    for field in fields:
+        if field in doc:
+            doc[field] = from_minor(doc[field])
+    return doc
+
+def present_trader(doc: Optional[dict]) -> Optional[dict]:
+    return present_money(doc, TRADER_MONEY_FIELDS)
+
+def present_card(doc: Optional[dict]) -> Optional[dict]:
+    return present_money(doc, CARD_MONEY_FIELDS)
+
+def present_transaction(doc: Optional[dict]) -> Optional[dict]:
+    return present_money(doc, TRANSACTION_MONEY_FIELDS)
+
+def present_withdrawal(doc: Optional[dict]) -> Optional[dict]:
+    return present_money(doc, WITHDRAWAL_MONEY_FIELDS)
+
+# ===== READ ROUTING =====
+READ_PREFERENCE_TYPES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def make_read_preference(mode: str):
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCE_TYPES[mode](max_staleness=READ_MAX_STALENESS_SECONDS)
+
+READ_PREFERENCES = {route_class: make_read_preference(mode) for route_class, mode in READ_PREFERENCE_MODES.items()}
+
+def reader(route_class: str):
+    """Database handle for reads of the given route class."""
+    return db.with_options(read_preference=READ_PREFERENCES[route_class])
+
+# ===== REPOSITORIES =====
+# Route handlers read and write through a per-request Repositories bundle
+# (repositories.py); atomic guarded updates (settlement, card reservation,
+# idempotency, jobs) stay as direct collection calls.
+async def get_repos() -> Repositories:
+    return Repositories(db, MAX_QUERY_RESULTS)
+
+async def get_dashboard_repos() -> Repositories:
+    """Read-only repositories for polled dashboard lists; may be served by a secondary."""
+    return Repositories(reader("dashboard"), MAX_QUERY_RESULTS)
+
+def log_slow_query(collection: str, operation: str, seconds: float, documents: int):
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        logger.warning("Slow query: %s.%s took %.0f ms (%d docs)", collection, operation, seconds * 1000, documents)
+
+query_hooks.append(log_slow_query)
+
+# ===== ARCHIVE =====
+# Completed, expired and cancelled transactions are moved out of the hot
+# `transactions` collection once they are ARCHIVE_AFTER_DAYS old, keeping its
+# working set and indexes small. List reads only include the archive when asked
+# to; balances and totals always aggregate over both collections.
+ARCHIVABLE_STATUSES = ["completed", "expired", "cancelled"]
+
+async def archive_transactions():
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    archived = 0
+    while True:
+        batch = await db.transactions.find(
+            {"status": {"$in": ARCHIVABLE_STATUSES}, "created_at": {"$lt": cutoff}}
+        ).limit(ARCHIVE_BATCH_SIZE).to_list(None)
+        if not batch:
+            break
+        # Copy first, delete second: a crash in between leaves copies that the next run overwrites
+        await db.transactions_archive.bulk_write(
+            [ReplaceOne({"_id": doc['_id']}, doc, upsert=True) for doc in batch], ordered=False
+        )
+        await db.transactions.delete_many({"_id": {"$in": [doc['_id'] for doc in batch]}})
+        archived += len(batch)
+        if len(batch) < ARCHIVE_BATCH_SIZE:
+            break
+    if archived:
+        logger.info("Archived %d transactions older than %s", archived, cutoff.date())
+
+def including_archive(match: dict) -> List[dict]:
+    """Pipeline prefix selecting `match` from both the hot and the archived transactions."""
+    return [
+        {"$match": match},
+        {"$unionWith": {"coll": "transactions_archive", "pipeline": [{"$match": match}]}}
+    ]
+
+# ===== SNAPSHOTS =====
+SNAPSHOT_LEASE_ID = "snapshot_history"
+
+async def acquire_lease(lease_id: str, seconds: int) -> bool:
+    """Take or extend a named lease; False while another worker holds it."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.leases.find_one_and_update(
+            {"_id": lease_id, "$or": [{"expires_at": {"$lte": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lease exists and is held by someone else, so the upsert collided
+        return False
+    return True
+
+async def release_lease(lease_id: str):
+    await db.leases.update_one(
+        {"_id": lease_id, "owner": WORKER_ID},
+        {"$set": {"expires_at": datetime.now(timezone.utc)}}
+    )
+
+async def snapshot_history():
+    # Every worker schedules the job, but only the lease holder writes files
+    if not await acquire_lease(SNAPSHOT_LEASE_ID, SNAPSHOT_INTERVAL_SECONDS):
+        logger.info("Snapshot skipped: lease held by another worker")
+        return
+    
+    async def renew_lease():
+        # Extended before every write, so a long export can't outlive its lease
+        if not await acquire_lease(SNAPSHOT_LEASE_ID, SNAPSHOT_INTERVAL_SECONDS):
+            raise LeaseLost()
+    
+    try:
+        written = await run_snapshot(reader("analytics"), Path(SNAPSHOT_DIR), timedelta(hours=SNAPSHOT_LAG_HOURS),
+                                     renew_lease)
+    except LeaseLost:
+        logger.warning("Snapshot stopped: lease taken over by another worker")
+        return
+    finally:
+        await release_lease(SNAPSHOT_LEASE_ID)
+    logger.info("Snapshot written to %s: %s", SNAPSHOT_DIR, written)
+
+# ===== SHARDING =====
+# transactions and cards are laid out to be sharded by trader_id (SHARD_KEYS in
+# repositories.py). Hot queries always carry the shard key so mongos can route
+# them to a single shard. User-side lookups go through transaction_keys
+# (sharded by user_id), which maps each transaction id to its trader_id.
+async def user_transactions_filter(user_id: str) -> dict:
+    """Filter for a user's transactions, limited to the shards of traders they've dealt with."""
+    trader_ids = await db.transaction_keys.distinct("trader_id", targeted("transaction_keys", {"user_id": user_id}))
+    return {"user_id": user_id, "trader_id": {"$in": trader_ids}}
+
+# ===== STATS COUNTERS =====
+# Admin totals live in a single counters document, bumped on inserts and status
+# transitions and periodically reconciled with exact counts.
+ADMIN_STATS_ID = "admin_stats"
+ADMIN_STATS_FIELDS = ("total_traders", "total_users", "total_transactions", "completed_transactions")
+
+async def bump_admin_stats(**deltas: int):
+    await db.counters.update_one({"_id": ADMIN_STATS_ID}, {"$inc": deltas}, upsert=True)
+
+async def reconcile_admin_stats() -> dict:
+    """Recount admin totals and overwrite the cached counters."""
+    # Unfiltered totals come from collection metadata instead of a full scan
+    counts = {
+        "total_traders": await db.traders.estimated_document_count(),
+        "total_users": await db.users.count_documents({"role": "user"}),
+        "total_transactions": (await db.transactions.estimated_document_count()
+                               + await db.transactions_archive.estimated_document_count()),
+        "completed_transactions": (await db.transactions.count_documents({"status": "completed"})
+                                   + await db.transactions_archive.count_documents({"status": "completed"}))
+    }
+    await db.counters.update_one(
+        {"_id": ADMIN_STATS_ID},
+        {"$set": {**counts, "reconciled_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return counts
+
+# ===== IDEMPOTENCY =====
+# Retried POSTs carrying the same Idempotency-Key get the stored response back
+# instead of re-running the handler. Records live in the TTL-indexed
+# idempotency_keys collection; completed responses are also kept in a small
+# in-process LRU so hot retries skip Mongo entirely. Each record carries a hash
+# of the request, and reusing a key for a different request is rejected.
+idempotency_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def request_hash(payload) -> str:
+    return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+def check_request_hash(stored: Optional[str], expected: str):
+    if stored is not None and stored != expected:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Idempotency-Key was already used with a different request")
+
+def cache_idempotent_response(record_id: str, payload_hash: str, response, expires_at: datetime):
+    idempotency_cache[record_id] = (expires_at, payload_hash, response)
+    idempotency_cache.move_to_end(record_id)
+    while len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        idempotency_cache.popitem(last=False)
+
+async def run_idempotent(key: Optional[str], scope: str, user_id: str, payload, handler):
+    """Run `handler` at most once per (user, scope, key) and replay its response on retries of the same `payload`."""
+    if not key:
+        return await handler()
+    
+    record_id = f"{user_id}:{scope}:{key}"
+    payload_hash = request_hash(payload)
+    now = datetime.now(timezone.utc)
+    cached = idempotency_cache.get(record_id)
+    if cached and cached[0] > now:
+        check_request_hash(cached[1], payload_hash)
+        return cached[2]
+    
+    try:
+        await db.idempotency_keys.insert_one({"_id": record_id, "status": "in_progress",
+                                              "request_hash": payload_hash, "created_at": now})
+    except DuplicateKeyError:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record:
+            check_request_hash(record.get('request_hash'), payload_hash)
+        if record and record['status'] == 'completed':
+            cache_idempotent_response(record_id, payload_hash, record['response'],
+                                      record['created_at'] + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS))
+            return record['response']
+        # Take over a lock left behind by a crashed worker
+        stale = await db.idempotency_keys.find_one_and_update(
+            {"_id": record_id, "status": "in_progress", "created_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}},
+            {"$set": {"created_at": now}}
+        )
+        if not stale:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is already in progress")
+    
+    try:
+        response = jsonable_encoder(await handler())
+    except Exception:
+        # Failed requests (including 4xx) may be retried with the same key
+        await db.idempotency_keys.delete_one({"_id": record_id})
+        raise
+    
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$set": {"status": "completed", "response": response}}
+    )
+    cache_idempotent_response(record_id, payload_hash, response, now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS))
+    return response
+
+# ===== RATE LIMITING =====
+# Token buckets per (route class, principal). The principal is the user_id
+# from the bearer token (decoded without a database read) or the client IP.
+# Limits are checked in route-level dependencies, which FastAPI resolves
+# before get_current_user, so throttled requests never reach the database.
+RATE_LIMITS = {
+    # route class: (tokens refilled per second, bucket size)
+    "auth": (0.2, 5),
+    "deposit": (0.5, 5),
+    "write": (2.0, 20),
+    "poll": (3.0, 30),
+}
+RATE_LIMIT_MEMORY_MAX_KEYS = 100000
+
+class MemoryRateLimiter:
+    def __init__(self):
+        # key -> (tokens, updated_at), least recently used first
+        self.buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        """Take one token; return 0 when allowed, else seconds until a token is available."""
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        self.buckets.move_to_end(key)
+        # The idlest buckets go first; they are the ones closest to full again
+        while len(self.buckets) > RATE_LIMIT_MEMORY_MAX_KEYS:
+            self.buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+class MongoRateLimiter:
+    """Shared buckets updated with a single atomic pipeline update per request."""
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        now = time.time()
+        refilled = {"$min": [burst, {"$add": [
+            {"$ifNull": ["$tokens", burst]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, rate]}
+        ]}]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=burst / rate)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if bucket['allowed']:
+            return 0
+        return (1 - bucket['tokens']) / rate
+
+rate_limiter = MongoRateLimiter() if RATE_LIMIT_BACKEND == 'mongo' else MemoryRateLimiter()
+
+def rate_limit_principal(request: Request) -> str:
+    authorization = request.headers.get("Authorization", "")
+    if authorization.lower().startswith("bearer "):
+        try:
+            payload = jwt.decode(authorization[7:], JWT_SECRET, algorithms=[JWT_ALGORITHM])
+            return f"user:{payload['user_id']}"
+        except (jwt.InvalidTokenError, KeyError):
+            pass
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+def rate_limit(route_class: str):
+    rate, burst = RATE_LIMITS[route_class]
+    
+    async def check_rate_limit(request: Request):
+        key = f"{route_class}:{rate_limit_principal(request)}"
+        retry_after = await rate_limiter.acquire(key, rate, burst)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+    
+    return Depends(check_rate_limit)
+
+# ===== ROUTING INDEX =====
+# In-process view of everything deposit routing needs: trader eligibility and
+# active card headroom. Route handlers that change these fields write through
+# to the index; a change stream (or polling fallback) brings in writes made by
+# other workers. Routing reads only from memory and touches Mongo solely for
+# the final atomic card reservation.
+ROUTING_TRADER_FIELDS = {"_id": 1, "id": 1, "is_working": 1, "is_blocked": 1, "usdt_balance": 1}
+ROUTING_CARD_FIELDS = {
+    "_id": 1, "id": 1, "trader_id": 1, "status": 1, "currency": 1, "limit": 1, "current_usage": 1,
+    "bank_name": 1, "card_number": 1, "holder_name": 1, "card_name": 1
+}
+CHANGE_STREAM_UNSUPPORTED = 40573  # "$changeStream is only supported on replica sets"
+
+class EligibilityIndex:
+    def __init__(self):
+        self.traders = {}  # trader id -> routing fields
+        self.cards = {}  # card id -> routing fields
+        # currency -> card id -> routing fields, active cards only; a deposit
+        # only ever scans the partition of its own currency
+        self.active_by_currency: Dict[str, Dict[str, dict]] = {}
+        self.object_ids = {}  # Mongo _id -> entity id, for change stream deletes
+        self.loaded = asyncio.Event()
+
+    async def load(self):
+        traders = await db.traders.find({}, ROUTING_TRADER_FIELDS).to_list(None)
+        cards = await db.cards.find({}, ROUTING_CARD_FIELDS).to_list(None)
+        self.traders, self.cards, self.active_by_currency, self.object_ids = {}, {}, {}, {}
+        for trader in traders:
+            self.upsert_trader(trader)
+        for card in cards:
+            self.upsert_card(card)
+        self.loaded.set()
+
+    def upsert_trader(self, doc: dict):
+        trader = self.traders.setdefault(doc['id'], {})
+        trader.update({k: v for k, v in doc.items() if k in ROUTING_TRADER_FIELDS})
+        if '_id' in doc:
+            self.object_ids[doc['_id']] = doc['id']
+
+    def upsert_card(self, doc: dict):
+        card = self.cards.setdefault(doc['id'], {})
+        card.update({k: v for k, v in doc.items() if k in ROUTING_CARD_FIELDS})
+        if '_id' in doc:
+            self.object_ids[doc['_id']] = doc['id']
+        self.unpartition_card(card['id'])
+        if card.get('status') == 'active' and card.get('currency'):
+            self.active_by_currency.setdefault(card['currency'], {})[card['id']] = card
+
+    def unpartition_card(self, card_id: str):
+        for partition in self.active_by_currency.values():
+            partition.pop(card_id, None)
+
+    def remove_card(self, card_id: str):
+        self.cards.pop(card_id, None)
+        self.unpartition_card(card_id)
+
+    def apply_change(self, change: dict):
+        collection = change['ns']['coll']
+        if change['operationType'] == 'delete':
+            entity_id = self.object_ids.pop(change['documentKey']['_id'], None)
+            if collection == 'traders':
+                self.traders.pop(entity_id, None)
+            else:
+                self.remove_card(entity_id)
+        elif change.get('fullDocument'):
+            if collection == 'traders':
+                self.upsert_trader(change['fullDocument'])
+            else:
+                self.upsert_card(change['fullDocument'])
+
+    def has_cards(self, currency: str) -> bool:
+        return bool(self.active_by_currency.get(currency))
+
+    def candidates(self, currency: str, amount_to_pay: int, usdt_needed: int) -> List[dict]:
+        """Active cards in `currency` with enough headroom whose trader is working, unblocked and funded."""
+        result = []
+        for card in self.active_by_currency.get(currency, {}).values():
+            if card['limit'] - card.get('current_usage', 0) < amount_to_pay:
+                continue
+            trader = self.traders.get(card['trader_id'])
+            if not trader or not trader.get('is_working', False) or trader.get('is_blocked', False):
+                continue
+            if trader.get('usdt_balance', 0) < usdt_needed:
+                continue
+            result.append(card)
+        return result
+
+routing_index = EligibilityIndex()
+
+async def refresh_routing_card(card_id: str, trader_id: str):
+    card = await db.cards.find_one(targeted("cards", {"id": card_id, "trader_id": trader_id}), ROUTING_CARD_FIELDS)
+    if card:
+        routing_index.upsert_card(card)
+    else:
+        routing_index.remove_card(card_id)
+
+async def maintain_routing_index():
+    """Keep the routing index current: change stream when available, polling otherwise."""
+    while True:
+        try:
+            pipeline = [{"$match": {"ns.coll": {"$in": ["traders", "cards"]}}}]
+            async with db.watch(pipeline, full_document="updateLookup") as stream:
+                # Load after the stream is open so no change falls in between
+                await routing_index.load()
+                async for change in stream:
+                    routing_index.apply_change(change)
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                break
+            logger.exception("Routing index change stream failed, restarting")
+        except Exception:
+            logger.exception("Routing index change stream failed, restarting")
+        await asyncio.sleep(ROUTING_INDEX_POLL_SECONDS)
+    
+    logger.info("Change streams unavailable, polling routing index every %ss", ROUTING_INDEX_POLL_SECONDS)
+    await run_periodically("reload_routing_index", ROUTING_INDEX_POLL_SECONDS, routing_index.load)
+
+# ===== CARD HEALTH =====
+# Cards that can't take a deposit are moved to "auto_paused" so routing never
+# looks at them, and moved back to "active" once they can. A periodic sweep
+# covers everything; balance, limit and block changes re-check the affected
+# trader's cards straight away. Cards the trader paused are left alone.
+async def update_card_health(trader_id: Optional[str] = None) -> int:
+    """Auto-pause unroutable cards and reactivate recovered ones (all, or one trader's); returns cards changed."""
+    trader_query = {"$or": [{"usdt_balance": {"$lt": MIN_TRADER_BALANCE}}, {"is_blocked": True}]}
+    if trader_id:
+        trader_query["id"] = trader_id
+    ineligible = await db.traders.distinct("id", trader_query)
+    
+    headroom = {"$subtract": ["$limit", "$current_usage"]}
+    def pausable(reason: str) -> List[dict]:
+        # Active cards always qualify; auto-paused ones only if paused for another reason
+        return [{"status": "active"}, {"status": "auto_paused", "pause_reason": {"$ne": reason}}]
+    transitions = [
+        ("trader_ineligible", {"$or": pausable("trader_ineligible"),
+                               "$and": [{"trader_id": {"$in": ineligible}}]}),
+        ("no_capacity", {"$or": pausable("no_capacity"),
+                         "$and": [{"trader_id": {"$nin": ineligible}}],
+                         "$expr": {"$lt": [headroom, CARD_MIN_HEADROOM]}}),
+        (None, {"status": "auto_paused", "$and": [{"trader_id": {"$nin": ineligible}}],
+                "$expr": {"$gte": [headroom, CARD_MIN_HEADROOM]}}),
+    ]
+    
+    changed = []
+    changed_traders = set()
+    events = []
+    for reason, query in transitions:
+        if trader_id:
+            query = targeted("cards", {"trader_id": trader_id, **query})
+        cards = await db.cards.find(query, {"_id": 0, "id": 1, "trader_id": 1}).to_list(None)
+        if not cards:
+            continue
+        card_ids = [card['id'] for card in cards]
+        if reason:
+            update = {"$set": {"status": "auto_paused", "pause_reason": reason}}
+        else:
+            update = {"$set": {"status": "active"}, "$unset": {"pause_reason": ""}}
+        # Re-check the conditions: the card may have changed since it was read
+        await db.cards.update_many({**query, "id": {"$in": card_ids}}, update)
+        changed.extend(card_ids)
+        changed_traders.update(card['trader_id'] for card in cards)
+        events.extend(
+            event("card.auto_paused", card['id'], trader_id=card['trader_id'], reason=reason) if reason
+            else event("card.reactivated", card['id'], trader_id=card['trader_id'])
+            for card in cards
+        )
+    
+    if changed:
+        for card in await db.cards.find(
+            targeted("cards", {"trader_id": {"$in": list(changed_traders)}, "id": {"$in": changed}}), ROUTING_CARD_FIELDS
+        ).to_list(None):
+            routing_index.upsert_card(card)
+        await emit_events(events)
+        if not trader_id:
+            logger.info("Card health: %d cards auto-paused or reactivated", len(changed))
+    return len(changed)
+
+# ===== QUOTES =====
+# Deposit pricing depends only on settings, so settings are cached in-process
+# and quotes are computed without touching Mongo. Clients can preview a price
+# without reserving a card. Exchange rates are kept per currency (UAH from
+# usd_to_uah_rate, others from currency_rates) and cached alongside.
+DEFAULT_SETTINGS = {
+    "commission_rate": 9.0,
+    "usd_to_uah_rate": 41.5,
+    "currency_rates": {},
+    "deposit_wallet_address": "TB4K5h9QwFGSYR2LLJS9ejmt9EjHWurvi1"
+}
+settings_cache = {"settings": None, "rates": {}, "expires_at": 0.0}
+
+async def get_cached_settings() -> dict:
+    if settings_cache["settings"] is None or time.monotonic() >= settings_cache["expires_at"]:
+        settings = await SettingsRepo(db, MAX_QUERY_RESULTS).load()
+        settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        settings_cache["settings"] = settings
+        settings_cache["rates"] = {**settings['currency_rates'], "UAH": settings['usd_to_uah_rate']}
+        settings_cache["expires_at"] = time.monotonic() + SETTINGS_CACHE_SECONDS
+    return settings_cache["settings"]
+
+async def get_rates() -> Dict[str, float]:
+    """Currency -> USDT exchange rate (1 USDT = X units), cached with the settings."""
+    await get_cached_settings()
+    return settings_cache["rates"]
+
+async def get_rate(currency: str) -> float:
+    """USDT exchange rate for `currency`; 400 if no rate is configured."""
+    rate = (await get_rates()).get(currency)
+    if rate is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported currency: {currency}")
+    return rate
+
+def invalidate_settings_cache():
+    settings_cache["settings"] = None
+
+class Quote(NamedTuple):
+    amount: int  # Сумма БЕЗ комиссии
+    amount_to_pay: int  # Сумма К ОПЛАТЕ (с комиссией)
+    usdt_to_receive: int
+    commission_amount: int
+    commission_rate: float
+    exchange_rate: float
+
+def compute_quote(amount: int, commission_rate: float, exchange_rate: float) -> Quote:
+    """Price a deposit of `amount` minor units: the client pays amount + commission and receives amount / rate USDT."""
+    amount_to_pay = scale_minor(amount, 1 + Decimal(str(commission_rate)) / 100)
+    usdt_to_receive = scale_minor(amount, 1 / Decimal(str(exchange_rate)))
+    return Quote(amount, amount_to_pay, usdt_to_receive, amount_to_pay - amount, commission_rate, exchange_rate)
+
+def present_quote(quote: Quote, currency: str) -> dict:
+    return {
+        "amount": from_minor(quote.amount),
+        "amount_to_pay": from_minor(quote.amount_to_pay),
+        "usdt_to_receive": from_minor(quote.usdt_to_receive),
+        "commission_amount": from_minor(quote.commission_amount),
+        "commission_rate": quote.commission_rate,
+        "exchange_rate": quote.exchange_rate,
+        "currency": currency
+    }
+
+# ===== EVENTS =====
+# Append-only log of state transitions with monotonically increasing sequence
+# numbers, so consumers can process changes incrementally from a cursor
+# instead of re-querying whole collections. Sequence numbers are allocated
+# outside any session (no hot document inside transactions) and the event is
+# inserted with the caller's session, atomically with the change it records.
+EVENTS_SEQUENCE_ID = "events_seq"
+
+def event(event_type: str, entity_id: str, **data) -> dict:
+    return {"type": event_type, "entity_id": entity_id, "data": data}
+
+async def emit_events(events: List[dict], session=None):
+    if not events:
+        return
+    counter = await db.counters.find_one_and_update(
+        {"_id": EVENTS_SEQUENCE_ID},
+        {"$inc": {"seq": len(events)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    first_seq = counter['seq'] - len(events) + 1
+    now = datetime.now(timezone.utc)
+    await db.events.insert_many(
+        [{"seq": first_seq + i, "created_at": now, **e} for i, e in enumerate(events)],
+        session=session
+    )
+
+async def emit_event(event_type: str, entity_id: str, session=None, **data):
+    await emit_events([event(event_type, entity_id, **data)], session=session)
+
+# ===== JOB QUEUE =====
+# Slow admin work is persisted to `jobs` and executed by an in-process worker,
+# so the request returns as soon as the job is queued. Jobs are claimed with a
+# lease; a crashed worker's jobs become claimable again once the lease expires,
+# so handlers must be safe to run more than once.
+job_handlers = {}
+job_semaphore = asyncio.Semaphore(JOB_CONCURRENCY)
+jobs_wakeup = asyncio.Event()
+
+def job_handler(job_type: str):
+    def register(func):
+        job_handlers[job_type] = func
+        return func
+    return register
+
+async def enqueue_job(job_type: str, payload: dict, created_by: Optional[str] = None) -> str:
+    now = datetime.now(timezone.utc)
+    job_id = str(uuid.uuid4())
+    await db.jobs.insert_one({
+        "id": job_id,
+        "type": job_type,
+        "payload": payload,
+        "status": "queued",
+        "attempts": 0,
+        "run_at": now,
+        "created_by": created_by,
+        "created_at": now
+    })
+    jobs_wakeup.set()
+    return job_id
+
+async def claim_jobs(limit: int) -> List[dict]:
+    jobs = []
+    while len(jobs) < limit:
+        now = datetime.now(timezone.utc)
+        job = await db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lte": now}}
+            ]},
+            {
+                "$set": {"status": "running", "locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not job:
+            break
+        jobs.append(job)
+    return jobs
+
+async def run_job(job: dict):
+    async with job_semaphore:
+        handler = job_handlers.get(job['type'])
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler for job type {job['type']}")
+            result = await handler(job['payload'], job)
+        except Exception as exc:
+            logger.exception("Job %s (%s) failed, attempt %d", job['id'], job['type'], job['attempts'])
+            if job['attempts'] >= JOB_MAX_ATTEMPTS:
+                update = {"status": "failed", "finished_at": datetime.now(timezone.utc)}
+            else:
+                backoff = min(2 ** job['attempts'], 300)
+                update = {"status": "queued", "run_at": datetime.now(timezone.utc) + timedelta(seconds=backoff)}
+            await db.jobs.update_one(
+                {"id": job['id'], "status": "running"},
+                {"$set": {**update, "last_error": str(exc)}, "$unset": {"locked_until": ""}}
+            )
+            return
+        await db.jobs.update_one(
+            {"id": job['id'], "status": "running"},
+            {"$set": {"status": "done", "result": result, "finished_at": datetime.now(timezone.utc)},
+             "$unset": {"locked_until": ""}}
+        )
+
+async def run_job_worker():
+    while True:
+        try:
+            jobs = await claim_jobs(JOB_BATCH_SIZE)
+        except Exception:
+            logger.exception("Claiming jobs failed")
+            jobs = []
+        if jobs:
+            await asyncio.gather(*(run_job(job) for job in jobs))
+            continue
+        jobs_wakeup.clear()
+        try:
+            await asyncio.wait_for(jobs_wakeup.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# ===== SETTLEMENT =====
+# Confirming a payment debits the trader and completes the transaction. The
+# transaction is first moved to "settling" (write-ahead). When the deployment
+# supports multi-document transactions (replica set / sharded cluster) the
+# debit and completion commit together. Otherwise the debit also records the
+# transaction id in the trader's pending_settlements, which tells the recovery
+# worker whether a half-finished settlement must be rolled forward or back.
+mongo_capabilities = {"transactions": False}
+
+async def detect_mongo_capabilities():
+    hello = await client.admin.command("hello")
+    mongo_capabilities["transactions"] = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+class SettlementConflict(Exception):
+    """A settling transaction changed status while its debit was being applied."""
+
+class Settlement(NamedTuple):
+    trader: dict  # after the debit
+    completed_ids: List[str]  # the rest were debited but are left to recovery
+
+def settlement_completion(txn: dict, now: datetime) -> dict:
+    return {"$set": {"status": "completed", "completed_at": now, "usdt_amount": txn['usdt_requested']}}
+
+async def apply_settlement(trader_id: str, settlements: List[Tuple[dict, int]], session=None) -> Optional[Settlement]:
+    """Debit the trader once for all (settling transaction, USDT to deduct) pairs and complete them.
+    
+    Returns the updated trader and the ids completed, or None if the balance
+    doesn't cover the total. If a transaction left "settling" in the meantime
+    (e.g. recovery rolled it back), a session is aborted with SettlementConflict;
+    without one the debit stands and its marker is kept, so recovery rolls that
+    transaction forward (and counts it).
+    """
+    txn_ids = [txn['id'] for txn, _ in settlements]
+    total = sum(deduct for _, deduct in settlements)
+    query = {"id": trader_id, "usdt_balance": {"$gte": total}}
+    update = {"$inc": {"usdt_balance": -total}}
+    if session is None:
+        # A transaction that still has a marker was already debited
+        query["pending_settlements"] = {"$nin": txn_ids}
+        update["$addToSet"] = {"pending_settlements": {"$each": txn_ids}}
+    # The guard makes the balance check and the debit a single operation
+    trader = await db.traders.find_one_and_update(
+        query,
+        update,
+        projection={"_id": 0, "pending_settlements": 0},
+        session=session
+    )
+    if not trader:
+        return None
+    trader['usdt_balance'] -= total
+    now = datetime.now(timezone.utc)
+    result = await db.transactions.bulk_write([
+        UpdateOne(
+            targeted("transactions", {"id": txn['id'], "trader_id": trader_id, "status": "settling"}),
+            settlement_completion(txn, now)
+        )
+        for txn, _ in settlements
+    ], ordered=False, session=session)
+    
+    completed_ids = txn_ids
+    if result.matched_count < len(settlements):
+        if session is not None:
+            raise SettlementConflict(f"{len(settlements) - result.matched_count} transactions left settling")
+        completed_ids = await db.transactions.distinct("id", targeted("transactions", {
+            "id": {"$in": txn_ids}, "trader_id": trader_id, "status": "completed", "completed_at": now
+        }))
+        logger.warning("Settlement for trader %s completed %d of %d transactions; recovery will finish the rest",
+                       trader_id, len(completed_ids), len(settlements))
+    await emit_events([
+        event("transaction.completed", txn['id'], trader_id=trader_id,
+              usdt_amount=txn['usdt_requested'], usdt_debited=deduct)
+        for txn, deduct in settlements if txn['id'] in completed_ids
+    ], session=session)
+    if session is None and completed_ids:
+        await db.traders.update_one({"id": trader_id}, {"$pull": {"pending_settlements": {"$in": completed_ids}}})
+    return Settlement(trader, completed_ids)
+
+async def run_settlement(trader_id: str, settlements: List[Tuple[dict, int]]) -> Optional[Settlement]:
+    if not mongo_capabilities["transactions"]:
+        return await apply_settlement(trader_id, settlements)
+    
+    async def settle(session):
+        return await apply_settlement(trader_id, settlements, session=session)
+    
+    # A SettlementConflict aborts the transaction and propagates to the caller
+    
+    async with await client.start_session() as session:
+        return await session.with_transaction(settle)
+
+async def recover_settlements():
+    """Finish or roll back settlements left in "settling" by a crashed worker, in bulk.
+    
+    Debited transactions that were rolled back before their debit landed are
+    completed as well.
+    """
+    now = datetime.now(timezone.utc)
+    projection = {"_id": 0, "id": 1, "trader_id": 1, "usdt_requested": 1, "status": 1}
+    stuck = await db.transactions.find(
+        {"status": "settling", "settling_at": {"$lt": now - timedelta(seconds=SETTLEMENT_RECOVERY_GRACE_SECONDS)}},
+        projection
+    ).to_list(None)
+    traders = await db.traders.find(
+        {"pending_settlements.0": {"$exists": True}},
+        {"_id": 0, "pending_settlements": 1}
+    ).to_list(None)
+    debited = {txn_id for trader in traders for txn_id in trader['pending_settlements']}
+    if debited:
+        stuck += await db.transactions.find(
+            {"id": {"$in": list(debited)}, "status": "user_confirmed"}, projection
+        ).to_list(None)
+    
+    # Debited -> complete the transaction; not debited -> back to user_confirmed
+    operations = []
+    events = []
+    rolled_forward = 0
+    for txn in stuck:
+        if txn['id'] in debited:
+            operations.append(UpdateOne(
+                {"id": txn['id'], "trader_id": txn['trader_id'], "status": txn['status']},
+                settlement_completion(txn, now)
+            ))
+            events.append(event("transaction.completed", txn['id'], trader_id=txn['trader_id'],
+                                usdt_amount=txn['usdt_requested'], recovered=True))
+            rolled_forward += 1
+        else:
+            operations.append(UpdateOne(
+                {"id": txn['id'], "trader_id": txn['trader_id'], "status": "settling"},
+                {"$set": {"status": "user_confirmed"}, "$unset": {"settling_at": "", "settling_batch": ""}}
+            ))
+            events.append(event("transaction.settlement_failed", txn['id'], trader_id=txn['trader_id'], recovered=True))
+    if operations:
+        await db.transactions.bulk_write(operations, ordered=False)
+        await emit_events(events)
+        logger.warning("Recovered %d settlements (%d completed, %d rolled back)",
+                       len(operations), rolled_forward, len(operations) - rolled_forward)
+    if rolled_forward:
+        await bump_admin_stats(completed_transactions=rolled_forward)
+    
+    # Clear markers of every debited transaction that is now completed
+    if debited:
+        completed = await db.transactions.distinct("id", {"id": {"$in": list(debited)}, "status": "completed"})
+        if completed:
+            await db.traders.update_many(
+                {"pending_settlements": {"$in": completed}},
+                {"$pull": {"pending_settlements": {"$in": completed}}}
+            )
+
 # ===== AUTH HELPERS =====
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -148,11 +1129,29 @@ def verify_password(password: str, password_hash: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
 
 def create_token(user_id: str, email: str, role: str) -> str:
+    now = datetime.now(timezone.utc)
+    if AUTH_MODE == 'stateless':
+        lifetime = timedelta(minutes=ACCESS_TOKEN_MINUTES)
+    else:
+        lifetime = timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
         'user_id': user_id,
         'email': email,
         'role': role,
-        'exp': datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
+        'type': 'access',
+        'iat': now,
+        'exp': now + lifetime
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def create_refresh_token(user_id: str) -> str:
+    now = datetime.now(timezone.utc)
+    payload = {
+        'user_id': user_id,
+        'type': 'refresh',
+        'jti': str(uuid.uuid4()),
+        'iat': now,
+        'exp': now + timedelta(days=REFRESH_TOKEN_DAYS)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
@@ -164,28 +1163,97 @@ def decode_token(token: str) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    token = credentials.credentials
-    payload = decode_token(token)
-    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
+# Users blocked by an admin; fed by admin_block_user and refreshed from the
+# database periodically so every worker converges
+blocked_user_ids: set = set()
+
+async def refresh_blocked_users():
+    blocked = await db.users.find({"is_blocked": True}, {"_id": 0, "id": 1}).to_list(None)
+    blocked_user_ids.clear()
+    blocked_user_ids.update(u['id'] for u in blocked)
+
+def check_login_allowed(user: dict):
+    # Check if user is blocked
+    if user.get('is_blocked', False):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Account is blocked")
+    
+    # Check if user is approved (admins bypass this check)
+    if user['role'] != 'admin' and not user.get('is_approved', False):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Account pending admin approval")
+
+def decode_access_token(credentials: HTTPAuthorizationCredentials) -> dict:
+    payload = decode_token(credentials.credentials)
+    if payload.get('type', 'access') != 'access':
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return payload
+
+def user_from_claims(payload: dict) -> dict:
+    # CPU-only path: claims are signed and short-lived
+    if payload['user_id'] in blocked_user_ids:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Account is blocked")
+    return {"id": payload['user_id'], "email": payload['email'], "role": payload['role']}
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    repos: Repositories = Depends(get_repos)
+) -> dict:
+    payload = decode_access_token(credentials)
+    if AUTH_MODE == 'stateless':
+        return user_from_claims(payload)
+    
+    user = await repos.users.get(payload['user_id'])
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     return user
 
-async def require_trader(user: dict = Depends(get_current_user)) -> dict:
+def check_trader_role(user: dict):
     if user['role'] not in ['trader', 'admin']:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Trader access required")
-    return user
 
 async def require_admin(user: dict = Depends(get_current_user)) -> dict:
     if user['role'] != 'admin':
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
     return user
 
+class TraderContext(NamedTuple):
+    user: dict
+    trader: Optional[dict]
+
+async def get_trader_context(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    repos: Repositories = Depends(get_repos)
+) -> TraderContext:
+    """Resolve the caller and their trader profile with a single query."""
+    payload = decode_access_token(credentials)
+    if AUTH_MODE == 'stateless':
+        user = user_from_claims(payload)
+        trader = await repos.traders.get_by_user(user['id'])
+    else:
+        docs = await db.users.aggregate([
+            {"$match": {"id": payload['user_id']}},
+            {"$limit": 1},
+            {"$lookup": {"from": "traders", "localField": "id", "foreignField": "user_id", "as": "traders"}},
+            {"$project": {"_id": 0, "traders._id": 0, "traders.pending_settlements": 0, "traders.applied_jobs": 0}}
+        ]).to_list(1)
+        if not docs:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        user = docs[0]
+        traders = user.pop('traders')
+        trader = repos.traders.remember(traders[0]) if traders else None
+        repos.users.remember(user)
+    
+    check_trader_role(user)
+    return TraderContext(user, trader)
+
+async def require_trader_context(ctx: TraderContext = Depends(get_trader_context)) -> TraderContext:
+    if not ctx.trader:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
+    return ctx
+
 # ===== AUTH ROUTES =====
-@api_router.post("/auth/register")
-async def register(data: UserRegister):
-    existing = await db.users.find_one({"email": data.email}, {"_id": 0})
+@api_router.post("/auth/register", dependencies=[rate_limit("auth")])
+async def register(data: UserRegister, repos: Repositories = Depends(get_repos)):
+    existing = await repos.users.get_by_email(data.email)
     if existing:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
     
@@ -194,7 +1262,9 @@ async def register(data: UserRegister):
         password_hash=hash_password(data.password),
         is_approved=False  # Requires admin approval
     )
-    await db.users.insert_one(user.model_dump())
+    await repos.users.insert(user.model_dump())
+    await bump_admin_stats(total_users=1)
+    await emit_event("user.registered", user.id)
     
     # Don't return token - user needs approval first
     return {
@@ -202,43 +1272,63 @@ async def register(data: UserRegister):
         "user": {"id": user.id, "email": user.email, "status": "pending_approval"}
     }
 
-@api_router.post("/auth/login")
-async def login(data: UserLogin):
-    user = await db.users.find_one({"email": data.email}, {"_id": 0})
+@api_router.post("/auth/login", dependencies=[rate_limit("auth")])
+async def login(data: UserLogin, repos: Repositories = Depends(get_repos)):
+    user = await repos.users.get_by_email(data.email)
     if not user or not verify_password(data.password, user['password_hash']):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     
-    # Check if user is blocked
-    if user.get('is_blocked', False):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Account is blocked")
-    
-    # Check if user is approved (admins bypass this check)
-    if user['role'] != 'admin' and not user.get('is_approved', False):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Account pending admin approval")
+    check_login_allowed(user)
     
     token = create_token(user['id'], user['email'], user['role'])
-    return {"token": token, "user": {"id": user['id'], "email": user['email'], "role": user['role']}}
+    return {
+        "token": token,
+        "refresh_token": create_refresh_token(user['id']),
+        "user": {"id": user['id'], "email": user['email'], "role": user['role']}
+    }
 
-@api_router.get("/auth/me")
-async def get_me(user: dict = Depends(get_current_user)):
+@api_router.post("/auth/refresh", dependencies=[rate_limit("auth")])
+async def refresh_token(data: RefreshRequest, repos: Repositories = Depends(get_repos)):
+    payload = decode_token(data.refresh_token)
+    if payload.get('type') != 'refresh':
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    
+    # Refresh re-reads the user so role changes and blocks take effect
+    user = await repos.users.get(payload['user_id'])
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    check_login_allowed(user)
+    
+    return {
+        "token": create_token(user['id'], user['email'], user['role']),
+        "refresh_token": create_refresh_token(user['id']),
+        "user": {"id": user['id'], "email": user['email'], "role": user['role']}
+    }
+
+@api_router.get("/auth/me", dependencies=[rate_limit("poll")])
+async def get_me(user: dict = Depends(get_current_user), repos: Repositories = Depends(get_repos)):
     trader = None
     if user['role'] in ['trader', 'admin']:
-        trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
+        trader = await repos.traders.get_by_user(user['id'])
     
     return {
         "id": user['id'],
         "email": user['email'],
         "role": user['role'],
-        "trader": trader
+        "trader": present_trader(trader)
     }
 
 # ===== TRADER ROUTES =====
 @api_router.post("/trader/register")
-async def become_trader(data: TraderRegister, user: dict = Depends(get_current_user)):
+async def become_trader(
+    data: TraderRegister,
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repos)
+):
     if user['role'] == 'trader':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Already a trader")
     
-    existing = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
+    existing = await repos.traders.get_by_user(user['id'])
     if existing:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Trader profile already exists")
     
@@ -249,105 +1339,134 @@ async def become_trader(data: TraderRegister, user: dict = Depends(get_current_u
         usdt_address=data.usdt_address,
         phone=data.phone
     )
-    await db.traders.insert_one(trader.model_dump())
+    await repos.traders.insert(trader.model_dump())
+    routing_index.upsert_trader(trader.model_dump())
     
     # Update user role
-    await db.users.update_one({"id": user['id']}, {"$set": {"role": "trader"}})
+    await repos.users.update(user['id'], {"role": "trader"})
+    await bump_admin_stats(total_traders=1, total_users=-1 if user['role'] == 'user' else 0)
+    await emit_event("trader.created", trader.id, user_id=user['id'])
     
-    return trader
+    return present_trader(trader.model_dump())
 
-@api_router.get("/trader/profile")
-async def get_trader_profile(user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
-    return trader
+@api_router.get("/trader/profile", dependencies=[rate_limit("poll")])
+async def get_trader_profile(ctx: TraderContext = Depends(require_trader_context)):
+    trader = ctx.trader
+    return present_trader(trader)
 
-@api_router.post("/trader/cards")
-async def add_card(data: CardCreate, user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
+@api_router.post("/trader/cards", dependencies=[rate_limit("write")])
+async def add_card(
+    data: CardCreate,
+    ctx: TraderContext = Depends(require_trader_context),
+    repos: Repositories = Depends(get_repos)
+):
+    trader = ctx.trader
     
     card = Card(
         trader_id=trader['id'],
         card_number=data.card_number,
         bank_name=data.bank_name,
         holder_name=data.holder_name,
-        limit=data.limit,
+        limit=to_minor(data.limit),
         currency=data.currency,
         card_name=data.card_name
     )
-    await db.cards.insert_one(card.model_dump())
-    return card
-
-@api_router.get("/trader/cards")
-async def get_trader_cards(user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
+    await repos.cards.insert(card.model_dump())
+    routing_index.upsert_card(card.model_dump())
+    await emit_event("card.created", card.id, trader_id=trader['id'], limit=card.limit)
+    return present_card(card.model_dump())
+
+@api_router.get("/trader/cards", dependencies=[rate_limit("poll")])
+async def get_trader_cards(ctx: TraderContext = Depends(get_trader_context), repos: Repositories = Depends(get_repos)):
+    trader = ctx.trader
     if not trader:
         return []
     
-    cards = await db.cards.find({"trader_id": trader['id']}, {"_id": 0}).to_list(1000)
-    return cards
+    cards = await repos.cards.list({"trader_id": trader['id']}, "trader_cards")
+    return [present_card(card) for card in cards]
 
-@api_router.put("/trader/cards/{card_id}")
-async def update_card(card_id: str, data: CardUpdate, user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
+@api_router.put("/trader/cards/{card_id}", dependencies=[rate_limit("write")])
+async def update_card(
+    card_id: str,
+    data: CardUpdate,
+    ctx: TraderContext = Depends(require_trader_context),
+    repos: Repositories = Depends(get_repos)
+):
+    trader = ctx.trader
     
-    card = await db.cards.find_one({"id": card_id, "trader_id": trader['id']}, {"_id": 0})
+    card = await repos.cards.get(card_id, trader_id=trader['id'])
     if not card:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Card not found")
     
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
-    await db.cards.update_one({"id": card_id}, {"$set": update_data})
-    
-    updated_card = await db.cards.find_one({"id": card_id}, {"_id": 0})
-    return updated_card
-
-@api_router.delete("/trader/cards/{card_id}")
-async def delete_card(card_id: str, user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
-    
-    result = await db.cards.delete_one({"id": card_id, "trader_id": trader['id']})
-    if result.deleted_count == 0:
+    if 'limit' in update_data:
+        update_data['limit'] = to_minor(update_data['limit'])
+    # A manual status change ends any auto-pause, so the health check may pause it afresh
+    unset = ["pause_reason"] if 'status' in update_data else []
+    updated_card = await repos.cards.update(card_id, update_data, unset=unset, trader_id=trader['id'])
+    routing_index.upsert_card(updated_card)
+    await emit_event("card.updated", card_id, trader_id=trader['id'], **update_data)
+    # A raised limit or a manual reactivation may change whether the card is routable
+    if await update_card_health(trader['id']):
+        repos.cards.forget(card_id)
+        updated_card = await repos.cards.get(card_id, trader_id=trader['id'])
+    return present_card(updated_card)
+
+@api_router.delete("/trader/cards/{card_id}", dependencies=[rate_limit("write")])
+async def delete_card(
+    card_id: str,
+    ctx: TraderContext = Depends(require_trader_context),
+    repos: Repositories = Depends(get_repos)
+):
+    trader = ctx.trader
+    
+    if not await repos.cards.delete(card_id, trader_id=trader['id']):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Card not found")
+    routing_index.remove_card(card_id)
+    await emit_event("card.deleted", card_id, trader_id=trader['id'])
     
     return {"message": "Card deleted successfully"}
 
-@api_router.get("/trader/transactions")
-async def get_trader_transactions(user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
+@api_router.get("/trader/transactions", dependencies=[rate_limit("poll")])
+async def get_trader_transactions(
+    include_archive: bool = False,
+    ctx: TraderContext = Depends(require_trader_context),
+    repos: Repositories = Depends(get_repos)
+):
+    trader = ctx.trader
     
     # Check for expired transactions and disable trader if needed
     now = datetime.now(timezone.utc)
-    expired_txns = await db.transactions.find({
+    # Bounded like other lists; anything past the cap expires on the next call
+    expired_txns = await repos.transactions.list({
         "trader_id": trader['id'],
         "status": "user_confirmed",
-        "expires_at": {"$lt": now.isoformat()}
-    }, {"_id": 0}).to_list(100)
+        "expires_at": {"$lt": now}
+    }, "trader_expired_transactions", projection={"_id": 0, "id": 1})
     
     if expired_txns:
         # Disable trader due to expired transactions
-        await db.traders.update_one({"id": trader['id']}, {"$set": {"is_working": False}})
+        await repos.traders.update(trader['id'], {"is_working": False})
+        routing_index.upsert_trader({"id": trader['id'], "is_working": False})
         
         # Mark transactions as expired
-        for txn in expired_txns:
-            await db.transactions.update_one(
-                {"id": txn['id']},
-                {"$set": {"status": "expired"}}
-            )
+        expired_ids = [txn['id'] for txn in expired_txns]
+        await db.transactions.update_many(
+            targeted("transactions", {"id": {"$in": expired_ids}, "trader_id": trader['id'], "status": "user_confirmed"}),
+            {"$set": {"status": "expired"}}
+        )
+        await emit_events(
+            [event("transaction.expired", txn_id, trader_id=trader['id']) for txn_id in expired_ids]
+            + [event("trader.work_disabled", trader['id'], reason="expired_transactions")]
+        )
     
-    transactions = await db.transactions.find({"trader_id": trader['id']}, {"_id": 0}).to_list(1000)
+    transactions = await repos.transactions.history({"trader_id": trader['id']}, "trader_transactions", include_archive)
+    transactions = [present_transaction(txn) for txn in transactions]
     
-    # Enrich with card info
+    # Enrich with card info, fetched in one batch
+    cards = await repos.cards.get_many({txn['card_id'] for txn in transactions}, trader_id=trader['id'])
     for txn in transactions:
-        card = await db.cards.find_one({"id": txn['card_id']}, {"_id": 0})
+        card = cards.get(txn['card_id'])
         if card:
             txn['card'] = {
                 "card_number": card['card_number'],
@@ -357,156 +1476,305 @@ async def get_trader_transactions(user: dict = Depends(require_trader)):
     
     return transactions
 
-@api_router.get("/trader/info")
-async def get_trader_info(user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
+@api_router.get("/trader/info", dependencies=[rate_limit("poll")])
+async def get_trader_info(ctx: TraderContext = Depends(require_trader_context)):
+    user, trader = ctx
     
     return {
         "id": trader['id'],
         "email": trader.get('email', user['email']),
-        "usdt_balance": trader.get('usdt_balance', 0.0),
+        "usdt_balance": from_minor(trader.get('usdt_balance', 0)),
         "is_working": trader.get('is_working', False),
         "is_blocked": trader.get('is_blocked', False)
     }
 
-@api_router.post("/trader/toggle-work")
-async def toggle_trader_work(user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
+@api_router.post("/trader/toggle-work", dependencies=[rate_limit("write")])
+async def toggle_trader_work(
+    ctx: TraderContext = Depends(require_trader_context),
+    repos: Repositories = Depends(get_repos)
+):
+    trader = ctx.trader
     
     # Check balance before enabling
     if not trader.get('is_working', False):  # Trying to enable
-        if trader['usdt_balance'] < 50:
+        if trader['usdt_balance'] < MIN_TRADER_BALANCE:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, 
-                detail=f"Cannot enable work mode. Minimum balance required: 50 USDT. Current balance: {trader['usdt_balance']:.2f} USDT"
+                detail=f"Cannot enable work mode. Minimum balance required: 50 USDT. Current balance: {from_minor(trader['usdt_balance']):.2f} USDT"
             )
     
     # Toggle status
     new_status = not trader.get('is_working', False)
-    await db.traders.update_one({"id": trader['id']}, {"$set": {"is_working": new_status}})
+    await repos.traders.update(trader['id'], {"is_working": new_status})
+    routing_index.upsert_trader({"id": trader['id'], "is_working": new_status})
+    await emit_event("trader.work_enabled" if new_status else "trader.work_disabled", trader['id'], reason="toggle")
     
     return {
         "is_working": new_status,
         "message": "Work mode enabled" if new_status else "Work mode disabled"
     }
 
-@api_router.post("/trader/confirm-payment/{transaction_id}")
-async def trader_confirm_payment(transaction_id: str, user: dict = Depends(require_trader)):
-    trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
-    if not trader:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader profile not found")
-    
-    txn = await db.transactions.find_one({"id": transaction_id, "trader_id": trader['id']}, {"_id": 0})
+@api_router.post("/trader/confirm-payment/{transaction_id}", dependencies=[rate_limit("write")])
+async def trader_confirm_payment(
+    transaction_id: str,
+    ctx: TraderContext = Depends(require_trader_context),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(idempotency_key, "trader-confirm-payment", ctx.user['id'],
+                                {"transaction_id": transaction_id}, lambda: settle_payment(transaction_id, ctx.trader))
+
+async def settle_payment(transaction_id: str, trader: dict):
+    txn = await db.transactions.find_one(targeted("transactions", {"id": transaction_id, "trader_id": trader['id']}), {"_id": 0})
     if not txn:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
     
     if txn['status'] != 'user_confirmed':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User must confirm payment first")
     
-    # Get USDT requested amount
-    usdt_requested = txn.get('usdt_requested', 0.0)
+    # Get USDT requested amount (cents)
+    usdt_requested = txn.get('usdt_requested', 0)
     if usdt_requested <= 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid transaction data")
     
     # Calculate USDT to deduct from trader (4% more than requested)
-    usdt_to_deduct = usdt_requested * 1.04
+    usdt_to_deduct = scale_minor(usdt_requested, TRADER_MARKUP)
+    
+    # Write-ahead: claim the transaction so concurrent confirmations can't double-debit
+    claimed = await db.transactions.update_one(
+        targeted("transactions", {"id": transaction_id, "trader_id": trader['id'], "status": "user_confirmed"}),
+        {"$set": {"status": "settling", "settling_at": datetime.now(timezone.utc)}}
+    )
+    if not claimed.modified_count:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Transaction is already being processed")
     
-    # Check trader balance
-    if trader['usdt_balance'] < usdt_to_deduct:
+    # Debit trader balance (списываем +4% у трейдера) and complete the transaction
+    try:
+        settlement = await run_settlement(trader['id'], [(txn, usdt_to_deduct)])
+    except SettlementConflict:
+        await db.transactions.update_one(
+            targeted("transactions", {"id": transaction_id, "trader_id": trader['id'], "status": "settling"}),
+            {"$set": {"status": "user_confirmed"}, "$unset": {"settling_at": ""}}
+        )
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Transaction is already being processed")
+    if not settlement:
+        await db.transactions.update_one(
+            targeted("transactions", {"id": transaction_id, "trader_id": trader['id'], "status": "settling"}),
+            {"$set": {"status": "user_confirmed"}, "$unset": {"settling_at": ""}}
+        )
+        await emit_event("transaction.settlement_failed", transaction_id, trader_id=trader['id'], reason="insufficient_balance")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Insufficient USDT balance")
+    routing_index.upsert_trader(settlement.trader)
+    low_balance = await disable_if_low_balance(settlement.trader)
+    completed = transaction_id in settlement.completed_ids
+    if completed:
+        await bump_admin_stats(completed_transactions=1)
     
-    # Update trader balance (списываем +4% у трейдера)
-    new_balance = trader['usdt_balance'] - usdt_to_deduct
+    # Get the transaction currency's rate for display
+    currency = txn.get('currency', 'UAH')
     
-    # Auto-disable trader if balance falls below 50 USDT
-    update_data = {"usdt_balance": new_balance}
-    if new_balance < 50:
-        update_data["is_working"] = False
+    response = {
+        # Debited but not completed: the recovery worker finishes it
+        "message": "Payment confirmed and USDT sent" if completed else "Payment confirmed, completion pending",
+        "status": "completed" if completed else "pending",
+        "usdt_sent_to_user": from_minor(usdt_requested),
+        "usdt_deducted_from_trader": from_minor(usdt_to_deduct),
+        "uah_received": from_minor(txn['amount']),
+        "currency": currency,
+        "rate": (await get_rates()).get(currency)
+    }
     
-    await db.traders.update_one({"id": trader['id']}, {"$set": update_data})
+    if low_balance:
+        response["warning"] = LOW_BALANCE_WARNING
     
-    # Update transaction
-    await db.transactions.update_one(
-        {"id": transaction_id},
-        {"$set": {
-            "status": "completed",
-            "completed_at": datetime.now(timezone.utc).isoformat(),
-            "usdt_amount": usdt_requested
-        }}
+    return response
+
+async def disable_if_low_balance(trader: dict) -> bool:
+    """Auto-disable a trader whose balance fell below 50 USDT; True if it did."""
+    if trader['usdt_balance'] >= MIN_TRADER_BALANCE:
+        return False
+    await db.traders.update_one(
+        {"id": trader['id'], "usdt_balance": {"$lt": MIN_TRADER_BALANCE}},
+        {"$set": {"is_working": False}}
     )
-    
-    # Get settings for display
-    settings = await db.settings.find_one({}, {"_id": 0})
-    usd_to_uah_rate = settings['usd_to_uah_rate'] if settings else 41.5
+    routing_index.upsert_trader({"id": trader['id'], "is_working": False})
+    await emit_event("trader.work_disabled", trader['id'], reason="low_balance")
+    await update_card_health(trader['id'])
+    return True
+
+@api_router.post("/trader/confirm-payments", dependencies=[rate_limit("write")])
+async def trader_confirm_payments(
+    data: BatchConfirmRequest,
+    ctx: TraderContext = Depends(require_trader_context),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Confirm several payments with one debit; each id gets its own result."""
+    return await run_idempotent(idempotency_key, "trader-confirm-payments", ctx.user['id'], data,
+                                lambda: settle_payments(data.transaction_ids, ctx.trader))
+
+async def settle_payments(transaction_ids: List[str], trader: dict):
+    transaction_ids = list(dict.fromkeys(transaction_ids))
+    if not transaction_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No transactions given")
+    if len(transaction_ids) > CONFIRM_BATCH_MAX:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {CONFIRM_BATCH_MAX} transactions per request")
+    
+    txns = await db.transactions.find(
+        targeted("transactions", {"id": {"$in": transaction_ids}, "trader_id": trader['id']}), {"_id": 0}
+    ).to_list(None)
+    txns = {txn['id']: txn for txn in txns}
+    
+    # Pick what the balance known at request time covers; the guarded debit re-checks it
+    failures = {}
+    settlements = []
+    available = trader['usdt_balance']
+    for txn_id in transaction_ids:
+        txn = txns.get(txn_id)
+        if not txn:
+            failures[txn_id] = "Transaction not found"
+        elif txn['status'] != 'user_confirmed':
+            failures[txn_id] = "User must confirm payment first"
+        elif txn.get('usdt_requested', 0) <= 0:
+            failures[txn_id] = "Invalid transaction data"
+        elif scale_minor(txn['usdt_requested'], TRADER_MARKUP) > available:
+            failures[txn_id] = "Insufficient USDT balance"
+        else:
+            usdt_to_deduct = scale_minor(txn['usdt_requested'], TRADER_MARKUP)
+            available -= usdt_to_deduct
+            settlements.append((txn, usdt_to_deduct))
+    
+    # Write-ahead: claim all of them at once, tagged so we know which ones we got
+    batch_id = str(uuid.uuid4())
+    if settlements:
+        claimed = await db.transactions.update_many(
+            targeted("transactions", {"id": {"$in": [txn['id'] for txn, _ in settlements]},
+                                      "trader_id": trader['id'], "status": "user_confirmed"}),
+            {"$set": {"status": "settling", "settling_at": datetime.now(timezone.utc), "settling_batch": batch_id}}
+        )
+        if claimed.modified_count < len(settlements):
+            claimed_ids = set(await db.transactions.distinct("id", targeted(
+                "transactions", {"trader_id": trader['id'], "status": "settling", "settling_batch": batch_id}
+            )))
+            for txn, _ in settlements:
+                if txn['id'] not in claimed_ids:
+                    failures[txn['id']] = "Transaction is already being processed"
+            settlements = [(txn, deduct) for txn, deduct in settlements if txn['id'] in claimed_ids]
+    
+    low_balance = False
+    completed_ids = set()
+    if settlements:
+        try:
+            settlement = await run_settlement(trader['id'], settlements)
+            conflict = False
+        except SettlementConflict:
+            settlement, conflict = None, True
+        if settlement:
+            routing_index.upsert_trader(settlement.trader)
+            low_balance = await disable_if_low_balance(settlement.trader)
+            completed_ids = set(settlement.completed_ids)
+            if completed_ids:
+                await bump_admin_stats(completed_transactions=len(completed_ids))
+        else:
+            await db.transactions.update_many(
+                targeted("transactions", {"trader_id": trader['id'], "status": "settling", "settling_batch": batch_id}),
+                {"$set": {"status": "user_confirmed"}, "$unset": {"settling_at": "", "settling_batch": ""}}
+            )
+            if not conflict:
+                await emit_events([
+                    event("transaction.settlement_failed", txn['id'], trader_id=trader['id'], reason="insufficient_balance")
+                    for txn, _ in settlements
+                ])
+            for txn, _ in settlements:
+                failures[txn['id']] = "Transaction is already being processed" if conflict else "Insufficient USDT balance"
+            settlements = []
+    
+    completed = [txn for txn, _ in settlements if txn['id'] in completed_ids]
+    rates = await get_rates()
+    received = {}
+    for txn in completed:
+        currency = txn.get('currency', 'UAH')
+        received[currency] = received.get(currency, 0) + txn['amount']
+    
+    def result(txn_id: str) -> dict:
+        if txn_id in failures:
+            return {"transaction_id": txn_id, "status": "failed", "detail": failures[txn_id]}
+        if txn_id in completed_ids:
+            return {"transaction_id": txn_id, "status": "completed"}
+        # Debited but not completed: the recovery worker finishes it
+        return {"transaction_id": txn_id, "status": "pending"}
     
     response = {
-        "message": "Payment confirmed and USDT sent",
-        "usdt_sent_to_user": round(usdt_requested, 2),
-        "usdt_deducted_from_trader": round(usdt_to_deduct, 2),
-        "uah_received": txn['amount'],
-        "rate": usd_to_uah_rate
+        "results": [result(txn_id) for txn_id in transaction_ids],
+        "confirmed": len(completed),
+        "usdt_sent_to_users": from_minor(sum(txn['usdt_requested'] for txn in completed)),
+        "usdt_deducted_from_trader": from_minor(sum(deduct for _, deduct in settlements)),
+        "received": {currency: from_minor(amount) for currency, amount in received.items()},
+        "rates": {currency: rates.get(currency) for currency in received}
     }
     
-    if new_balance < 50:
-        response["warning"] = "Your balance is below 50 USDT. You have been automatically disabled from work."
+    if low_balance:
+        response["warning"] = LOW_BALANCE_WARNING
     
     return response
 
 # ===== USER ROUTES =====
-@api_router.post("/user/request-card")
-async def request_card(data: TransactionRequest, user: dict = Depends(get_current_user)):
-    # Validate amount
-    if data.amount <= 0:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount must be positive")
-    
-    # Get settings for commission
-    settings = await db.settings.find_one({}, {"_id": 0})
-    commission_rate = settings['commission_rate'] if settings else 9.0
-    usd_to_uah_rate = settings['usd_to_uah_rate'] if settings else 41.5
-    
+@api_router.post("/user/request-card", dependencies=[rate_limit("deposit")])
+async def request_card(
+    data: TransactionRequest,
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repos),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(idempotency_key, "request-card", user['id'], data,
+                                lambda: reserve_card(data, user, repos))
+
+async def reserve_card(data: TransactionRequest, user: dict, repos: Repositories):
     # NEW LOGIC: Client enters desired deposit amount (without commission)
     # data.amount = UAH клиент ХОЧЕТ положить на счет (без комиссии)
     # Клиент ПЛАТИТ: amount * (1 + commission/100) = amount * 1.09
     # Клиент ПОЛУЧАЕТ: amount / rate USDT
     
-    amount_to_pay = data.amount * (1 + commission_rate / 100)  # Сумма к оплате С комиссией
-    usdt_to_receive = data.amount / usd_to_uah_rate  # USDT которые получит клиент
-    commission_amount = amount_to_pay - data.amount  # Комиссия в UAH
+    # All amounts below are integer minor units
+    settings = await get_cached_settings()
+    quote = compute_quote(to_minor(data.amount), settings['commission_rate'], await get_rate(data.currency))
+    amount, amount_to_pay, usdt_to_receive, commission_amount, commission_rate, exchange_rate = quote
     
-    # Find available cards from WORKING traders with sufficient balance
-    cards = await db.cards.find({
-        "status": "active",
-        "currency": data.currency
-    }, {"_id": 0}).to_list(1000)
+    # Validate amount after rounding: a deposit worth 0 USDT could never settle
+    if amount <= 0 or usdt_to_receive <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount is too small")
     
-    if not cards:
+    # Find available cards from WORKING traders with sufficient balance
+    try:
+        await asyncio.wait_for(routing_index.loaded.wait(), ROUTING_INDEX_READY_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Card routing is not ready yet, please retry")
+    if not routing_index.has_cards(data.currency):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No available cards")
     
-    # Filter cards by trader status and balance
+    # Trader needs at least 50 USDT and the request amount +4%
+    usdt_needed = max(MIN_TRADER_BALANCE, scale_minor(usdt_to_receive, TRADER_MARKUP))
+    
+    # Candidates are filtered in memory by card headroom and trader status/balance
     available_card = None
-    for card in cards:
-        # Check trader
-        trader = await db.traders.find_one({"id": card['trader_id']}, {"_id": 0})
-        if not trader:
-            continue
-        
-        # Check if trader is working and has sufficient balance (at least 50 USDT + request amount)
-        usdt_needed = usdt_to_receive * 1.04  # +4% for trader
-        if not trader.get('is_working', False):
-            continue
-        if trader['usdt_balance'] < max(50, usdt_needed):
-            continue
-        if trader.get('is_blocked', False):
-            continue
-        
-        # Check card limit (with commission)
-        if (card['limit'] - card['current_usage']) >= amount_to_pay:
+    for card in routing_index.candidates(data.currency, amount_to_pay, usdt_needed):
+        # Reserve card capacity atomically (используем amount_to_pay С комиссией);
+        # a concurrent request may have taken the headroom in the meantime
+        reserved = await db.cards.update_one(
+            targeted("cards", {
+                "id": card['id'],
+                "trader_id": card['trader_id'],
+                "status": "active",
+                "$expr": {"$lte": [{"$add": ["$current_usage", amount_to_pay]}, "$limit"]}
+            }),
+            {"$inc": {"current_usage": amount_to_pay}}
+        )
+        if reserved.modified_count:
+            card['current_usage'] = card.get('current_usage', 0) + amount_to_pay
             available_card = card
+            if card['limit'] - card['current_usage'] < CARD_MIN_HEADROOM:
+                await update_card_health(card['trader_id'])
             break
+        # The index was stale for this card; resync it and move on
+        await refresh_routing_card(card['id'], card['trader_id'])
     
     if not available_card:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No working traders available. Please try again later.")
@@ -518,17 +1786,18 @@ async def request_card(data: TransactionRequest, user: dict = Depends(get_curren
         user_id=user['id'],
         trader_id=available_card['trader_id'],
         card_id=available_card['id'],
-        amount=round(data.amount, 2),  # Сумма БЕЗ комиссии
-        usdt_requested=round(usdt_to_receive, 2),
+        amount=amount,  # Сумма БЕЗ комиссии
+        usdt_requested=usdt_to_receive,
+        commission_amount=commission_amount,
         currency=data.currency
     )
-    await db.transactions.insert_one(txn.model_dump())
-    
-    # Update card usage (используем amount_to_pay С комиссией)
-    await db.cards.update_one(
-        {"id": available_card['id']},
-        {"$set": {"current_usage": available_card['current_usage'] + amount_to_pay}}
-    )
+    await repos.transaction_keys.insert({
+        "_id": txn.id, "user_id": txn.user_id, "trader_id": txn.trader_id, "created_at": txn.created_at
+    })
+    await repos.transactions.insert(txn.model_dump())
+    await bump_admin_stats(total_transactions=1)
+    await emit_event("transaction.created", txn.id, user_id=user['id'], trader_id=txn.trader_id,
+                     card_id=txn.card_id, amount=txn.amount, amount_to_pay=amount_to_pay, currency=txn.currency)
     
     return {
         "transaction_id": txn.id,
@@ -537,112 +1806,160 @@ async def request_card(data: TransactionRequest, user: dict = Depends(get_curren
             "card_number": available_card['card_number'],
             "holder_name": available_card['holder_name'],
             "card_name": available_card.get('card_name'),
-            "amount": round(data.amount, 2),  # Сумма БЕЗ комиссии
-            "amount_to_pay": round(amount_to_pay, 2),  # Сумма К ОПЛАТЕ (с комиссией)
+            "amount": from_minor(amount),  # Сумма БЕЗ комиссии
+            "amount_to_pay": from_minor(amount_to_pay),  # Сумма К ОПЛАТЕ (с комиссией)
             "currency": data.currency,
-            "usdt_amount": round(usdt_to_receive, 2),
+            "usdt_amount": from_minor(usdt_to_receive),
             "commission_rate": commission_rate,
-            "commission_amount": round(commission_amount, 2),
-            "exchange_rate": usd_to_uah_rate
+            "commission_amount": from_minor(commission_amount),
+            "exchange_rate": exchange_rate
         },
         "expires_at": txn.expires_at
     }
 
-@api_router.post("/user/confirm-payment/{transaction_id}")
-async def user_confirm_payment(transaction_id: str, user: dict = Depends(get_current_user)):
-    txn = await db.transactions.find_one({"id": transaction_id, "user_id": user['id']}, {"_id": 0})
-    if not txn:
+@api_router.get("/quote", dependencies=[rate_limit("poll")])
+async def get_quote(amount: float, currency: str = "UAH"):
+    """Preview a deposit price without reserving a card."""
+    amount = to_minor(amount)
+    if amount <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount must be positive")
+    settings = await get_cached_settings()
+    return present_quote(compute_quote(amount, settings['commission_rate'], await get_rate(currency)), currency)
+
+@api_router.get("/quote/batch", dependencies=[rate_limit("poll")])
+async def get_batch_quote(amounts: List[float] = Query(..., alias="amount"), currency: str = "UAH"):
+    """Quotes for several amounts at once: /quote/batch?amount=500&amount=1000"""
+    if len(amounts) > QUOTE_BATCH_MAX:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {QUOTE_BATCH_MAX} amounts per request")
+    amounts = [to_minor(amount) for amount in amounts]
+    if any(amount <= 0 for amount in amounts):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount must be positive")
+    commission_rate = (await get_cached_settings())['commission_rate']
+    exchange_rate = await get_rate(currency)
+    return {"quotes": [present_quote(compute_quote(amount, commission_rate, exchange_rate), currency)
+                       for amount in amounts]}
+
+@api_router.post("/user/confirm-payment/{transaction_id}", dependencies=[rate_limit("write")])
+async def user_confirm_payment(
+    transaction_id: str,
+    user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(idempotency_key, "user-confirm-payment", user['id'],
+                                {"transaction_id": transaction_id}, lambda: confirm_user_payment(transaction_id, user))
+
+async def confirm_user_payment(transaction_id: str, user: dict):
+    # Resolve the shard key first so the transaction lookup stays targeted
+    key = await db.transaction_keys.find_one(targeted("transaction_keys", {"_id": transaction_id, "user_id": user['id']}))
+    if not key:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
+    
+    txn_filter = targeted("transactions", {"id": transaction_id, "trader_id": key['trader_id']})
+    txn = await db.transactions.find_one(txn_filter, {"_id": 0})
+    if not txn or txn['user_id'] != user['id']:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
     
     if txn['status'] != 'pending':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Transaction already processed")
     
     await db.transactions.update_one(
-        {"id": transaction_id},
+        {**txn_filter, "status": "pending"},
         {"$set": {
             "status": "user_confirmed",
-            "user_confirmed_at": datetime.now(timezone.utc).isoformat()
+            "user_confirmed_at": datetime.now(timezone.utc)
         }}
     )
+    await emit_event("transaction.user_confirmed", transaction_id, user_id=user['id'], trader_id=txn['trader_id'])
     
     return {"message": "Payment confirmation sent to trader"}
 
-@api_router.get("/user/transactions")
-async def get_user_transactions(user: dict = Depends(get_current_user)):
-    transactions = await db.transactions.find({"user_id": user['id']}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return transactions
+@api_router.get("/user/transactions", dependencies=[rate_limit("poll")])
+async def get_user_transactions(
+    include_archive: bool = False,
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repos)
+):
+    transactions = await repos.transactions.history(
+        await user_transactions_filter(user['id']), "user_transactions", include_archive
+    )
+    return [present_transaction(txn) for txn in transactions]
 
 # ===== WITHDRAWAL ROUTES =====
-@api_router.post("/user/withdrawal-request")
-async def create_withdrawal_request(data: WithdrawalRequest, user: dict = Depends(get_current_user)):
-    # Check user balance
-    user_transactions = await db.transactions.find({
-        "user_id": user['id'],
-        "status": "completed"
-    }, {"_id": 0}).to_list(1000)
-    
-    total_usdt = sum(tx.get('usdt_amount', 0) for tx in user_transactions)
-    
-    # Check pending withdrawals
-    pending_withdrawals = await db.withdrawals.find({
-        "user_id": user['id'],
-        "status": "pending"
-    }, {"_id": 0}).to_list(1000)
-    
-    pending_amount = sum(w.get('amount', 0) for w in pending_withdrawals)
-    
-    # Check approved withdrawals
-    approved_withdrawals = await db.withdrawals.find({
-        "user_id": user['id'],
-        "status": "approved"
-    }, {"_id": 0}).to_list(1000)
-    
-    approved_amount = sum(w.get('amount', 0) for w in approved_withdrawals)
-    
-    available_balance = total_usdt - pending_amount - approved_amount
-    
-    if data.amount > available_balance:
+@api_router.post("/user/withdrawal-request", dependencies=[rate_limit("deposit")])
+async def create_withdrawal_request(
+    data: WithdrawalRequest,
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repos),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(idempotency_key, "withdrawal-request", user['id'], data,
+                                lambda: create_withdrawal(data, user, repos))
+
+async def create_withdrawal(data: WithdrawalRequest, user: dict, repos: Repositories):
+    amount = to_minor(data.amount)
+    
+    # Check user balance: completed deposits minus pending and approved withdrawals,
+    # summed server-side in cents
+    deposits = await db.transactions.aggregate([
+        *including_archive({**await user_transactions_filter(user['id']), "status": "completed"}),
+        {"$group": {"_id": None, "total": {"$sum": "$usdt_amount"}}}
+    ]).to_list(1)
+    total_usdt = deposits[0]['total'] if deposits else 0
+    
+    withdrawn = await db.withdrawals.aggregate([
+        {"$match": {"user_id": user['id'], "status": {"$in": ["pending", "approved"]}}},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+    ]).to_list(1)
+    withdrawn_amount = withdrawn[0]['total'] if withdrawn else 0
+    
+    available_balance = total_usdt - withdrawn_amount
+    
+    if amount > available_balance:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Insufficient balance. Available: {available_balance:.2f} USDT"
+            detail=f"Insufficient balance. Available: {from_minor(available_balance):.2f} USDT"
         )
     
-    if data.amount <= 0:
+    if amount <= 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount must be positive")
     
     # Create withdrawal request
     withdrawal = Withdrawal(
         user_id=user['id'],
         user_email=user['email'],
-        amount=data.amount,
+        amount=amount,
         wallet_address=data.wallet_address,
         status="pending"
     )
     
-    await db.withdrawals.insert_one(withdrawal.model_dump())
+    await repos.withdrawals.insert(withdrawal.model_dump())
+    await emit_event("withdrawal.created", withdrawal.id, user_id=user['id'], amount=amount)
     
     return {"message": "Withdrawal request created", "withdrawal_id": withdrawal.id}
 
-@api_router.get("/user/withdrawals")
-async def get_user_withdrawals(user: dict = Depends(get_current_user)):
-    withdrawals = await db.withdrawals.find({"user_id": user['id']}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return withdrawals
+@api_router.get("/user/withdrawals", dependencies=[rate_limit("poll")])
+async def get_user_withdrawals(user: dict = Depends(get_current_user), repos: Repositories = Depends(get_repos)):
+    withdrawals = await repos.withdrawals.list({"user_id": user['id']}, "user_withdrawals", sort=[("created_at", -1)])
+    return [present_withdrawal(w) for w in withdrawals]
 
 # ===== ADMIN ROUTES =====
-@api_router.get("/admin/traders")
-async def get_all_traders(user: dict = Depends(require_admin)):
-    traders = await db.traders.find({}, {"_id": 0}).to_list(1000)
+@api_router.get("/admin/traders", dependencies=[rate_limit("poll")])
+async def get_all_traders(user: dict = Depends(require_admin), repos: Repositories = Depends(get_dashboard_repos)):
+    traders = await repos.traders.list({}, "admin_traders")
+    
+    traders = [present_trader(trader) for trader in traders]
     
-    # Enrich with user email
+    # Enrich with user email, fetched in one batch
+    users = await repos.users.get_many(trader['user_id'] for trader in traders)
     for trader in traders:
-        user_doc = await db.users.find_one({"id": trader['user_id']}, {"_id": 0})
+        user_doc = users.get(trader['user_id'])
         trader['email'] = user_doc['email'] if user_doc else None
     
     return traders
 
-@api_router.get("/admin/users")
-async def get_all_users(user: dict = Depends(require_admin)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+@api_router.get("/admin/users", dependencies=[rate_limit("poll")])
+async def get_all_users(user: dict = Depends(require_admin), repos: Repositories = Depends(get_dashboard_repos)):
+    users = await repos.users.list({}, "admin_users", projection=USER_PUBLIC_PROJECTION)
     return users
 
 class UserCreate(BaseModel):
@@ -651,9 +1968,13 @@ class UserCreate(BaseModel):
     role: str = "user"  # user, trader, admin
 
 @api_router.post("/admin/users/create")
-async def admin_create_user(data: UserCreate, admin: dict = Depends(require_admin)):
+async def admin_create_user(
+    data: UserCreate,
+    admin: dict = Depends(require_admin),
+    repos: Repositories = Depends(get_repos)
+):
     # Check if user already exists
-    existing = await db.users.find_one({"email": data.email}, {"_id": 0})
+    existing = await repos.users.get_by_email(data.email)
     if existing:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already exists")
     
@@ -668,7 +1989,10 @@ async def admin_create_user(data: UserCreate, admin: dict = Depends(require_admi
         role=data.role,
         is_approved=True  # Admin-created users are auto-approved
     )
-    await db.users.insert_one(new_user.model_dump())
+    await repos.users.insert(new_user.model_dump())
+    if new_user.role == "user":
+        await bump_admin_stats(total_users=1)
+    await emit_event("user.created", new_user.id, role=new_user.role, by=admin['id'])
     
     return {
         "message": "User created successfully",
@@ -681,213 +2005,612 @@ async def admin_create_user(data: UserCreate, admin: dict = Depends(require_admi
     }
 
 @api_router.put("/admin/users/{user_id}/block")
-async def admin_block_user(user_id: str, admin: dict = Depends(require_admin)):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+async def admin_block_user(user_id: str, admin: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    user = await repos.users.get(user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
     # Toggle is_blocked field
     current_blocked = user.get('is_blocked', False)
     new_status = not current_blocked
-    await db.users.update_one({"id": user_id}, {"$set": {"is_blocked": new_status}})
+    await repos.users.update(user_id, {"is_blocked": new_status})
+    if new_status:
+        blocked_user_ids.add(user_id)
+    else:
+        blocked_user_ids.discard(user_id)
+    await emit_event("user.blocked" if new_status else "user.unblocked", user_id, by=admin['id'])
     
     return {"message": "User status updated", "is_blocked": new_status}
 
 @api_router.put("/admin/users/{user_id}/approve")
-async def admin_approve_user(user_id: str, admin: dict = Depends(require_admin)):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+async def admin_approve_user(user_id: str, admin: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    user = await repos.users.get(user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
-    await db.users.update_one({"id": user_id}, {"$set": {"is_approved": True}})
+    await repos.users.update(user_id, {"is_approved": True})
+    await emit_event("user.approved", user_id, by=admin['id'])
     
     return {"message": "User approved", "is_approved": True}
 
 @api_router.delete("/admin/users/{user_id}/reject")
-async def admin_reject_user(user_id: str, admin: dict = Depends(require_admin)):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+async def admin_reject_user(user_id: str, admin: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    user = await repos.users.get(user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
     # Delete the user if not approved yet
     if not user.get('is_approved', False):
-        await db.users.delete_one({"id": user_id})
+        await repos.users.delete(user_id)
+        if user['role'] == 'user':
+            await bump_admin_stats(total_users=-1)
+        await emit_event("user.rejected", user_id, by=admin['id'])
         return {"message": "User registration rejected and deleted"}
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot reject approved user")
 
-@api_router.get("/admin/users/pending")
-async def get_pending_users(admin: dict = Depends(require_admin)):
-    pending_users = await db.users.find({"is_approved": False, "role": {"$ne": "admin"}}, {"_id": 0, "password_hash": 0}).to_list(1000)
+@api_router.get("/admin/users/pending", dependencies=[rate_limit("poll")])
+async def get_pending_users(admin: dict = Depends(require_admin), repos: Repositories = Depends(get_dashboard_repos)):
+    pending_users = await repos.users.list(
+        {"is_approved": False, "role": {"$ne": "admin"}}, "admin_pending_users", projection=USER_PUBLIC_PROJECTION
+    )
     return pending_users
 
+@job_handler("trader.add_balance")
+async def add_balance_job(payload: dict, job: dict):
+    # A re-claimed job must not credit twice. The credit pushes the job id onto
+    # the trader's applied_jobs in the same update; once the job itself is marked
+    # as applied the id is pulled again, so the array only holds jobs in flight.
+    trader_id = payload['trader_id']
+    if not job.get('applied'):
+        trader = await db.traders.find_one_and_update(
+            {"id": trader_id, "applied_jobs": {"$ne": job['id']}},
+            {"$inc": {"usdt_balance": payload['amount']}, "$push": {"applied_jobs": job['id']}},
+            projection=ROUTING_TRADER_FIELDS
+        )
+        if trader:
+            trader['usdt_balance'] += payload['amount']
+            routing_index.upsert_trader(trader)
+            await emit_event("trader.balance_added", trader_id, amount=payload['amount'],
+                             usdt_balance=trader['usdt_balance'], by=job['created_by'])
+            await update_card_health(trader_id)
+        elif not await db.traders.find_one({"id": trader_id, "applied_jobs": job['id']}, {"_id": 1}):
+            return {"applied": False}
+        await db.jobs.update_one({"id": job['id']}, {"$set": {"applied": True}})
+    await db.traders.update_one({"id": trader_id}, {"$pull": {"applied_jobs": job['id']}})
+    trader = await db.traders.find_one({"id": trader_id}, {"_id": 0, "usdt_balance": 1})
+    return {"applied": True, "new_balance": from_minor(trader['usdt_balance'])}
+
 @api_router.post("/admin/traders/{trader_id}/add-balance")
-async def admin_add_balance(trader_id: str, data: AdminAddBalance, user: dict = Depends(require_admin)):
-    trader = await db.traders.find_one({"id": trader_id}, {"_id": 0})
-    if not trader:
+async def admin_add_balance(
+    trader_id: str,
+    data: AdminAddBalance,
+    user: dict = Depends(require_admin),
+    repos: Repositories = Depends(get_repos)
+):
+    if not await repos.traders.get(trader_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader not found")
     
-    new_balance = trader['usdt_balance'] + data.amount
-    await db.traders.update_one({"id": trader_id}, {"$set": {"usdt_balance": new_balance}})
-    
-    return {"message": "Balance added", "new_balance": new_balance}
+    job_id = await enqueue_job(
+        "trader.add_balance",
+        {"trader_id": trader_id, "amount": to_minor(data.amount)},
+        created_by=user['id']
+    )
+    return {"message": "Balance top-up queued", "job_id": job_id}
 
 @api_router.put("/admin/traders/{trader_id}/block")
-async def admin_block_trader(trader_id: str, user: dict = Depends(require_admin)):
-    trader = await db.traders.find_one({"id": trader_id}, {"_id": 0})
+async def admin_block_trader(trader_id: str, user: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    trader = await repos.traders.get(trader_id)
     if not trader:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trader not found")
     
     new_status = not trader['is_blocked']
-    await db.traders.update_one({"id": trader_id}, {"$set": {"is_blocked": new_status}})
+    await repos.traders.update(trader_id, {"is_blocked": new_status})
+    routing_index.upsert_trader({"id": trader_id, "is_blocked": new_status})
+    await emit_event("trader.blocked" if new_status else "trader.unblocked", trader_id, by=user['id'])
+    await update_card_health(trader_id)
     
     return {"message": "Trader status updated", "is_blocked": new_status}
 
-@api_router.get("/admin/transactions")
-async def get_all_transactions(user: dict = Depends(require_admin)):
-    transactions = await db.transactions.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return transactions
+@api_router.get("/admin/transactions", dependencies=[rate_limit("poll")])
+async def get_all_transactions(
+    include_archive: bool = False,
+    user: dict = Depends(require_admin),
+    repos: Repositories = Depends(get_dashboard_repos)
+):
+    transactions = await repos.transactions.history({}, "admin_transactions", include_archive, scatter=True)
+    return [present_transaction(txn) for txn in transactions]
 
 @api_router.get("/admin/settings")
-async def get_settings(user: dict = Depends(require_admin)):
-    settings = await db.settings.find_one({}, {"_id": 0})
+async def get_settings(user: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    settings = await repos.settings.load()
     if not settings:
-        settings = {
-            "commission_rate": 9.0,
-            "usd_to_uah_rate": 41.5,
-            "deposit_wallet_address": "TB4K5h9QwFGSYR2LLJS9ejmt9EjHWurvi1"
-        }
-        await db.settings.insert_one(settings)
+        settings = dict(DEFAULT_SETTINGS)
+        await repos.settings.save(settings)
     return settings
 
 @api_router.get("/settings/public")
 async def get_public_settings():
     """Public endpoint for deposit wallet address"""
-    settings = await db.settings.find_one({}, {"_id": 0})
-    if not settings:
-        return {"deposit_wallet_address": "TB4K5h9QwFGSYR2LLJS9ejmt9EjHWurvi1"}
-    return {"deposit_wallet_address": settings.get("deposit_wallet_address", "TB4K5h9QwFGSYR2LLJS9ejmt9EjHWurvi1")}
+    settings = await get_cached_settings()
+    return {"deposit_wallet_address": settings['deposit_wallet_address']}
 
 @api_router.put("/admin/settings")
-async def update_settings(data: AdminSettings, user: dict = Depends(require_admin)):
-    await db.settings.update_one({}, {"$set": data.model_dump()}, upsert=True)
+async def update_settings(
+    data: AdminSettings,
+    user: dict = Depends(require_admin),
+    repos: Repositories = Depends(get_repos)
+):
+    if any(rate <= 0 for rate in data.currency_rates.values()):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Currency rates must be positive")
+    await repos.settings.save(data.model_dump())
+    invalidate_settings_cache()
+    await emit_event("settings.updated", "settings", by=user['id'], **data.model_dump())
     return {"message": "Settings updated"}
 
-@api_router.get("/admin/withdrawals")
-async def get_all_withdrawals(user: dict = Depends(require_admin)):
-    withdrawals = await db.withdrawals.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return withdrawals
+@api_router.get("/admin/withdrawals", dependencies=[rate_limit("poll")])
+async def get_all_withdrawals(user: dict = Depends(require_admin), repos: Repositories = Depends(get_dashboard_repos)):
+    withdrawals = await repos.withdrawals.list({}, "admin_withdrawals", sort=[("created_at", -1)])
+    return [present_withdrawal(w) for w in withdrawals]
+
+@job_handler("withdrawal.approve")
+async def approve_withdrawal_job(payload: dict, job: dict):
+    withdrawal = await db.withdrawals.find_one_and_update(
+        {"id": payload['withdrawal_id'], "status": "pending"},
+        {"$set": {
+            "status": "approved",
+            "processed_at": datetime.now(timezone.utc)
+        }},
+        projection={"_id": 0}
+    )
+    if not withdrawal:
+        return {"applied": False}
+    await emit_event("withdrawal.approved", payload['withdrawal_id'], user_id=withdrawal['user_id'], by=job['created_by'])
+    return {"applied": True}
 
 @api_router.put("/admin/withdrawals/{withdrawal_id}/approve")
-async def approve_withdrawal(withdrawal_id: str, user: dict = Depends(require_admin)):
-    withdrawal = await db.withdrawals.find_one({"id": withdrawal_id}, {"_id": 0})
+async def approve_withdrawal(withdrawal_id: str, user: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    withdrawal = await repos.withdrawals.get(withdrawal_id)
     if not withdrawal:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Withdrawal not found")
     
     if withdrawal['status'] != 'pending':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Withdrawal already processed")
     
-    await db.withdrawals.update_one(
-        {"id": withdrawal_id},
+    job_id = await enqueue_job("withdrawal.approve", {"withdrawal_id": withdrawal_id}, created_by=user['id'])
+    return {"message": "Withdrawal approve queued", "job_id": job_id}
+
+@job_handler("withdrawal.reject")
+async def reject_withdrawal_job(payload: dict, job: dict):
+    withdrawal = await db.withdrawals.find_one_and_update(
+        {"id": payload['withdrawal_id'], "status": "pending"},
         {"$set": {
-            "status": "approved",
-            "processed_at": datetime.now(timezone.utc).isoformat()
-        }}
+            "status": "rejected",
+            "processed_at": datetime.now(timezone.utc)
+        }},
+        projection={"_id": 0}
     )
-    
-    return {"message": "Withdrawal approved"}
+    if not withdrawal:
+        return {"applied": False}
+    await emit_event("withdrawal.rejected", payload['withdrawal_id'], user_id=withdrawal['user_id'], by=job['created_by'])
+    return {"applied": True}
 
 @api_router.put("/admin/withdrawals/{withdrawal_id}/reject")
-async def reject_withdrawal(withdrawal_id: str, user: dict = Depends(require_admin)):
-    withdrawal = await db.withdrawals.find_one({"id": withdrawal_id}, {"_id": 0})
+async def reject_withdrawal(withdrawal_id: str, user: dict = Depends(require_admin), repos: Repositories = Depends(get_repos)):
+    withdrawal = await repos.withdrawals.get(withdrawal_id)
     if not withdrawal:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Withdrawal not found")
     
     if withdrawal['status'] != 'pending':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Withdrawal already processed")
     
-    await db.withdrawals.update_one(
-        {"id": withdrawal_id},
-        {"$set": {
-            "status": "rejected",
-            "processed_at": datetime.now(timezone.utc).isoformat()
+    job_id = await enqueue_job("withdrawal.reject", {"withdrawal_id": withdrawal_id}, created_by=user['id'])
+    return {"message": "Withdrawal reject queued", "job_id": job_id}
+
+@api_router.get("/admin/jobs/{job_id}")
+async def get_job(job_id: str, user: dict = Depends(require_admin)):
+    job = await db.jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+@api_router.get("/admin/events")
+async def get_events(
+    after: int = 0,
+    limit: int = 100,
+    event_type: Optional[str] = Query(None, alias="type"),
+    user: dict = Depends(require_admin)
+):
+    """Tail the event log: pass the returned next_cursor as `after` to continue."""
+    limit = max(1, min(limit, EVENTS_PAGE_MAX))
+    events = await db.events.find({"seq": {"$gt": after}}, {"_id": 0}).sort("seq", 1).limit(limit).to_list(None)
+    
+    # Stop before a fresh gap so a slower writer's event isn't skipped
+    gap_cutoff = datetime.now(timezone.utc) - timedelta(seconds=EVENT_GAP_WAIT_SECONDS)
+    contiguous = []
+    expected = after + 1
+    for e in events:
+        if e['seq'] != expected and e['created_at'] > gap_cutoff:
+            break
+        contiguous.append(e)
+        expected = e['seq'] + 1
+    
+    next_cursor = contiguous[-1]['seq'] if contiguous else after
+    if event_type:
+        contiguous = [e for e in contiguous if e['type'] == event_type]
+    return {"events": contiguous, "next_cursor": next_cursor}
+
+# ===== ANALYTICS =====
+# Completed transactions are bucketed by completed_at with $dateTrunc. Buckets
+# that are already closed can't change any more, so they are cached in
+# analytics_buckets and only the open bucket and cache misses hit the pipeline.
+ANALYTICS_GRANULARITIES = ("hour", "day", "week", "month")
+ANALYTICS_MAX_BUCKETS = 1000
+
+def bucket_floor(moment: datetime, granularity: str) -> datetime:
+    """Start of the bucket containing `moment` (weeks start on Monday, like $dateTrunc below)."""
+    moment = moment.astimezone(timezone.utc)
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return day
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+def bucket_next(bucket_start: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return bucket_start + timedelta(hours=1)
+    if granularity == "day":
+        return bucket_start + timedelta(days=1)
+    if granularity == "week":
+        return bucket_start + timedelta(weeks=1)
+    if bucket_start.month == 12:
+        return bucket_start.replace(year=bucket_start.year + 1, month=1)
+    return bucket_start.replace(month=bucket_start.month + 1)
+
+def empty_bucket(granularity: str, bucket_start: datetime) -> dict:
+    return {
+        "_id": f"{granularity}:{bucket_start.isoformat()}",
+        "granularity": granularity,
+        "bucket_start": bucket_start,
+        "bucket_end": bucket_next(bucket_start, granularity),
+        "count": 0,
+        "usdt_amount": 0,
+        "by_currency": {},
+        "by_trader": {}
+    }
+
+async def compute_analytics_buckets(granularity: str, start: datetime, end: datetime) -> dict:
+    """Aggregate completed transactions in [start, end) into buckets keyed by bucket_start."""
+    rows = await reader("analytics").transactions.aggregate([
+        *including_archive({"status": "completed", "completed_at": {"$gte": start, "$lt": end}}),
+        {"$group": {
+            "_id": {
+                "bucket": {"$dateTrunc": {"date": "$completed_at", "unit": granularity, "startOfWeek": "monday"}},
+                "trader_id": "$trader_id",
+                "currency": "$currency"
+            },
+            "count": {"$sum": 1},
+            "volume": {"$sum": "$amount"},
+            "usdt_amount": {"$sum": "$usdt_amount"},
+            "commission": {"$sum": "$commission_amount"}
         }}
-    )
+    ]).to_list(None)
+    
+    buckets = {}
+    for row in rows:
+        key = row['_id']
+        bucket = buckets.setdefault(key['bucket'], empty_bucket(granularity, key['bucket']))
+        bucket['count'] += row['count']
+        bucket['usdt_amount'] += row['usdt_amount']
+        
+        currency = bucket['by_currency'].setdefault(key['currency'], {"count": 0, "volume": 0, "commission": 0})
+        currency['count'] += row['count']
+        currency['volume'] += row['volume']
+        currency['commission'] += row['commission']
+        
+        trader = bucket['by_trader'].setdefault(key['trader_id'], {"count": 0, "usdt_amount": 0, "volume": {}})
+        trader['count'] += row['count']
+        trader['usdt_amount'] += row['usdt_amount']
+        trader['volume'][key['currency']] = trader['volume'].get(key['currency'], 0) + row['volume']
+    return buckets
+
+def present_bucket(bucket: dict) -> dict:
+    return {
+        "bucket_start": bucket['bucket_start'],
+        "bucket_end": bucket['bucket_end'],
+        "count": bucket['count'],
+        "usdt_amount": from_minor(bucket['usdt_amount']),
+        "by_currency": [
+            {
+                "currency": currency,
+                "count": totals['count'],
+                "volume": from_minor(totals['volume']),
+                "commission": from_minor(totals['commission'])
+            }
+            for currency, totals in sorted(bucket['by_currency'].items())
+        ],
+        "by_trader": [
+            {
+                "trader_id": trader_id,
+                "count": totals['count'],
+                "usdt_amount": from_minor(totals['usdt_amount']),
+                "volume": {currency: from_minor(v) for currency, v in totals['volume'].items()}
+            }
+            for trader_id, totals in sorted(bucket['by_trader'].items())
+        ]
+    }
+
+@api_router.get("/admin/analytics")
+async def get_analytics(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    granularity: str = "day",
+    user: dict = Depends(require_admin)
+):
+    if granularity not in ANALYTICS_GRANULARITIES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Granularity must be one of: {', '.join(ANALYTICS_GRANULARITIES)}"
+        )
+    
+    now = datetime.now(timezone.utc)
+    end = end.replace(tzinfo=end.tzinfo or timezone.utc) if end else now
+    start = start.replace(tzinfo=start.tzinfo or timezone.utc) if start else end - timedelta(days=30)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end")
+    
+    # Align the range to whole buckets
+    bucket_starts = []
+    cursor = bucket_floor(start, granularity)
+    while cursor < end:
+        bucket_starts.append(cursor)
+        if len(bucket_starts) > ANALYTICS_MAX_BUCKETS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Too many buckets, use a coarser granularity")
+        cursor = bucket_next(cursor, granularity)
+    
+    cached = await db.analytics_buckets.find(
+        {"granularity": granularity, "bucket_start": {"$in": bucket_starts}}
+    ).to_list(None)
+    buckets = {doc['bucket_start']: doc for doc in cached}
+    
+    missing = [b for b in bucket_starts if b not in buckets]
+    if missing:
+        # Each run of consecutive misses is aggregated on its own, so cached
+        # buckets between them are never recomputed
+        runs = []
+        for bucket_start in missing:
+            if runs and bucket_next(runs[-1][-1], granularity) == bucket_start:
+                runs[-1].append(bucket_start)
+            else:
+                runs.append([bucket_start])
+        computed = {}
+        for run in runs:
+            computed.update(await compute_analytics_buckets(granularity, run[0], bucket_next(run[-1], granularity)))
+        closed = []
+        for bucket_start in missing:
+            bucket = computed.get(bucket_start) or empty_bucket(granularity, bucket_start)
+            buckets[bucket_start] = bucket
+            # A lagging secondary may not have seen the last moments of a bucket yet
+            if bucket['bucket_end'] <= now - timedelta(seconds=READ_MAX_STALENESS_SECONDS):
+                closed.append(bucket)
+        # Closed buckets are final; cache them so they're never recomputed
+        for bucket in closed:
+            await db.analytics_buckets.replace_one({"_id": bucket['_id']}, bucket, upsert=True)
     
-    return {"message": "Withdrawal rejected"}
+    return {
+        "granularity": granularity,
+        "start": bucket_starts[0],
+        "end": bucket_next(bucket_starts[-1], granularity),
+        "buckets": [present_bucket(buckets[b]) for b in bucket_starts]
+    }
+
+# ===== REPORTS =====
+def present_report_row(row: dict) -> dict:
+    profit = None if row['profit'] is None else from_minor(row['profit'])
+    return {**row, "volume": from_minor(row['volume']), "usdt": from_minor(row['usdt']), "profit": profit}
+
+@api_router.get("/admin/reports/traders")
+async def get_trader_report(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    trader_id: Optional[str] = None,
+    user: dict = Depends(require_admin)
+):
+    """Count, volume, USDT sent and profit for completed transactions, per trader, day and currency."""
+    now = datetime.now(timezone.utc)
+    end = end.replace(tzinfo=end.tzinfo or timezone.utc) if end else now
+    start = start.replace(tzinfo=start.tzinfo or timezone.utc) if start else end - timedelta(days=30)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end")
+    
+    cursor = reader("analytics").transactions.aggregate([
+        *including_archive(report_match(start, end, trader_id)),
+        {"$project": REPORT_FIELDS}
+    ], allowDiskUse=True).batch_size(REPORT_BATCH_SIZE)
+    rates = await get_rates()
+    report = await build_trader_report(cursor, float(TRADER_MARKUP), rates)
+    
+    return {
+        "start": start,
+        "end": end,
+        "exchange_rates": {row['currency']: rates.get(row['currency']) for row in report.by_currency},
+        "by_currency": [present_report_row(row) for row in report.by_currency],
+        "by_trader": [present_report_row(row) for row in report.by_trader],
+        "by_day": [present_report_row(row) for row in report.by_day]
+    }
+
+# ===== EXPORTS =====
+# Exports iterate a Motor cursor in batches and stream rows out as they arrive,
+# so memory stays flat no matter how many documents match.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+TRANSACTION_EXPORT_FIELDS = [
+    "id", "user_id", "trader_id", "card_id", "amount", "usdt_requested", "usdt_amount",
+    "commission_amount", "currency", "status", "created_at", "user_confirmed_at",
+    "completed_at", "expires_at"
+]
+WITHDRAWAL_EXPORT_FIELDS = [
+    "id", "user_id", "user_email", "amount", "wallet_address", "status",
+    "created_at", "processed_at", "admin_note"
+]
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+async def stream_export(cursor, fields: List[str], present, fmt: str):
+    """Yield one encoded chunk per cursor batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(fields)
+    rows = 0
+    async for doc in cursor:
+        doc = present(doc)
+        if writer:
+            writer.writerow([export_value(doc.get(field)) for field in fields])
+        else:
+            buffer.write(json.dumps({field: export_value(doc.get(field)) for field in fields}))
+            buffer.write("\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def export_response(collection, fields: List[str], present, name: str, fmt: str,
+                    start: Optional[datetime], end: Optional[datetime], status_filter: Optional[str],
+                    archive=None):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Format must be one of: {', '.join(EXPORT_FORMATS)}"
+        )
+    
+    query = {}
+    if start or end:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start.replace(tzinfo=start.tzinfo or timezone.utc)
+        if end:
+            query["created_at"]["$lt"] = end.replace(tzinfo=end.tzinfo or timezone.utc)
+    if status_filter:
+        query["status"] = {"$in": status_filter.split(",")}
+    
+    projection = {"_id": 0, **{field: 1 for field in fields}}
+    if archive is not None:
+        cursor = collection.aggregate([
+            {"$match": query},
+            {"$unionWith": {"coll": archive.name, "pipeline": [{"$match": query}]}},
+            {"$project": projection},
+            {"$sort": {"created_at": 1}}
+        ], allowDiskUse=True).batch_size(EXPORT_BATCH_SIZE)
+    else:
+        cursor = collection.find(query, projection).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+    return StreamingResponse(
+        stream_export(cursor, fields, present, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    )
+
+@api_router.get("/admin/export/transactions")
+async def export_transactions(
+    fmt: str = Query("csv", alias="format"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    include_archive: bool = False,
+    user: dict = Depends(require_admin)
+):
+    source = reader("analytics")
+    return export_response(source.transactions, TRANSACTION_EXPORT_FIELDS, present_transaction,
+                           "transactions", fmt, start, end, status_filter,
+                           archive=source.transactions_archive if include_archive else None)
+
+@api_router.get("/admin/export/withdrawals")
+async def export_withdrawals(
+    fmt: str = Query("csv", alias="format"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    user: dict = Depends(require_admin)
+):
+    return export_response(reader("analytics").withdrawals, WITHDRAWAL_EXPORT_FIELDS, present_withdrawal,
+                           "withdrawals", fmt, start, end, status_filter)
 
 # ===== STATS ROUTE =====
-@api_router.get("/stats")
-async def get_stats(user: dict = Depends(get_current_user)):
+@api_router.get("/stats", dependencies=[rate_limit("poll")])
+async def get_stats(user: dict = Depends(get_current_user), repos: Repositories = Depends(get_repos)):
     if user['role'] == 'trader':
-        trader = await db.traders.find_one({"user_id": user['id']}, {"_id": 0})
+        trader = await repos.traders.get_by_user(user['id'])
         if trader:
-            completed = await db.transactions.count_documents({"trader_id": trader['id'], "status": "completed"})
-            pending = await db.transactions.count_documents({"trader_id": trader['id'], "status": "user_confirmed"})
-            cards_count = await db.cards.count_documents({"trader_id": trader['id']})
+            pending = await repos.transactions.count({"trader_id": trader['id'], "status": "user_confirmed"})
+            cards_count = await repos.cards.count({"trader_id": trader['id']})
             
-            # Get exchange rate
-            settings = await db.settings.find_one({}, {"_id": 0})
-            usd_to_uah_rate = settings['usd_to_uah_rate'] if settings else 41.5
+            rates = await get_rates()
             
-            # Calculate today's stats
+            # Completed count and today's / all-time totals per currency in one server-side pass
             today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-            today_transactions = await db.transactions.find({
-                "trader_id": trader['id'],
-                "status": "completed",
-                "completed_at": {"$gte": today_start.isoformat()}
-            }, {"_id": 0}).to_list(1000)
+            is_today = {"$gte": ["$completed_at", today_start]}
+            groups = await db.transactions.aggregate([
+                *including_archive({"trader_id": trader['id'], "status": "completed"}),
+                {"$group": {
+                    "_id": {"$ifNull": ["$currency", "UAH"]},
+                    "count": {"$sum": 1},
+                    "amount": {"$sum": "$amount"},
+                    "usdt": {"$sum": "$usdt_requested"},
+                    "today_amount": {"$sum": {"$cond": [is_today, "$amount", 0]}},
+                    "today_usdt": {"$sum": {"$cond": [is_today, "$usdt_requested", 0]}}
+                }}
+            ]).to_list(MAX_QUERY_RESULTS)
             
-            today_uah_total = 0
-            today_profit = 0
-            
-            for txn in today_transactions:
-                uah_received = txn.get('amount', 0)
-                usdt_sent = txn.get('usdt_requested', 0)
-                # Profit = UAH received - (USDT sent * 1.04 * rate)
-                usdt_cost = usdt_sent * 1.04 * usd_to_uah_rate
-                profit = uah_received - usdt_cost
-                
-                today_uah_total += uah_received
-                today_profit += profit
-            
-            # Calculate total profit (all time)
-            all_transactions = await db.transactions.find({
-                "trader_id": trader['id'],
-                "status": "completed"
-            }, {"_id": 0}).to_list(10000)
-            
-            total_profit = 0
-            for txn in all_transactions:
-                uah_received = txn.get('amount', 0)
-                usdt_sent = txn.get('usdt_requested', 0)
-                usdt_cost = usdt_sent * 1.04 * usd_to_uah_rate
-                profit = uah_received - usdt_cost
-                total_profit += profit
+            # Profit = currency received - (USDT sent * 1.04 * rate of that currency);
+            # linear, so it is computed from the sums. None if the currency has no rate.
+            def profit(totals: dict, amount_field: str, usdt_field: str) -> Optional[float]:
+                rate = rates.get(totals['_id'])
+                if rate is None:
+                    return None
+                usdt_cost = from_minor(totals[usdt_field]) * float(TRADER_MARKUP) * rate
+                return round(from_minor(totals[amount_field]) - usdt_cost, 2)
             
+            by_currency = {
+                totals['_id']: {
+                    "completed_transactions": totals['count'],
+                    "volume": from_minor(totals['amount']),
+                    "today_volume": from_minor(totals['today_amount']),
+                    "today_profit": profit(totals, 'today_amount', 'today_usdt'),
+                    "total_profit": profit(totals, 'amount', 'usdt')
+                }
+                for totals in groups
+            }
+            uah = by_currency.get("UAH", {})
             return {
-                "balance": trader['usdt_balance'],
-                "completed_transactions": completed,
+                "balance": from_minor(trader['usdt_balance']),
+                "completed_transactions": sum(totals['count'] for totals in groups),
                 "pending_transactions": pending,
                 "cards_count": cards_count,
-                "today_uah_received": round(today_uah_total, 2),
-                "today_profit": round(today_profit, 2),
-                "total_profit": round(total_profit, 2)
+                "today_uah_received": uah.get('today_volume', 0.0),
+                "today_profit": uah.get('today_profit', 0.0),
+                "total_profit": uah.get('total_profit', 0.0),
+                "by_currency": by_currency
             }
     elif user['role'] == 'admin':
-        total_traders = await db.traders.count_documents({})
-        total_users = await db.users.count_documents({"role": "user"})
-        total_transactions = await db.transactions.count_documents({})
-        completed_transactions = await db.transactions.count_documents({"status": "completed"})
-        return {
-            "total_traders": total_traders,
-            "total_users": total_users,
-            "total_transactions": total_transactions,
-            "completed_transactions": completed_transactions
-        }
+        counters = await reader("dashboard").counters.find_one({"_id": ADMIN_STATS_ID})
+        if not counters:
+            counters = await reconcile_admin_stats()
+        return {field: counters.get(field, 0) for field in ADMIN_STATS_FIELDS}
     else:
-        completed = await db.transactions.count_documents({"user_id": user['id'], "status": "completed"})
-        pending = await db.transactions.count_documents({"user_id": user['id'], "status": {"$in": ["pending", "user_confirmed"]}})
+        user_filter = await user_transactions_filter(user['id'])
+        completed = (await db.transactions.count_documents({**user_filter, "status": "completed"})
+                     + await db.transactions_archive.count_documents({**user_filter, "status": "completed"}))
+        pending = await db.transactions.count_documents({**user_filter, "status": {"$in": ["pending", "user_confirmed"]}})
         return {
             "completed_transactions": completed,
             "pending_transactions": pending
@@ -909,6 +2632,74 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ===== BACKGROUND JOBS =====
+background_tasks: List[asyncio.Task] = []
+
+async def run_periodically(name: str, interval_seconds: int, job):
+    while True:
+        try:
+            await job()
+        except Exception:
+            logger.exception("Background job %s failed", name)
+        await asyncio.sleep(interval_seconds)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    await detect_mongo_capabilities()
+    background_tasks.append(asyncio.create_task(
+        run_periodically("recover_settlements", SETTLEMENT_RECOVERY_GRACE_SECONDS, recover_settlements)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("reconcile_admin_stats", STATS_RECONCILE_INTERVAL_SECONDS, reconcile_admin_stats)
+    ))
+    if AUTH_MODE == 'stateless':
+        background_tasks.append(asyncio.create_task(
+            run_periodically("refresh_blocked_users", BLOCKED_USERS_REFRESH_SECONDS, refresh_blocked_users)
+        ))
+    background_tasks.append(asyncio.create_task(maintain_routing_index()))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("update_card_health", CARD_HEALTH_INTERVAL_SECONDS, update_card_health)
+    ))
+    background_tasks.append(asyncio.create_task(run_job_worker()))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("archive_transactions", ARCHIVE_INTERVAL_SECONDS, archive_transactions)
+    ))
+    if SNAPSHOT_DIR:
+        background_tasks.append(asyncio.create_task(
+            run_periodically("snapshot_history", SNAPSHOT_INTERVAL_SECONDS, snapshot_history)
+        ))
+
+@app.on_event("startup")
+async def create_indexes():
+    # Date-range indexes for the expiry sweep, daily stats and history listings
+    await db.transactions.create_index([("trader_id", 1), ("status", 1), ("expires_at", 1)])
+    await db.transactions.create_index([("trader_id", 1), ("status", 1), ("completed_at", 1)])
+    await db.transactions.create_index([("user_id", 1), ("created_at", -1)])
+    await db.transactions.create_index([("trader_id", 1), ("created_at", -1)])
+    await db.transactions.create_index([("created_at", -1)])
+    await db.transactions.create_index([("status", 1), ("settling_at", 1)])
+    await db.transactions.create_index([("status", 1), ("created_at", 1)])
+    await db.transactions_archive.create_index([("user_id", 1), ("created_at", -1)])
+    await db.transactions_archive.create_index([("trader_id", 1), ("created_at", -1)])
+    await db.transactions_archive.create_index([("trader_id", 1), ("status", 1), ("completed_at", 1)])
+    await db.transactions_archive.create_index([("status", 1), ("completed_at", 1)])
+    await db.transactions_archive.create_index([("created_at", 1)])
+    await db.transaction_keys.create_index([("user_id", 1), ("trader_id", 1)])
+    await db.cards.create_index([("trader_id", 1), ("status", 1)])
+    await db.cards.create_index("status")
+    await db.events.create_index("seq", unique=True)
+    await db.jobs.create_index("id", unique=True)
+    await db.jobs.create_index([("status", 1), ("run_at", 1)])
+    await db.jobs.create_index("finished_at", expireAfterSeconds=JOB_RETENTION_SECONDS)
+    await db.withdrawals.create_index([("user_id", 1), ("created_at", -1)])
+    await db.withdrawals.create_index([("created_at", -1)])
+    await db.analytics_buckets.create_index([("granularity", 1), ("bucket_start", 1)])
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    if RATE_LIMIT_BACKEND == 'mongo':
+        await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+Columnar snapshots of SkiPay history for offline analytics.
+
+Transactions and withdrawals are appended incrementally to Hive-partitioned
+Parquet files (`<root>/<dataset>/date=YYYY-MM-DD/part-*.parquet`), picking up
+from the last exported `created_at`. Trader balances are snapshotted in full on
+every run. Only documents created at least `lag` ago are exported, so rows are
+written once their status has settled; anything still open at that point is
+exported as it stood. Watermarks are kept next to the files, so deleting the
+snapshot directory starts a fresh full export.
+
+Each export window is recorded as pending before any file is written, and its
+files are named after the window. A run that crashed midway is retried with the
+same window on the next run and overwrites its own files instead of adding
+duplicates. Callers running several workers pass `renew_lease`, which is
+awaited before every file and state write; it extends the caller's lease or
+raises LeaseLost, so a worker whose lease lapsed stops before it writes again.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+
+# Money columns are integer minor units, as stored
+SCHEMAS = {
+    "transactions": pa.schema([
+        ("id", pa.string()), ("user_id", pa.string()), ("trader_id", pa.string()), ("card_id", pa.string()),
+        ("amount", pa.int64()), ("usdt_requested", pa.int64()), ("usdt_amount", pa.int64()),
+        ("commission_amount", pa.int64()), ("currency", pa.string()), ("status", pa.string()),
+        ("created_at", TIMESTAMP), ("user_confirmed_at", TIMESTAMP), ("completed_at", TIMESTAMP),
+        ("expires_at", TIMESTAMP),
+    ]),
+    "withdrawals": pa.schema([
+        ("id", pa.string()), ("user_id", pa.string()), ("amount", pa.int64()), ("wallet_address", pa.string()),
+        ("status", pa.string()), ("created_at", TIMESTAMP), ("processed_at", TIMESTAMP),
+    ]),
+    "trader_balances": pa.schema([
+        ("id", pa.string()), ("user_id", pa.string()), ("usdt_balance", pa.int64()),
+        ("is_working", pa.bool_()), ("is_blocked", pa.bool_()), ("snapshot_at", TIMESTAMP),
+    ]),
+}
+# dataset -> collections it is exported from (archived transactions included)
+INCREMENTAL_SOURCES = {
+    "transactions": ("transactions", "transactions_archive"),
+    "withdrawals": ("withdrawals",),
+}
+PARTITION_FIELDS = {"transactions": "created_at", "withdrawals": "created_at", "trader_balances": "snapshot_at"}
+WATERMARKS_FILE = "_watermarks.json"
+WRITE_BATCH_SIZE = 50000
+
+RenewLease = Callable[[], Awaitable[None]]
+
+class LeaseLost(Exception):
+    """Another worker took over the snapshot lease."""
+
+async def no_lease():
+    pass
+
+class Window(NamedTuple):
+    since: Optional[datetime]
+    until: datetime
+
+    @property
+    def label(self) -> str:
+        start = self.since.strftime("%Y%m%dT%H%M%S%f") if self.since else "start"
+        return f"{start}-{self.until.strftime('%Y%m%dT%H%M%S%f')}"
+
+class SnapshotState(NamedTuple):
+    watermarks: Dict[str, datetime]  # dataset -> exported up to (inclusive)
+    pending: Dict[str, Window]  # dataset -> window being exported
+
+def load_state(root: Path) -> SnapshotState:
+    path = root / WATERMARKS_FILE
+    if not path.exists():
+        return SnapshotState({}, {})
+    data = json.loads(path.read_text())
+    parse = lambda value: datetime.fromisoformat(value) if value else None  # noqa: E731
+    return SnapshotState(
+        {name: parse(value) for name, value in data.get("watermarks", {}).items()},
+        {name: Window(parse(since), parse(until)) for name, (since, until) in data.get("pending", {}).items()},
+    )
+
+def save_state(root: Path, state: SnapshotState):
+    # Write-then-rename so a crash never leaves a half-written watermark file
+    path = root / WATERMARKS_FILE
+    tmp = path.with_suffix(".tmp")
+    iso = lambda value: value.isoformat() if value else None  # noqa: E731
+    tmp.write_text(json.dumps({
+        "watermarks": {name: iso(value) for name, value in state.watermarks.items()},
+        "pending": {name: [iso(window.since), iso(window.until)] for name, window in state.pending.items()},
+    }))
+    os.replace(tmp, path)
+
+def write_partitions(root: Path, dataset: str, rows: List[dict], file_prefix: str):
+    """Write one batch of rows, split into one Parquet file per partition day."""
+    schema = SCHEMAS[dataset]
+    partition_field = PARTITION_FIELDS[dataset]
+    by_day: Dict[str, List[dict]] = {}
+    for row in rows:
+        by_day.setdefault(row[partition_field].date().isoformat(), []).append(row)
+    for day, day_rows in by_day.items():
+        directory = root / dataset / f"date={day}"
+        directory.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pylist([{field: row.get(field) for field in schema.names} for row in day_rows], schema)
+        pq.write_table(table, directory / f"{file_prefix}.parquet", compression="zstd")
+
+async def export_collection(db, root: Path, dataset: str, collection: str, window: Window,
+                            renew_lease: RenewLease = no_lease) -> int:
+    query = {"created_at": {"$lte": window.until}}
+    if window.since:
+        query["created_at"]["$gt"] = window.since
+    projection = {"_id": 0, **{field: 1 for field in SCHEMAS[dataset].names}}
+    # A stable order gives a retried window the same batches, hence the same file names
+    cursor = db[collection].find(query, projection).sort([("created_at", 1), ("id", 1)]).batch_size(WRITE_BATCH_SIZE)
+
+    exported = 0
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= WRITE_BATCH_SIZE:
+            prefix = f"part-{window.label}-{collection}-{exported // WRITE_BATCH_SIZE:05d}"
+            await renew_lease()
+            await asyncio.to_thread(write_partitions, root, dataset, batch, prefix)
+            exported += len(batch)
+            batch = []
+    if batch:
+        prefix = f"part-{window.label}-{collection}-{exported // WRITE_BATCH_SIZE:05d}"
+        await renew_lease()
+        await asyncio.to_thread(write_partitions, root, dataset, batch, prefix)
+        exported += len(batch)
+    return exported
+
+async def export_trader_balances(db, root: Path, now: datetime, run_id: str,
+                                 renew_lease: RenewLease = no_lease) -> int:
+    projection = {"_id": 0, **{field: 1 for field in SCHEMAS["trader_balances"].names if field != "snapshot_at"}}
+    traders = await db.traders.find({}, projection).to_list(None)
+    rows = [{**trader, "snapshot_at": now} for trader in traders]
+    if rows:
+        await renew_lease()
+        await asyncio.to_thread(write_partitions, root, "trader_balances", rows, f"part-{run_id}")
+    return len(rows)
+
+async def run_snapshot(db, root: Path, lag: timedelta, renew_lease: RenewLease = no_lease) -> Dict[str, int]:
+    """Export everything created since the last run (and older than `lag`); returns rows written per dataset."""
+    root.mkdir(parents=True, exist_ok=True)
+    now = datetime.now(timezone.utc)
+    until = now - lag
+    run_id = now.strftime("%Y%m%dT%H%M%S")
+    state = load_state(root)
+
+    written = {}
+    for dataset, collections in INCREMENTAL_SOURCES.items():
+        written[dataset] = 0
+        # Finish an interrupted window first, with the same bounds and file names
+        window = state.pending.get(dataset)
+        if window is None:
+            window = Window(state.watermarks.get(dataset), until)
+            if window.since and window.since >= window.until:
+                continue
+            state.pending[dataset] = window
+            await renew_lease()
+            save_state(root, state)
+        for collection in collections:
+            written[dataset] += await export_collection(db, root, dataset, collection, window, renew_lease)
+        state.watermarks[dataset] = window.until
+        del state.pending[dataset]
+        await renew_lease()
+        save_state(root, state)
+    written["trader_balances"] = await export_trader_balances(db, root, now, run_id, renew_lease)
+    return written
+
+def read_snapshot(root: Path, dataset: str, start: Optional[str] = None, end: Optional[str] = None) -> pa.Table:
+    """Memory-mapped Arrow table of a snapshot dataset, optionally limited to date partitions in [start, end]."""
+    files = []
+    for directory in sorted((root / dataset).glob("date=*")):
+        day = directory.name.split("=", 1)[1]
+        if (start and day < start) or (end and day > end):
+            continue
+        files.extend(sorted(directory.glob("*.parquet")))
+    if not files:
+        return SCHEMAS[dataset].empty_table()
+    return pa.concat_tables(pq.read_table(path, memory_map=True, schema=SCHEMAS[dataset]) for path in files)
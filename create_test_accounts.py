@@ -50,7 +50,7 @@ async def create_test_accounts():
         'role': 'admin',
         'is_blocked': False,
         'is_approved': True,
-        'created_at': datetime.now().isoformat()
+        'created_at': datetime.now(timezone.utc)
     }
     await db.users.insert_one(admin)
     print(f"✅ Admin создан: {admin['email']} / admin123")
@@ -64,7 +64,7 @@ async def create_test_accounts():
         'role': 'trader',
         'is_blocked': False,
         'is_approved': True,
-        'created_at': datetime.now().isoformat()
+        'created_at': datetime.now(timezone.utc)
     }
     await db.users.insert_one(trader)
     
@@ -73,7 +73,7 @@ async def create_test_accounts():
         'id': str(uuid.uuid4()),
         'user_id': trader['id'],
         'email': trader['email'],
-        'usdt_balance': 5000.0,
+        'usdt_balance': 5000 * 100,  # USDT cents
         'is_working': True,
         'deposit_wallet_address': ''
     }
@@ -86,11 +86,12 @@ async def create_test_accounts():
         'card_number': '5168742012345678',
         'bank_name': 'ПриватБанк',
         'holder_name': 'IVAN PETRENKO',
-        'limit': 100000,
+        'limit': 100000 * 100,  # kopecks
+        'current_usage': 0,
         'currency': 'UAH',
         'status': 'active',
         'card_name': 'Основная карта для тестов',
-        'created_at': datetime.now().isoformat()
+        'created_at': datetime.now(timezone.utc)
     }
     await db.cards.insert_one(card)
     
@@ -107,7 +108,7 @@ async def create_test_accounts():
         'role': 'user',
         'is_blocked': False,
         'is_approved': True,
-        'created_at': datetime.now().isoformat()
+        'created_at': datetime.now(timezone.utc)
     }
     await db.users.insert_one(user)
     print(f"✅ User создан: {user['email']} / user123")
@@ -127,6 +128,14 @@ async def create_test_accounts():
         print(f"   📊 Комиссия: {settings['commission_rate']}%")
         print(f"   💱 Курс: 1 USDT = {settings['usd_to_uah_rate']} UAH")
     
+    # Amounts above are already in minor units and timestamps are BSON dates
+    for migration in ('money_minor_units', 'native_datetimes'):
+        await db.migrations.update_one(
+            {'_id': migration},
+            {'$setOnInsert': {'applied_at': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    
     print("\n" + "="*60)
     print("✅ ВСЕ ТЕСТОВЫЕ АККАУНТЫ УСПЕШНО СОЗДАНЫ!")
     print("="*60)
@@ -154,5 +163,5 @@ async def create_test_accounts():
     client.close()
 
 if __name__ == '__main__':
-    from datetime import datetime
+    from datetime import datetime, timezone
     asyncio.run(create_test_accounts())
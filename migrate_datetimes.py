@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Миграция временных полей SkiPay: ISO-строки -> BSON даты.
+
+Запускается один раз, до старта обновлённого backend. Повторный запуск безопасен:
+факт выполнения записывается в коллекцию `migrations`. Строки, которые не удалось
+разобрать, остаются как есть; их количество выводится по каждому полю.
+"""
+import asyncio
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Optional
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+
+# Load environment
+ROOT_DIR = Path(__file__).parent / 'backend'
+load_dotenv(ROOT_DIR / '.env')
+
+MIGRATION_NAME = 'native_datetimes'
+
+# collection -> timestamp fields
+DATE_FIELDS = {
+    'users': ['created_at'],
+    'traders': ['created_at'],
+    'cards': ['created_at'],
+    'transactions': ['created_at', 'user_confirmed_at', 'completed_at', 'expires_at'],
+    'withdrawals': ['created_at', 'processed_at'],
+}
+
+def to_date_expr(field: str) -> dict:
+    """Aggregation expression parsing an ISO string; strings without an offset are read as UTC.
+    Unparseable strings are kept unchanged rather than replaced with null."""
+    return {"$dateFromString": {"dateString": f"${field}", "onError": f"${field}"}}
+
+async def migrate_db(db) -> Optional[Dict[str, int]]:
+    """Convert every date string; returns "collection.field" -> strings left unparsed, or None if already applied."""
+    if await db.migrations.find_one({"_id": MIGRATION_NAME}):
+        return None
+
+    skipped = {}
+    for collection, fields in DATE_FIELDS.items():
+        print(f"\n🕒 {collection}: {', '.join(fields)}")
+        for field in fields:
+            result = await db[collection].update_many(
+                {field: {"$type": "string"}},
+                [{"$set": {field: to_date_expr(field)}}]
+            )
+            print(f"   {field}: обновлено документов: {result.modified_count}")
+            unparsed = await db[collection].count_documents({field: {"$type": "string"}})
+            if unparsed:
+                skipped[f"{collection}.{field}"] = unparsed
+                print(f"   ⚠️  {field}: не удалось разобрать, оставлено без изменений: {unparsed}")
+
+    await db.migrations.insert_one({
+        "_id": MIGRATION_NAME,
+        "applied_at": datetime.now(timezone.utc)
+    })
+    return skipped
+
+async def migrate():
+    mongo_url = os.environ['MONGO_URL']
+    db_name = os.environ['DB_NAME']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+
+    print("🔄 Подключение к MongoDB...")
+    print(f"Database: {db_name}")
+
+    skipped = await migrate_db(db)
+    if skipped is None:
+        print(f"\n✅ Миграция '{MIGRATION_NAME}' уже выполнена, пропускаем")
+        client.close()
+        return
+
+    print("\n" + "="*60)
+    print("✅ МИГРАЦИЯ ВРЕМЕННЫХ ПОЛЕЙ ЗАВЕРШЕНА")
+    print("="*60)
+    if skipped:
+        print(f"⚠️  Не разобрано строк: {sum(skipped.values())} — исправьте их вручную:")
+        for name, count in skipped.items():
+            print(f"   {name}: {count}")
+
+    client.close()
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
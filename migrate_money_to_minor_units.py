@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Миграция денежных полей SkiPay: float -> целые минимальные единицы (центы / копейки).
+
+Запускается один раз, до старта обновлённого backend. Повторный запуск безопасен:
+после каждого поля и по завершении в коллекцию `migrations` пишется отметка, так что
+после сбоя уже сконвертированные поля не умножаются на 100 повторно.
+"""
+import asyncio
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+
+# Load environment
+ROOT_DIR = Path(__file__).parent / 'backend'
+load_dotenv(ROOT_DIR / '.env')
+
+MIGRATION_NAME = 'money_minor_units'
+MINOR_UNITS = 100
+
+# collection -> money fields (must match *_MONEY_FIELDS in backend/server.py)
+MONEY_FIELDS = {
+    'traders': ['usdt_balance'],
+    'cards': ['limit', 'current_usage'],
+    'transactions': ['amount', 'usdt_requested', 'usdt_amount'],
+    'withdrawals': ['amount'],
+}
+
+def to_minor_expr(field: str) -> dict:
+    """Aggregation expression converting a decimal amount to rounded integer minor units."""
+    return {"$toLong": {"$round": [{"$multiply": [f"${field}", MINOR_UNITS]}, 0]}}
+
+def field_marker(collection: str, field: str) -> str:
+    return f"{MIGRATION_NAME}:{collection}.{field}"
+
+async def migrate_db(db) -> bool:
+    """Convert every money field not yet marked as done; returns False if the migration was already applied."""
+    if await db.migrations.find_one({"_id": MIGRATION_NAME}):
+        return False
+
+    for collection, fields in MONEY_FIELDS.items():
+        print(f"\n💱 {collection}: {', '.join(fields)}")
+        for field in fields:
+            marker = field_marker(collection, field)
+            if await db.migrations.find_one({"_id": marker}):
+                print(f"   {field}: уже сконвертировано, пропускаем")
+                continue
+            # Server-side conversion: every numeric value is rewritten in one update_many
+            result = await db[collection].update_many(
+                {field: {"$type": "number"}},
+                [{"$set": {field: to_minor_expr(field)}}]
+            )
+            # Marked straight away: a re-run must never multiply this field again
+            await db.migrations.insert_one({"_id": marker, "applied_at": datetime.now(timezone.utc)})
+            print(f"   {field}: обновлено документов: {result.modified_count}")
+
+    await db.migrations.insert_one({
+        "_id": MIGRATION_NAME,
+        "applied_at": datetime.now(timezone.utc)
+    })
+    return True
+
+async def migrate():
+    mongo_url = os.environ['MONGO_URL']
+    db_name = os.environ['DB_NAME']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+
+    print("🔄 Подключение к MongoDB...")
+    print(f"Database: {db_name}")
+
+    if not await migrate_db(db):
+        print(f"\n✅ Миграция '{MIGRATION_NAME}' уже выполнена, пропускаем")
+        client.close()
+        return
+
+    print("\n" + "="*60)
+    print("✅ МИГРАЦИЯ ДЕНЕЖНЫХ ПОЛЕЙ ЗАВЕРШЕНА")
+    print("="*60)
+
+    client.close()
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
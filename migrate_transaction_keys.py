@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Миграция SkiPay: заполнение карты transaction_keys (id транзакции -> user_id, trader_id).
+
+Новые транзакции попадают в карту при создании; скрипт переносит уже существующие
+из `transactions` и `transactions_archive`. Запускается один раз, до старта
+обновлённого backend. Повторный запуск безопасен: факт выполнения записывается
+в коллекцию `migrations`.
+"""
+import asyncio
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+
+# Load environment
+ROOT_DIR = Path(__file__).parent / 'backend'
+load_dotenv(ROOT_DIR / '.env')
+
+MIGRATION_NAME = 'transaction_keys'
+SOURCE_COLLECTIONS = ['transactions', 'transactions_archive']
+
+async def migrate():
+    mongo_url = os.environ['MONGO_URL']
+    db_name = os.environ['DB_NAME']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+
+    print("🔄 Подключение к MongoDB...")
+    print(f"Database: {db_name}")
+
+    if await db.migrations.find_one({"_id": MIGRATION_NAME}):
+        print(f"\n✅ Миграция '{MIGRATION_NAME}' уже выполнена, пропускаем")
+        client.close()
+        return
+
+    for collection in SOURCE_COLLECTIONS:
+        print(f"\n🗝️  {collection} -> transaction_keys")
+        # Server-side copy: existing keys are left untouched
+        await db[collection].aggregate([
+            {"$project": {"_id": "$id", "user_id": 1, "trader_id": 1, "created_at": 1}},
+            {"$merge": {"into": "transaction_keys", "on": "_id", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ]).to_list(None)
+        print(f"   transaction_keys: {await db.transaction_keys.estimated_document_count()} записей")
+
+    await db.migrations.insert_one({
+        "_id": MIGRATION_NAME,
+        "applied_at": datetime.now(timezone.utc)
+    })
+
+    print("\n" + "="*60)
+    print("✅ КАРТА TRANSACTION_KEYS ЗАПОЛНЕНА")
+    print("="*60)
+
+    client.close()
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
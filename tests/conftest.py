@@ -0,0 +1,55 @@
+"""
+Shared fixtures for the backend tests.
+
+The API module is imported from backend/ as uvicorn runs it, with its Motor
+database swapped for an in-memory mongomock one per test. Startup hooks
+(indexes, background jobs) are not run.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+import mongomock.aggregate
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncLatentCommandCursor, AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'skipay_test')
+os.environ.setdefault('SHARD_KEY_CHECKS', '1')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+def union_with(in_collection, database, options):
+    # mongomock has no $unionWith, which the archive-aware aggregations use
+    other = database[options['coll']]
+    return list(in_collection) + list(other.aggregate(options.get('pipeline', [])))
+
+mongomock.aggregate._PIPELINE_HANDLERS.setdefault('$unionWith', union_with)
+# aggregate() cursors fall through to the synchronous cursor on batch_size()
+AsyncLatentCommandCursor.batch_size = lambda self, size: self
+
+@pytest.fixture
+def db(monkeypatch):
+    test_db = AsyncMongoMockClient(tz_aware=True)[os.environ['DB_NAME']]
+    monkeypatch.setattr(server, 'db', test_db)
+    monkeypatch.setattr(server, 'routing_index', server.EligibilityIndex())
+    monkeypatch.setitem(server.mongo_capabilities, 'transactions', False)
+    # mongomock's with_options returns an unwrapped synchronous database
+    monkeypatch.setattr(server, 'reader', lambda route_class: test_db)
+    server.invalidate_settings_cache()
+    return test_db
+
+@pytest.fixture
+def api(db):
+    return TestClient(server.app)
+
+@pytest.fixture
+def make_user(db):
+    """Create an approved account; returns (user, auth headers)."""
+    def make(email: str, role: str = "user"):
+        user = server.User(email=email, password_hash="x", role=role, is_approved=True)
+        asyncio.run(db.users.insert_one(user.model_dump()))
+        return user, {"Authorization": f"Bearer {server.create_token(user.id, user.email, role)}"}
+    return make
@@ -0,0 +1,15 @@
+def test_amounts_rounding_to_zero_are_rejected(api, make_user):
+    _, headers = make_user("client@example.com")
+
+    assert api.get("/api/quote", params={"amount": 0.004}).status_code == 400
+    assert api.get("/api/quote/batch", params={"amount": [100, 0.004]}).status_code == 400
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 0.004})
+    assert response.status_code == 400
+    # Worth less than one USDT cent at the default rate
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 0.2})
+    assert response.status_code == 400
+
+def test_quote_prices_the_rounded_amount(api):
+    quote = api.get("/api/quote", params={"amount": 100.005}).json()
+    assert quote["amount"] == 100.01
+    assert quote["amount_to_pay"] == 109.01
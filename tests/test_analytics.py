@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+import server
+
+@pytest.fixture
+def computed_ranges(db, monkeypatch):
+    ranges = []
+
+    async def compute(granularity, start, end):
+        ranges.append((start, end))
+        return {}
+
+    monkeypatch.setattr(server, 'compute_analytics_buckets', compute)
+    return ranges
+
+def cache_days(db, days):
+    asyncio.run(db.analytics_buckets.insert_many([server.empty_bucket("day", day) for day in days]))
+
+def analytics(api, make_user, start, end) -> dict:
+    _, headers = make_user("admin@example.com", "admin")
+    response = api.get("/api/admin/analytics", headers=headers,
+                       params={"granularity": "day", "start": start.isoformat(), "end": end.isoformat()})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_only_the_open_bucket_is_queried_when_closed_ones_are_cached(api, make_user, db, computed_ranges):
+    today = server.bucket_floor(datetime.now(timezone.utc), "day")
+    days = [today - timedelta(days=n) for n in range(5, 0, -1)]
+    cache_days(db, days)
+
+    body = analytics(api, make_user, days[0], today + timedelta(hours=1))
+    assert len(body['buckets']) == 6
+    assert computed_ranges == [(today, today + timedelta(days=1))]
+
+def test_cached_buckets_between_misses_are_not_recomputed(api, make_user, db, computed_ranges):
+    today = server.bucket_floor(datetime.now(timezone.utc), "day")
+    # All closed well before now
+    days = [today - timedelta(days=n) for n in range(8, 2, -1)]
+    one_day = timedelta(days=1)
+    # Cached: days[1], days[2], days[4]; missing: days[0], days[3], days[5]
+    cache_days(db, [days[1], days[2], days[4]])
+
+    analytics(api, make_user, days[0], days[5] + one_day)
+    assert computed_ranges == [
+        (days[0], days[0] + one_day),
+        (days[3], days[3] + one_day),
+        (days[5], days[5] + one_day),
+    ]
+    # The misses were closed and are cached now
+    computed_ranges.clear()
+    analytics(api, make_user, days[0], days[5] + one_day)
+    assert computed_ranges == []
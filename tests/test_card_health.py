@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+import server
+
+def setup_card(db, make_user, usdt_balance: int = 100000, limit: int = 100000):
+    trader_user, headers = make_user("trader@example.com", "trader")
+    trader = server.Trader(user_id=trader_user.id, name="T", nickname="t", usdt_address="a", phone="p",
+                           usdt_balance=usdt_balance)
+    card = server.Card(trader_id=trader.id, card_number="4111", bank_name="B", holder_name="H", limit=limit)
+    asyncio.run(db.traders.insert_one(trader.model_dump()))
+    asyncio.run(db.cards.insert_one(card.model_dump()))
+    return trader, card, headers
+
+def card_state(db, card_id: str) -> tuple:
+    card = asyncio.run(db.cards.find_one({"id": card_id}))
+    return card['status'], card.get('pause_reason')
+
+def health(trader_id=None) -> int:
+    return asyncio.run(server.update_card_health(trader_id))
+
+def test_card_without_headroom_is_paused_and_reactivated(db, make_user):
+    trader, card, _ = setup_card(db, make_user, limit=server.CARD_MIN_HEADROOM - 1)
+    assert health() == 1
+    assert card_state(db, card.id) == ("auto_paused", "no_capacity")
+    assert health() == 0
+
+    asyncio.run(db.cards.update_one({"id": card.id}, {"$set": {"limit": server.CARD_MIN_HEADROOM * 2}}))
+    assert health(trader.id) == 1
+    assert card_state(db, card.id) == ("active", None)
+
+def test_ineligible_trader_cards_are_paused_and_reactivated(db, make_user):
+    trader, card, _ = setup_card(db, make_user, usdt_balance=server.MIN_TRADER_BALANCE - 1)
+    assert health() == 1
+    assert card_state(db, card.id) == ("auto_paused", "trader_ineligible")
+
+    asyncio.run(db.traders.update_one({"id": trader.id}, {"$set": {"usdt_balance": server.MIN_TRADER_BALANCE}}))
+    assert health(trader.id) == 1
+    assert card_state(db, card.id) == ("active", None)
+
+def test_pause_reason_follows_the_current_cause(db, make_user):
+    trader, card, _ = setup_card(db, make_user, limit=server.CARD_MIN_HEADROOM - 1)
+    health()
+    asyncio.run(db.traders.update_one({"id": trader.id}, {"$set": {"is_blocked": True}}))
+    assert health(trader.id) == 1
+    assert card_state(db, card.id) == ("auto_paused", "trader_ineligible")
+
+@pytest.mark.parametrize("usdt_balance, limit, reason", [
+    (100000, server.CARD_MIN_HEADROOM - 1, "no_capacity"),
+    (server.MIN_TRADER_BALANCE - 1, 100000, "trader_ineligible"),
+])
+def test_manual_reactivation_is_paused_again(api, db, make_user, usdt_balance, limit, reason):
+    trader, card, headers = setup_card(db, make_user, usdt_balance=usdt_balance, limit=limit)
+    health()
+    assert card_state(db, card.id) == ("auto_paused", reason)
+
+    response = api.put(f"/api/trader/cards/{card.id}", headers=headers, json={"status": "active"})
+    assert response.status_code == 200, response.text
+    # The cause is still there, so the card goes straight back to auto_paused
+    assert response.json()['status'] == "auto_paused"
+    assert card_state(db, card.id) == ("auto_paused", reason)
+    assert card.id not in server.routing_index.active_by_currency.get("UAH", {})
+
+def test_manual_pause_clears_auto_pause_reason(api, db, make_user):
+    trader, card, headers = setup_card(db, make_user, limit=server.CARD_MIN_HEADROOM - 1)
+    health()
+    response = api.put(f"/api/trader/cards/{card.id}", headers=headers, json={"status": "paused"})
+    assert response.status_code == 200, response.text
+    assert card_state(db, card.id) == ("paused", None)
+    # Cards the trader paused are left alone
+    assert health() == 0
@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import server
+
+def tail(api, headers, **params) -> dict:
+    response = api.get("/api/admin/events", headers=headers, params=params)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def insert_events(db, seqs, age: timedelta = timedelta(0)):
+    created_at = datetime.now(timezone.utc) - age
+    asyncio.run(db.events.insert_many([
+        {"seq": seq, "created_at": created_at, "type": "test.event", "entity_id": str(seq), "data": {}}
+        for seq in seqs
+    ]))
+
+def test_concurrent_emits_get_distinct_ordered_sequence_numbers(api, make_user, db):
+    _, headers = make_user("admin@example.com", "admin")
+
+    async def emit_all():
+        await asyncio.gather(*(
+            server.emit_events([server.event("test.event", f"{batch}-{i}") for i in range(3)])
+            for batch in range(5)
+        ))
+    asyncio.run(emit_all())
+
+    page = tail(api, headers, limit=100)
+    assert [e['seq'] for e in page['events']] == list(range(1, 16))
+    assert page['next_cursor'] == 15
+    # Events of one emit_events call are numbered consecutively
+    by_batch = {}
+    for e in page['events']:
+        by_batch.setdefault(e['entity_id'].split("-")[0], []).append(e['seq'])
+    assert all(seqs == list(range(seqs[0], seqs[0] + 3)) for seqs in by_batch.values())
+
+def test_after_cursor_pages_through_the_log(api, make_user, db):
+    _, headers = make_user("admin@example.com", "admin")
+    insert_events(db, range(1, 8))
+    seen = []
+    cursor = 0
+    while True:
+        page = tail(api, headers, after=cursor, limit=3)
+        if not page['events']:
+            break
+        assert len(page['events']) <= 3
+        seen.extend(e['seq'] for e in page['events'])
+        cursor = page['next_cursor']
+    assert seen == list(range(1, 8))
+    assert cursor == 7
+
+def test_tail_waits_at_a_fresh_gap(api, make_user, db):
+    _, headers = make_user("admin@example.com", "admin")
+    insert_events(db, [1, 2, 4, 5])
+    page = tail(api, headers)
+    assert [e['seq'] for e in page['events']] == [1, 2]
+    assert page['next_cursor'] == 2
+
+    # The in-flight event lands; the next call picks up from the cursor
+    insert_events(db, [3])
+    page = tail(api, headers, after=page['next_cursor'])
+    assert [e['seq'] for e in page['events']] == [3, 4, 5]
+
+def test_tail_skips_a_gap_older_than_the_wait(api, make_user, db):
+    _, headers = make_user("admin@example.com", "admin")
+    old = timedelta(seconds=server.EVENT_GAP_WAIT_SECONDS + 1)
+    insert_events(db, [1, 3], age=old)
+    page = tail(api, headers)
+    assert [e['seq'] for e in page['events']] == [1, 3]
+    assert page['next_cursor'] == 3
+
+def test_type_filter_still_advances_the_cursor(api, make_user, db):
+    _, headers = make_user("admin@example.com", "admin")
+    insert_events(db, [1, 2])
+    asyncio.run(db.events.update_one({"seq": 2}, {"$set": {"type": "other.event"}}))
+    page = tail(api, headers, type="other.event")
+    assert [e['seq'] for e in page['events']] == [2]
+    assert page['next_cursor'] == 2
@@ -0,0 +1,79 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+import pytest
+from fastapi import HTTPException
+import server
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(server, 'idempotency_cache', OrderedDict())
+
+def counting_handler(calls: list, fail: Exception = None):
+    async def handler():
+        calls.append(1)
+        if fail:
+            raise fail
+        return {"call": len(calls)}
+    return handler
+
+def test_retry_replays_the_first_response(db):
+    calls = []
+    first = asyncio.run(server.run_idempotent("k1", "scope", "u1", {"amount": 10}, counting_handler(calls)))
+    again = asyncio.run(server.run_idempotent("k1", "scope", "u1", {"amount": 10}, counting_handler(calls)))
+    assert first == again == {"call": 1}
+    # Replayed from Mongo as well, not only from the in-process cache
+    server.idempotency_cache.clear()
+    assert asyncio.run(server.run_idempotent("k1", "scope", "u1", {"amount": 10}, counting_handler(calls))) == first
+    assert len(calls) == 1
+
+def test_key_reused_with_a_different_request_is_rejected(db):
+    calls = []
+    asyncio.run(server.run_idempotent("k1", "scope", "u1", {"amount": 10}, counting_handler(calls)))
+    for cache in (True, False):
+        if not cache:
+            server.idempotency_cache.clear()
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(server.run_idempotent("k1", "scope", "u1", {"amount": 20}, counting_handler(calls)))
+        assert exc.value.status_code == 422
+    assert len(calls) == 1
+
+def test_concurrent_duplicate_gets_409(db):
+    async def scenario():
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await release.wait()
+            return {"ok": True}
+
+        first = asyncio.create_task(server.run_idempotent("k1", "scope", "u1", {}, slow))
+        await started.wait()
+        with pytest.raises(HTTPException) as exc:
+            await server.run_idempotent("k1", "scope", "u1", {}, slow)
+        release.set()
+        return exc.value.status_code, await first
+
+    assert asyncio.run(scenario()) == (409, {"ok": True})
+
+def test_failed_request_releases_the_key(db):
+    calls = []
+    failure = HTTPException(status_code=400, detail="Amount is too small")
+    with pytest.raises(HTTPException):
+        asyncio.run(server.run_idempotent("k1", "scope", "u1", {}, counting_handler(calls, failure)))
+    assert asyncio.run(db.idempotency_keys.count_documents({})) == 0
+    assert asyncio.run(server.run_idempotent("k1", "scope", "u1", {}, counting_handler(calls))) == {"call": 2}
+
+def test_request_card_with_changed_amount_is_rejected(api, make_user, db):
+    user, headers = make_user("client@example.com")
+    headers = {**headers, "Idempotency-Key": "deposit-1"}
+    # A completed earlier deposit for 100
+    asyncio.run(db.idempotency_keys.insert_one({
+        "_id": f"{user.id}:request-card:deposit-1", "status": "completed", "response": {"transaction_id": "t1"},
+        "request_hash": server.request_hash(server.TransactionRequest(amount=100)),
+        "created_at": datetime.now(timezone.utc),
+    }))
+    assert api.post("/api/user/request-card", headers=headers, json={"amount": 100}).json() == {"transaction_id": "t1"}
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 200})
+    assert response.status_code == 422
@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+from pymongo import ReturnDocument
+import server
+
+TRADER_ID = "trader-1"
+
+def run(coro):
+    return asyncio.run(coro)
+
+class ClaimableJobs:
+    """db.jobs whose find_one_and_update returns the updated document even when
+    it no longer matches the filter, as Mongo does and mongomock doesn't."""
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def find_one_and_update(self, query, update, projection=None, return_document=ReturnDocument.BEFORE,
+                                  **kwargs):
+        before = await self.collection.find_one_and_update(query, update, **kwargs)
+        if before is None or return_document is ReturnDocument.BEFORE:
+            return before
+        return await self.collection.find_one({"_id": before['_id']}, projection)
+
+class JobsDB:
+    def __init__(self, db):
+        self.db = db
+        self.jobs = ClaimableJobs(db.jobs)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def __getitem__(self, name):
+        return self.jobs if name == "jobs" else self.db[name]
+
+@pytest.fixture
+def jobs_db(db, monkeypatch):
+    monkeypatch.setattr(server, 'db', JobsDB(db))
+    monkeypatch.setattr(server, 'jobs_wakeup', asyncio.Event())
+    return db
+
+async def job_doc(db, job_id):
+    return await db.jobs.find_one({"id": job_id}, {"_id": 0})
+
+def test_claim_takes_due_jobs_and_leases_them(jobs_db):
+    due = run(server.enqueue_job("noop", {}))
+    later = run(server.enqueue_job("noop", {}))
+    run(jobs_db.jobs.update_one({"id": later}, {"$set": {"run_at": datetime.now(timezone.utc) + timedelta(hours=1)}}))
+
+    claimed = run(server.claim_jobs(10))
+    assert [job['id'] for job in claimed] == [due]
+    assert claimed[0]['status'] == "running" and claimed[0]['attempts'] == 1
+    assert claimed[0]['locked_until'] > datetime.now(timezone.utc)
+    # Leased jobs are not handed out again
+    assert run(server.claim_jobs(10)) == []
+
+def test_expired_lease_is_reclaimed(jobs_db):
+    job_id = run(server.enqueue_job("noop", {}))
+    run(server.claim_jobs(1))
+    run(jobs_db.jobs.update_one({"id": job_id},
+                                {"$set": {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}))
+    [job] = run(server.claim_jobs(1))
+    assert job['id'] == job_id and job['attempts'] == 2
+
+def test_failed_job_backs_off_then_gives_up(jobs_db, monkeypatch):
+    async def broken(payload, job):
+        raise RuntimeError("boom")
+    monkeypatch.setitem(server.job_handlers, "broken", broken)
+    job_id = run(server.enqueue_job("broken", {}))
+
+    [job] = run(server.claim_jobs(1))
+    started = datetime.now(timezone.utc)
+    run(server.run_job(job))
+    stored = run(job_doc(jobs_db, job_id))
+    assert stored['status'] == "queued" and stored['last_error'] == "boom"
+    # Stored datetimes are truncated to milliseconds
+    assert stored['run_at'] >= started + timedelta(seconds=2) - timedelta(milliseconds=1)
+    assert "locked_until" not in stored
+
+    run(jobs_db.jobs.update_one({"id": job_id}, {"$set": {"status": "running",
+                                                          "attempts": server.JOB_MAX_ATTEMPTS}}))
+    run(server.run_job(run(job_doc(jobs_db, job_id))))
+    stored = run(job_doc(jobs_db, job_id))
+    assert stored['status'] == "failed" and "finished_at" in stored
+
+def test_add_balance_credits_once_per_job(jobs_db):
+    run(jobs_db.traders.insert_one({"id": TRADER_ID, "user_id": "u1", "usdt_balance": 0,
+                                    "is_working": True, "is_blocked": False}))
+    job_id = run(server.enqueue_job("trader.add_balance", {"trader_id": TRADER_ID, "amount": 500}))
+    [job] = run(server.claim_jobs(1))
+    assert run(server.run_job(job)) is None
+    assert run(job_doc(jobs_db, job_id))['result'] == {"applied": True, "new_balance": 5.0}
+
+    # Many other top-ups land before the first job is handed out again
+    for _ in range(25):
+        run(server.enqueue_job("trader.add_balance", {"trader_id": TRADER_ID, "amount": 100}))
+    for other in run(server.claim_jobs(50)):
+        run(server.run_job(other))
+    run(server.add_balance_job(job['payload'], run(job_doc(jobs_db, job_id))))
+
+    trader = run(jobs_db.traders.find_one({"id": TRADER_ID}))
+    assert trader['usdt_balance'] == 500 + 25 * 100
+    assert trader['applied_jobs'] == []
+
+def test_add_balance_retry_after_crash_before_marking_job(jobs_db):
+    run(jobs_db.traders.insert_one({"id": TRADER_ID, "user_id": "u1", "usdt_balance": 0,
+                                    "is_working": True, "is_blocked": False, "applied_jobs": ["job-1"]}))
+    job = {"id": "job-1", "created_by": None}
+    run(jobs_db.jobs.insert_one({**job, "status": "running"}))
+    # The credit landed but the job was never marked; the retry only finishes the bookkeeping
+    result = run(server.add_balance_job({"trader_id": TRADER_ID, "amount": 500}, job))
+    assert result == {"applied": True, "new_balance": 0.0}
+    assert run(job_doc(jobs_db, "job-1"))['applied'] is True
+    assert run(jobs_db.traders.find_one({"id": TRADER_ID}))['applied_jobs'] == []
+
+def test_trader_views_hide_applied_jobs(api, make_user, db):
+    trader_user, headers = make_user("trader@example.com", "trader")
+    run(db.traders.insert_one({"id": TRADER_ID, "user_id": trader_user.id, "usdt_balance": 0,
+                               "is_working": True, "is_blocked": False, "applied_jobs": ["job-1"]}))
+    assert "applied_jobs" not in api.get("/api/trader/profile", headers=headers).json()
+    assert "applied_jobs" not in api.get("/api/auth/me", headers=headers).json()['trader']
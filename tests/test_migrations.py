@@ -0,0 +1,44 @@
+import asyncio
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+import migrate_money_to_minor_units as money
+
+class CrashingDB:
+    """Database whose `crash_on` collection fails to update, as if the script died there."""
+    def __init__(self, db, crash_on: str):
+        self.db = db
+        self.crash_on = crash_on
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def __getitem__(self, name):
+        if name == self.crash_on:
+            raise RuntimeError("connection lost")
+        return self.db[name]
+
+@pytest.fixture
+def migration_db(monkeypatch):
+    # mongomock has no $round; the amounts below convert exactly without it
+    monkeypatch.setattr(money, 'to_minor_expr',
+                        lambda field: {"$toLong": {"$multiply": [f"${field}", money.MINOR_UNITS]}})
+    return AsyncMongoMockClient()['skipay_migration_test']
+
+def test_money_migration_rerun_after_partial_run(migration_db):
+    db = migration_db
+    asyncio.run(db.traders.insert_one({"id": "t1", "usdt_balance": 12.5}))
+    asyncio.run(db.cards.insert_one({"id": "c1", "limit": 1000.0, "current_usage": 250.25}))
+    asyncio.run(db.withdrawals.insert_one({"id": "w1", "amount": 3.0}))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(money.migrate_db(CrashingDB(db, "transactions")))
+    assert asyncio.run(db.traders.find_one({"id": "t1"}))['usdt_balance'] == 1250
+
+    assert asyncio.run(money.migrate_db(db))
+    assert asyncio.run(db.traders.find_one({"id": "t1"}))['usdt_balance'] == 1250
+    card = asyncio.run(db.cards.find_one({"id": "c1"}))
+    assert (card['limit'], card['current_usage']) == (100000, 25025)
+    assert asyncio.run(db.withdrawals.find_one({"id": "w1"}))['amount'] == 300
+
+    assert not asyncio.run(money.migrate_db(db))
+    assert asyncio.run(db.traders.find_one({"id": "t1"}))['usdt_balance'] == 1250
@@ -0,0 +1,21 @@
+import asyncio
+import server
+
+def test_memory_buckets_stay_bounded_without_resetting_others(monkeypatch):
+    monkeypatch.setattr(server, 'RATE_LIMIT_MEMORY_MAX_KEYS', 100)
+    limiter = server.MemoryRateLimiter()
+
+    async def scenario():
+        # Throttle one client, then flood with other keys
+        while not await limiter.acquire("deposit:user:victim", 0.001, 2):
+            pass
+        for i in range(50):
+            await limiter.acquire(f"deposit:ip:{i}", 0.001, 2)
+        still_throttled = await limiter.acquire("deposit:user:victim", 0.001, 2)
+        for i in range(50, 1000):
+            await limiter.acquire(f"deposit:ip:{i}", 0.001, 2)
+        return still_throttled
+
+    assert asyncio.run(scenario()) > 0
+    assert len(limiter.buckets) == 100
+    assert "deposit:ip:999" in limiter.buckets
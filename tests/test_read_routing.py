@@ -0,0 +1,30 @@
+"""
+Read preference per route class, checked on the real Motor handles (Motor
+connects lazily, so no server is needed). Settlement and other writes must
+stay on the primary; dashboards and analytics may use a bounded-staleness
+secondary.
+"""
+import asyncio
+from pymongo.read_preferences import Primary, SecondaryPreferred
+import server
+
+def test_handles_carry_their_route_class_read_preference():
+    dashboard = asyncio.run(server.get_dashboard_repos())
+    primary = asyncio.run(server.get_repos())
+    analytics = server.reader("analytics")
+
+    for collection in (dashboard.transactions.collection, dashboard.withdrawals.collection, analytics.transactions):
+        assert collection.read_preference.mode == SecondaryPreferred().mode
+        assert collection.read_preference.max_staleness == server.READ_MAX_STALENESS_SECONDS
+
+    # Request repositories and the settlement path (apply_settlement uses server.db) read the primary
+    for collection in (primary.transactions.collection, primary.traders.collection,
+                       server.db.traders, server.db.transactions):
+        assert collection.read_preference.mode == Primary().mode
+        assert collection.read_preference.max_staleness == -1
+
+def test_primary_route_class_ignores_staleness():
+    assert server.make_read_preference("primary") == Primary()
+    assert server.make_read_preference("secondaryPreferred") == SecondaryPreferred(
+        max_staleness=server.READ_MAX_STALENESS_SECONDS
+    )
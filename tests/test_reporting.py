@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import server
+
+def seed_completed(db, trader_id: str):
+    completed_at = datetime.now(timezone.utc) - timedelta(hours=1)
+    asyncio.run(db.settings.insert_one({"usd_to_uah_rate": 40.0, "currency_rates": {"EUR": 0.5}}))
+    server.invalidate_settings_cache()
+    asyncio.run(db.transactions.insert_many([
+        # 1000.00 UAH for 20 USDT, 100.00 EUR for 100 USDT, 50.00 PLN (no rate) for 10 USDT
+        {"id": "t-uah", "trader_id": trader_id, "currency": "UAH", "amount": 100000, "usdt_requested": 2000,
+         "status": "completed", "created_at": completed_at, "completed_at": completed_at},
+        {"id": "t-eur", "trader_id": trader_id, "currency": "EUR", "amount": 10000, "usdt_requested": 10000,
+         "status": "completed", "created_at": completed_at, "completed_at": completed_at},
+        {"id": "t-pln", "trader_id": trader_id, "currency": "PLN", "amount": 5000, "usdt_requested": 1000,
+         "status": "completed", "created_at": completed_at, "completed_at": completed_at},
+    ]))
+
+def test_trader_report_prices_each_currency_with_its_rate(api, make_user, db):
+    _, admin_headers = make_user("admin@example.com", "admin")
+    seed_completed(db, "trader-1")
+
+    response = api.get("/api/admin/reports/traders", headers=admin_headers)
+    assert response.status_code == 200, response.text
+    report = response.json()
+    by_currency = {row['currency']: row for row in report['by_currency']}
+    # Profit = received - USDT * 1.04 * rate of the transaction's own currency
+    assert by_currency['UAH']['volume'] == 1000.0
+    assert by_currency['UAH']['profit'] == 1000.0 - 20 * 1.04 * 40.0
+    assert by_currency['EUR']['volume'] == 100.0
+    assert by_currency['EUR']['profit'] == 100.0 - 100 * 1.04 * 0.5
+    assert by_currency['PLN']['profit'] is None
+    assert report['exchange_rates'] == {"EUR": 0.5, "PLN": None, "UAH": 40.0}
+    assert {(row['trader_id'], row['currency']) for row in report['by_trader']} == {
+        ("trader-1", "UAH"), ("trader-1", "EUR"), ("trader-1", "PLN")}
+    assert len(report['by_day']) == 3
+
+def test_trader_stats_report_profit_per_currency(api, make_user, db):
+    trader_user, trader_headers = make_user("trader@example.com", "trader")
+    trader = server.Trader(user_id=trader_user.id, name="T", nickname="t", usdt_address="a", phone="p")
+    asyncio.run(db.traders.insert_one(trader.model_dump()))
+    seed_completed(db, trader.id)
+
+    response = api.get("/api/stats", headers=trader_headers)
+    assert response.status_code == 200, response.text
+    stats = response.json()
+    assert stats['completed_transactions'] == 3
+    assert stats['today_uah_received'] == 1000.0
+    assert stats['total_profit'] == round(1000.0 - 20 * 1.04 * 40.0, 2)
+    assert stats['by_currency']['EUR']['total_profit'] == round(100.0 - 100 * 1.04 * 0.5, 2)
+    assert stats['by_currency']['EUR']['volume'] == 100.0
+    assert stats['by_currency']['PLN']['total_profit'] is None
@@ -0,0 +1,61 @@
+import asyncio
+import repositories
+import server
+
+def test_route_writes_reach_query_hooks(api, make_user, db, monkeypatch):
+    seen = []
+    monkeypatch.setattr(repositories, 'query_hooks', [lambda collection, operation, *_: seen.append((collection, operation))])
+    _, admin_headers = make_user("admin@example.com", "admin")
+    trader_user, trader_headers = make_user("trader@example.com", "trader")
+    _, user_headers = make_user("client@example.com")
+    trader = server.Trader(user_id=trader_user.id, name="T", nickname="t", usdt_address="a", phone="p",
+                           usdt_balance=100000)
+    asyncio.run(db.traders.insert_one(trader.model_dump()))
+    asyncio.run(server.routing_index.load())
+
+    def ok(response):
+        assert response.status_code < 300, response.text
+        return response.json()
+
+    ok(api.get("/api/admin/settings", headers=admin_headers))
+    ok(api.put("/api/admin/settings", headers=admin_headers, json={"commission_rate": 9, "usd_to_uah_rate": 41.5}))
+    server.invalidate_settings_cache()
+    ok(api.post("/api/trader/toggle-work", headers=trader_headers))
+    ok(api.post("/api/trader/cards", headers=trader_headers,
+                json={"card_number": "4111", "bank_name": "B", "holder_name": "H", "limit": 100000}))
+    txn_id = ok(api.post("/api/user/request-card", headers=user_headers, json={"amount": 1000}))['transaction_id']
+    ok(api.post(f"/api/user/confirm-payment/{txn_id}", headers=user_headers))
+    ok(api.post(f"/api/trader/confirm-payment/{txn_id}", headers=trader_headers))
+    ok(api.post("/api/user/withdrawal-request", headers=user_headers, json={"amount": 1, "wallet_address": "T1"}))
+
+    for write in [("settings", "find_one"), ("settings", "update"), ("traders", "update"),
+                  ("transactions", "insert"), ("transaction_keys", "insert"), ("withdrawals", "insert")]:
+        assert write in seen
+
+def test_concurrent_gets_share_one_query(db, monkeypatch):
+    seen = []
+    monkeypatch.setattr(repositories, 'query_hooks', [lambda collection, operation, *_: seen.append((collection, operation))])
+    asyncio.run(db.users.insert_many([{"id": f"u{n}", "email": f"u{n}@example.com"} for n in range(5)]))
+
+    async def load():
+        repo = repositories.UserRepo(db, 100)
+        return await asyncio.gather(*(repo.get(user_id) for user_id in ["u0", "u1", "u2", "u3", "u4", "u1", "missing"]))
+
+    docs = asyncio.run(load())
+    assert [doc['id'] if doc else None for doc in docs] == ["u0", "u1", "u2", "u3", "u4", "u1", None]
+    assert seen == [("users", "get_many")]
+
+def test_concurrent_get_error_reaches_every_waiter(db, monkeypatch):
+    async def load():
+        repo = repositories.UserRepo(db, 100)
+
+        async def broken(keys, **scope):
+            raise RuntimeError("connection lost")
+
+        repo.get_many = broken
+        return await asyncio.gather(*(repo.get(user_id) for user_id in ["u0", "u1", "u2"]), return_exceptions=True)
+
+    results = asyncio.run(load())
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len({id(result) for result in results}) == 1
@@ -0,0 +1,70 @@
+import asyncio
+import server
+
+def test_deposit_answers_503_until_routing_index_loads(api, make_user, monkeypatch):
+    monkeypatch.setattr(server, 'ROUTING_INDEX_READY_TIMEOUT_SECONDS', 0.01)
+    _, headers = make_user("client@example.com")
+    headers = {**headers, "Idempotency-Key": "deposit-1"}
+
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 100})
+    assert response.status_code == 503
+    # The idempotency key is released, so the client can retry with it (each
+    # TestClient request runs on its own event loop, hence the fresh index)
+    monkeypatch.setattr(server, 'routing_index', server.EligibilityIndex())
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 100})
+    assert response.status_code == 503
+
+def add_trader_with_cards(db, make_user, currencies):
+    trader_user, _ = make_user("trader@example.com", "trader")
+    trader = server.Trader(user_id=trader_user.id, name="T", nickname="t", usdt_address="a", phone="p",
+                           usdt_balance=1000000, is_working=True)
+    asyncio.run(db.traders.insert_one(trader.model_dump()))
+    cards = [server.Card(trader_id=trader.id, card_number=f"4111-{currency}", bank_name="B", holder_name="H",
+                         limit=10000000, currency=currency) for currency in currencies]
+    asyncio.run(db.cards.insert_many([card.model_dump() for card in cards]))
+    return {card.currency: card for card in cards}
+
+def test_deposits_only_route_to_cards_in_their_currency(api, make_user, db):
+    asyncio.run(db.settings.insert_one({"usd_to_uah_rate": 40.0, "currency_rates": {"EUR": 0.9}}))
+    server.invalidate_settings_cache()
+    cards = add_trader_with_cards(db, make_user, ["UAH"])
+    asyncio.run(server.routing_index.load())
+    _, headers = make_user("client@example.com")
+
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 100, "currency": "EUR"})
+    assert response.status_code == 404
+    assert asyncio.run(db.transactions.count_documents({})) == 0
+
+    response = api.post("/api/user/request-card", headers=headers, json={"amount": 100, "currency": "UAH"})
+    assert response.status_code == 200, response.text
+    txn = asyncio.run(db.transactions.find_one({"id": response.json()['transaction_id']}))
+    assert (txn['card_id'], txn['currency']) == (cards["UAH"].id, "UAH")
+
+    # Quotes are priced with the rate of the requested currency
+    assert api.get("/api/quote", params={"amount": 100, "currency": "EUR"}).json()['exchange_rate'] == 0.9
+    assert api.get("/api/quote", params={"amount": 100, "currency": "UAH"}).json()['exchange_rate'] == 40.0
+
+def test_candidates_never_cross_currencies(db, make_user):
+    cards = add_trader_with_cards(db, make_user, ["UAH", "EUR"])
+    asyncio.run(server.routing_index.load())
+    for currency in ("UAH", "EUR"):
+        assert [card['id'] for card in server.routing_index.candidates(currency, 100, 100)] == [cards[currency].id]
+    assert server.routing_index.candidates("PLN", 100, 100) == []
+
+def test_card_changing_currency_moves_between_partitions(db, make_user):
+    cards = add_trader_with_cards(db, make_user, ["UAH"])
+    index = server.routing_index
+    asyncio.run(index.load())
+    card = asyncio.run(db.cards.find_one({"id": cards["UAH"].id}))
+
+    index.apply_change({"ns": {"coll": "cards"}, "operationType": "update", "fullDocument": {**card, "currency": "EUR"}})
+    assert not index.has_cards("UAH")
+    assert [c['id'] for c in index.candidates("EUR", 100, 100)] == [card['id']]
+
+    index.upsert_card({"id": card['id'], "status": "paused"})
+    assert not index.has_cards("EUR")
+    index.upsert_card({"id": card['id'], "status": "active"})
+    assert index.has_cards("EUR") and not index.has_cards("UAH")
+
+    index.apply_change({"ns": {"coll": "cards"}, "operationType": "delete", "documentKey": {"_id": card['_id']}})
+    assert not index.has_cards("EUR")
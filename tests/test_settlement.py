@@ -0,0 +1,149 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+import server
+
+TRADER_ID = "trader-1"
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def seed(db, balance=100000, pending=(), transactions=()):
+    await db.traders.insert_one({"id": TRADER_ID, "user_id": "user-1", "usdt_balance": balance,
+                                 "is_working": True, "is_blocked": False, "pending_settlements": list(pending)})
+    for txn in transactions:
+        await db.transactions.insert_one({"trader_id": TRADER_ID, "user_id": "user-2", "usdt_requested": 1000, **txn})
+
+async def state(db, txn_id):
+    txn = await db.transactions.find_one({"id": txn_id})
+    trader = await db.traders.find_one({"id": TRADER_ID})
+    return txn['status'], trader['usdt_balance'], trader['pending_settlements']
+
+def stale():
+    return datetime.now(timezone.utc) - timedelta(seconds=server.SETTLEMENT_RECOVERY_GRACE_SECONDS + 5)
+
+def test_settlement_debits_once_and_completes(db):
+    run(seed(db, transactions=[{"id": "t1", "status": "settling", "settling_at": datetime.now(timezone.utc)}]))
+    txn = run(db.transactions.find_one({"id": "t1"}, {"_id": 0}))
+    settlement = run(server.apply_settlement(TRADER_ID, [(txn, 1040)]))
+    assert settlement.trader['usdt_balance'] == 100000 - 1040
+    assert settlement.completed_ids == ["t1"]
+    assert run(state(db, "t1")) == ("completed", 100000 - 1040, [])
+
+def test_settlement_refuses_insufficient_balance(db):
+    run(seed(db, balance=500, transactions=[{"id": "t1", "status": "settling"}]))
+    txn = run(db.transactions.find_one({"id": "t1"}, {"_id": 0}))
+    assert run(server.apply_settlement(TRADER_ID, [(txn, 1040)])) is None
+    assert run(state(db, "t1")) == ("settling", 500, [])
+
+def test_recovery_rolls_debited_settlement_forward(db):
+    run(seed(db, balance=100000 - 1040, pending=["t1"],
+             transactions=[{"id": "t1", "status": "settling", "settling_at": stale()}]))
+    run(server.recover_settlements())
+    assert run(state(db, "t1")) == ("completed", 100000 - 1040, [])
+
+def test_recovery_rolls_undebited_settlement_back(db):
+    run(seed(db, transactions=[{"id": "t1", "status": "settling", "settling_at": stale()}]))
+    run(server.recover_settlements())
+    txn = run(db.transactions.find_one({"id": "t1"}))
+    assert txn['status'] == "user_confirmed"
+    assert "settling_at" not in txn
+
+def test_recovery_leaves_recent_settlements_alone(db):
+    run(seed(db, transactions=[{"id": "t1", "status": "settling", "settling_at": datetime.now(timezone.utc)}]))
+    run(server.recover_settlements())
+    assert run(state(db, "t1"))[0] == "settling"
+
+def test_debit_after_rollback_keeps_marker_for_recovery(db):
+    # Recovery rolled the transaction back just before the debit landed
+    run(seed(db, transactions=[{"id": "t1", "status": "user_confirmed"}]))
+    txn = run(db.transactions.find_one({"id": "t1"}, {"_id": 0}))
+    assert run(server.apply_settlement(TRADER_ID, [(txn, 1040)])) is not None
+    assert run(state(db, "t1")) == ("user_confirmed", 100000 - 1040, ["t1"])
+    
+    # A second confirmation can't debit the same transaction again
+    run(db.transactions.update_one({"id": "t1"}, {"$set": {"status": "settling"}}))
+    assert run(server.apply_settlement(TRADER_ID, [(txn, 1040)])) is None
+    run(db.transactions.update_one({"id": "t1"}, {"$set": {"status": "user_confirmed"}}))
+    
+    run(server.recover_settlements())
+    assert run(state(db, "t1")) == ("completed", 100000 - 1040, [])
+
+def test_partial_batch_completes_the_rest_through_recovery(db):
+    run(seed(db, transactions=[{"id": "t1", "status": "settling"}, {"id": "t2", "status": "user_confirmed"}]))
+    txns = run(db.transactions.find({}, {"_id": 0}).sort("id").to_list(None))
+    settlement = run(server.apply_settlement(TRADER_ID, [(txn, 1040) for txn in txns]))
+    assert settlement.completed_ids == ["t1"]
+    assert run(state(db, "t1")) == ("completed", 100000 - 2080, ["t2"])
+    completed = run(db.events.find({"type": "transaction.completed"}).to_list(None))
+    assert [e['entity_id'] for e in completed] == ["t1"]
+    
+    run(server.recover_settlements())
+    assert run(state(db, "t2")) == ("completed", 100000 - 2080, [])
+
+def test_partial_batch_reports_and_counts_only_completed(api, make_user, db, monkeypatch):
+    trader_user, headers = make_user("trader@example.com", "trader")
+    run(db.traders.insert_one({"id": TRADER_ID, "user_id": trader_user.id, "usdt_balance": 100000,
+                               "is_working": True, "is_blocked": False}))
+    for txn_id in ("t1", "t2"):
+        run(db.transactions.insert_one({"id": txn_id, "trader_id": TRADER_ID, "user_id": "user-2", "amount": 4000,
+                                        "usdt_requested": 1000, "currency": "UAH", "status": "user_confirmed"}))
+    run_settlement = server.run_settlement
+
+    async def rolled_back_meanwhile(trader_id, settlements):
+        # Recovery rolls t2 back between the claim and the debit
+        await db.transactions.update_one({"id": "t2"}, {"$set": {"status": "user_confirmed"}})
+        return await run_settlement(trader_id, settlements)
+
+    monkeypatch.setattr(server, 'run_settlement', rolled_back_meanwhile)
+    response = api.post("/api/trader/confirm-payments", headers=headers, json={"transaction_ids": ["t1", "t2"]})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert [r['status'] for r in body['results']] == ["completed", "pending"]
+    assert body['confirmed'] == 1
+    assert run(db.counters.find_one({"_id": server.ADMIN_STATS_ID}))['completed_transactions'] == 1
+
+    run(server.recover_settlements())
+    assert run(state(db, "t2"))[0] == "completed"
+    assert run(db.counters.find_one({"_id": server.ADMIN_STATS_ID}))['completed_transactions'] == 2
+
+class SessionlessCollection:
+    """mongomock rejects sessions; stands in for a collection inside a Mongo transaction."""
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        return lambda *args, session=None, **kwargs: method(*args, **kwargs)
+
+class SessionlessDB:
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return SessionlessCollection(self.db[name])
+
+    def __getitem__(self, name):
+        return SessionlessCollection(self.db[name])
+
+def test_session_settlement_aborts_on_conflict(db, monkeypatch):
+    run(seed(db, transactions=[{"id": "t1", "status": "user_confirmed"}]))
+    txn = run(db.transactions.find_one({"id": "t1"}, {"_id": 0}))
+    monkeypatch.setattr(server, 'db', SessionlessDB(db))
+    with pytest.raises(server.SettlementConflict):
+        run(server.apply_settlement(TRADER_ID, [(txn, 1040)], session=object()))
+    # The marker is only used without transactions
+    assert run(state(db, "t1"))[2] == []
+
+def test_trader_views_hide_settlement_bookkeeping(api, make_user, db):
+    trader_user, trader_headers = make_user("trader@example.com", "trader")
+    _, admin_headers = make_user("admin@example.com", "admin")
+    run(db.traders.insert_one({"id": TRADER_ID, "user_id": trader_user.id, "usdt_balance": 100000,
+                               "is_working": True, "is_blocked": False, "pending_settlements": ["t1"]}))
+
+    profile = api.get("/api/trader/profile", headers=trader_headers).json()
+    me = api.get("/api/auth/me", headers=trader_headers).json()
+    traders = api.get("/api/admin/traders", headers=admin_headers).json()
+    for trader in [profile, me['trader'], *traders]:
+        assert trader['id'] == TRADER_ID
+        assert "pending_settlements" not in trader
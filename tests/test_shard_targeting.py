@@ -0,0 +1,101 @@
+"""
+Hot routes must only send shard-targeted queries to sharded collections.
+
+Every filter sent to a sharded collection is recorded while trader and user
+routes run, and each one must carry the collection's shard key. Admin
+listings and background sweeps are scatter-gather by design and not covered.
+"""
+import asyncio
+import pytest
+from repositories import SHARD_KEYS
+import server
+
+FILTER_METHODS = {
+    "find", "find_one", "find_one_and_update", "update_one", "update_many",
+    "delete_one", "delete_many", "count_documents", "distinct",
+}
+
+class RecordingCollection:
+    def __init__(self, collection, name: str, queries: list):
+        self.collection = collection
+        self.name = name
+        self.queries = queries
+
+    def __getattr__(self, attr):
+        method = getattr(self.collection, attr)
+        if attr in FILTER_METHODS:
+            def record(*args, **kwargs):
+                query = kwargs.get("filter", args[1] if attr == "distinct" and len(args) > 1 else
+                                   args[0] if args and attr != "distinct" else {})
+                self.queries.append((self.name, attr, query))
+                return method(*args, **kwargs)
+            return record
+        if attr == "aggregate":
+            def record_pipeline(pipeline, *args, **kwargs):
+                match = pipeline[0].get("$match", {}) if pipeline else {}
+                self.queries.append((self.name, attr, match))
+                return method(pipeline, *args, **kwargs)
+            return record_pipeline
+        if attr == "bulk_write":
+            def record_bulk(operations, *args, **kwargs):
+                for operation in operations:
+                    self.queries.append((self.name, attr, getattr(operation, "_filter", {})))
+                return method(operations, *args, **kwargs)
+            return record_bulk
+        return method
+
+class RecordingDB:
+    def __init__(self, db):
+        self.db = db
+        self.queries = []
+
+    def __getitem__(self, name):
+        if name in SHARD_KEYS:
+            return RecordingCollection(self.db[name], name, self.queries)
+        return self.db[name]
+
+    def __getattr__(self, name):
+        return self[name]
+
+@pytest.fixture
+def recorded(db, monkeypatch):
+    recording = RecordingDB(db)
+    monkeypatch.setattr(server, 'db', recording)
+    monkeypatch.setattr(server, 'reader', lambda route_class: recording)
+    return recording
+
+def test_hot_routes_only_send_targeted_queries(api, make_user, db, recorded):
+    trader_user, trader_headers = make_user("trader@example.com", "trader")
+    _, user_headers = make_user("client@example.com")
+    trader = server.Trader(user_id=trader_user.id, name="T", nickname="t", usdt_address="a", phone="p",
+                           usdt_balance=100000, is_working=True)
+    asyncio.run(db.traders.insert_one(trader.model_dump()))
+    asyncio.run(server.routing_index.load())  # background full load, scatter by design
+    recorded.queries.clear()
+
+    def ok(response):
+        assert response.status_code < 300, response.text
+        return response.json()
+
+    card = ok(api.post("/api/trader/cards", headers=trader_headers,
+                       json={"card_number": "4111", "bank_name": "B", "holder_name": "H", "limit": 100000}))
+    ok(api.put(f"/api/trader/cards/{card['id']}", headers=trader_headers, json={"card_name": "Main"}))
+    txn_ids = []
+    for _ in range(3):
+        txn_id = ok(api.post("/api/user/request-card", headers=user_headers, json={"amount": 1000}))['transaction_id']
+        ok(api.post(f"/api/user/confirm-payment/{txn_id}", headers=user_headers))
+        txn_ids.append(txn_id)
+    ok(api.post(f"/api/trader/confirm-payment/{txn_ids[0]}", headers=trader_headers))
+    ok(api.post("/api/trader/confirm-payments", headers=trader_headers, json={"transaction_ids": txn_ids[1:]}))
+    ok(api.get("/api/trader/transactions", headers=trader_headers))
+    ok(api.get("/api/trader/transactions?include_archive=true", headers=trader_headers))
+    ok(api.get("/api/trader/cards", headers=trader_headers))
+    ok(api.get("/api/trader/info", headers=trader_headers))
+    ok(api.get("/api/stats", headers=trader_headers))
+    ok(api.get("/api/user/transactions", headers=user_headers))
+    ok(api.get("/api/user/transactions?include_archive=true", headers=user_headers))
+    ok(api.delete(f"/api/trader/cards/{card['id']}", headers=trader_headers))
+
+    assert recorded.queries
+    scatter = [(name, op, query) for name, op, query in recorded.queries if SHARD_KEYS[name] not in query]
+    assert scatter == []
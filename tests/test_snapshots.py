@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+import server
+import snapshots
+
+LAG = timedelta(hours=48)
+
+def insert_transactions(db, count: int, age: timedelta):
+    created_at = datetime.now(timezone.utc) - age
+    asyncio.run(db.transactions.insert_many([
+        {"id": f"txn-{created_at.timestamp()}-{n}", "trader_id": "t1", "amount": 100, "currency": "UAH",
+         "status": "completed", "created_at": created_at}
+        for n in range(count)
+    ]))
+
+def test_rerun_after_crash_does_not_duplicate_rows(db, tmp_path, monkeypatch):
+    insert_transactions(db, 3, timedelta(days=3))
+    save_state = snapshots.save_state
+    calls = []
+
+    def crash_after_export(root, state):
+        calls.append(dict(state.pending))
+        # First save records the pending window; the second would commit the watermark
+        if len(calls) == 2:
+            raise RuntimeError("crashed before saving the watermark")
+        save_state(root, state)
+
+    monkeypatch.setattr(snapshots, 'save_state', crash_after_export)
+    with pytest.raises(RuntimeError):
+        asyncio.run(snapshots.run_snapshot(db, tmp_path, LAG))
+    monkeypatch.setattr(snapshots, 'save_state', save_state)
+    assert snapshots.read_snapshot(tmp_path, "transactions").num_rows == 3
+
+    asyncio.run(snapshots.run_snapshot(db, tmp_path, LAG))
+    ids = snapshots.read_snapshot(tmp_path, "transactions").column("id").to_pylist()
+    assert len(ids) == len(set(ids)) == 3
+    state = snapshots.load_state(tmp_path)
+    assert state.pending == {}
+    assert state.watermarks["transactions"] == calls[0]["transactions"].until
+
+def test_snapshot_lease_excludes_other_workers(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'SNAPSHOT_DIR', str(tmp_path))
+    assert asyncio.run(server.acquire_lease(server.SNAPSHOT_LEASE_ID, 60))
+
+    monkeypatch.setattr(server, 'WORKER_ID', 'other-worker')
+    assert not asyncio.run(server.acquire_lease(server.SNAPSHOT_LEASE_ID, 60))
+    asyncio.run(server.snapshot_history())
+    assert not (tmp_path / snapshots.WATERMARKS_FILE).exists()
+
+    asyncio.run(db.leases.update_one({"_id": server.SNAPSHOT_LEASE_ID},
+                                     {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}))
+    asyncio.run(server.snapshot_history())
+    assert (tmp_path / snapshots.WATERMARKS_FILE).exists()
+    lease = asyncio.run(db.leases.find_one({"_id": server.SNAPSHOT_LEASE_ID}))
+    assert lease['owner'] == 'other-worker'
+    assert lease['expires_at'] <= datetime.now(timezone.utc)
+
+def test_snapshot_stops_when_its_lease_is_taken_over(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'SNAPSHOT_DIR', str(tmp_path))
+    insert_transactions(db, 3, timedelta(days=3))
+    write_partitions = snapshots.write_partitions
+    leases = []
+
+    def taken_over_after_first_write(root, dataset, rows, prefix):
+        write_partitions(root, dataset, rows, prefix)
+        # Runs in a worker thread, so it can drive the (in-memory) database on its own loop
+        leases.append(asyncio.run(db.leases.find_one({"_id": server.SNAPSHOT_LEASE_ID})))
+        # The export outlived the lease and another worker took it
+        asyncio.run(db.leases.update_one({"_id": server.SNAPSHOT_LEASE_ID}, {"$set": {
+            "owner": "other-worker", "expires_at": datetime.now(timezone.utc) + timedelta(hours=1)}}))
+
+    monkeypatch.setattr(snapshots, 'write_partitions', taken_over_after_first_write)
+    asyncio.run(server.snapshot_history())
+    assert leases[0]['owner'] == server.WORKER_ID
+    # Stopped before the next write: the window stays pending for the new holder
+    assert len(leases) == 1
+    state = snapshots.load_state(tmp_path)
+    assert "transactions" in state.pending and "transactions" not in state.watermarks
+    assert asyncio.run(db.leases.find_one({"_id": server.SNAPSHOT_LEASE_ID}))['owner'] == "other-worker"
+
+def test_snapshot_lease_is_renewed_before_each_write(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'SNAPSHOT_DIR', str(tmp_path))
+    monkeypatch.setattr(snapshots, 'WRITE_BATCH_SIZE', 1)
+    insert_transactions(db, 3, timedelta(days=3))
+    acquire_lease, write_partitions, save_state = server.acquire_lease, snapshots.write_partitions, snapshots.save_state
+    calls = []
+
+    async def recording_acquire(*args):
+        calls.append("lease")
+        return await acquire_lease(*args)
+
+    def recording(name, func):
+        def wrapper(*args):
+            calls.append(name)
+            return func(*args)
+        return wrapper
+
+    monkeypatch.setattr(server, 'acquire_lease', recording_acquire)
+    monkeypatch.setattr(snapshots, 'write_partitions', recording("write", write_partitions))
+    monkeypatch.setattr(snapshots, 'save_state', recording("save", save_state))
+    asyncio.run(server.snapshot_history())
+    assert calls.count("write") == 3
+    assert all(calls[i - 1] == "lease" for i, call in enumerate(calls) if call in ("write", "save"))
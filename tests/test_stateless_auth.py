@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import jwt
+import pytest
+import repositories
+import server
+
+@pytest.fixture
+def stateless(db, monkeypatch):
+    monkeypatch.setattr(server, 'AUTH_MODE', 'stateless')
+    monkeypatch.setattr(server, 'blocked_user_ids', set())
+    user_reads = []
+    monkeypatch.setattr(repositories, 'query_hooks',
+                        [lambda collection, operation, *_: collection == "users" and user_reads.append(operation)])
+    return user_reads
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+def test_claims_are_trusted_without_reading_the_user(api, stateless):
+    # The user isn't even in the database: the signed claims are enough
+    token = server.create_token("ghost", "ghost@example.com", "user")
+    response = api.get("/api/auth/me", headers=bearer(token))
+    assert response.status_code == 200, response.text
+    assert response.json()['id'] == "ghost"
+    assert stateless == []
+
+def test_blocked_user_is_rejected_without_a_database_read(api, make_user, stateless):
+    user, headers = make_user("client@example.com")
+    _, admin_headers = make_user("admin@example.com", "admin")
+    assert api.put(f"/api/admin/users/{user.id}/block", headers=admin_headers).json()['is_blocked']
+    stateless.clear()
+
+    response = api.get("/api/auth/me", headers=headers)
+    assert response.status_code == 403
+    assert stateless == []
+
+def test_token_with_outdated_role_is_rejected_until_refreshed(api, make_user, db, stateless):
+    user, headers = make_user("client@example.com")
+    asyncio.run(db.users.update_one({"id": user.id}, {"$set": {"role": "trader"}}))
+    # Role checks trust the claims, so the old token still says "user"
+    assert api.get("/api/trader/cards", headers=headers).status_code == 403
+
+    refreshed = api.post("/api/auth/refresh", json={"refresh_token": server.create_refresh_token(user.id)}).json()
+    assert refreshed['user']['role'] == "trader"
+    assert api.get("/api/trader/cards", headers=bearer(refreshed['token'])).status_code == 200
+
+def test_refresh_rotates_both_tokens(api, make_user, stateless):
+    user, _ = make_user("client@example.com")
+    refresh_token = server.create_refresh_token(user.id)
+    response = api.post("/api/auth/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body['refresh_token'] != refresh_token
+    claims = server.decode_token(body['token'])
+    assert claims['type'] == "access"
+    assert claims['exp'] - claims['iat'] == server.ACCESS_TOKEN_MINUTES * 60
+    assert api.get("/api/auth/me", headers=bearer(body['token'])).status_code == 200
+    # An access token can't be used to refresh
+    assert api.post("/api/auth/refresh", json={"refresh_token": body['token']}).status_code == 401
+
+def test_expired_refresh_token_is_denied(api, make_user, stateless):
+    user, _ = make_user("client@example.com")
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    expired = jwt.encode({"user_id": user.id, "type": "refresh", "jti": "x", "iat": past - timedelta(days=7),
+                          "exp": past}, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+    response = api.post("/api/auth/refresh", json={"refresh_token": expired})
+    assert response.status_code == 401
+    assert response.json()['detail'] == "Token expired"
+
+def test_blocked_user_cannot_refresh(api, make_user, db, stateless):
+    user, _ = make_user("client@example.com")
+    asyncio.run(db.users.update_one({"id": user.id}, {"$set": {"is_blocked": True}}))
+    response = api.post("/api/auth/refresh", json={"refresh_token": server.create_refresh_token(user.id)})
+    assert response.status_code == 403